@@ -11,3 +11,6 @@ Complete documentation at https://github.com/evoluxbr/greenswitch
 
 from .esl import InboundESL
 from .esl import OutboundESLServer
+from .esl import PreforkOutboundESLServer
+from .aioesl import AsyncInboundESL
+from .aioesl import AsyncOutboundESLServer
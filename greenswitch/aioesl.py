@@ -0,0 +1,671 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""asyncio transports for the FreeSWITCH Event Socket protocol.
+
+They drive the same ``ESLConnection`` state machine as the gevent classes
+in ``greenswitch.esl`` and follow their semantics, so an application can
+use either without monkey patching.
+"""
+
+import asyncio
+import functools
+import inspect
+import logging
+import pprint
+import sys
+import uuid
+
+import six
+
+from .connection import (
+    AUTH_REQUEST, CLOSED, NEED_DATA, REPLY, RUDE_REJECTION,
+    CommandTimeoutError, ESLConnection, EventHandlersMixin, NotConnectedError, OutboundSessionHasGoneAway,
+    OutboundSessionMixin)
+
+
+class AsyncESLProtocol(EventHandlersMixin):
+    read_size = 65536
+    # Default timeouts in seconds of commands and bgapi jobs, None waits
+    # forever. Jobs nobody waits for anymore are forgotten after
+    # bgapi_timeout, unless their future is cancelled first.
+    command_timeout = None
+    bgapi_timeout = 300
+    # Raised on commands still waiting for a reply when the socket closes.
+    _connection_lost_error = NotConnectedError
+
+    def __init__(self, lazy_events=False, json_decoder=None):
+        self.connection = ESLConnection(lazy_events=lazy_events,
+                                        json_decoder=json_decoder)
+        self.event_handlers = {}
+        # (name, handler) -> header values the events must have.
+        self.handler_filters = {}
+        self._reader = None
+        self._writer = None
+        self._auth_request_event = None
+        self._esl_event_queue = None
+        self._event_iterators = set()
+        self._receive_events_task = None
+        self._process_events_task = None
+
+    @property
+    def connected(self):
+        return self.connection.connected
+
+    @connected.setter
+    def connected(self, value):
+        self.connection.connected = value
+
+    @property
+    def _lingering(self):
+        return self.connection.lingering
+
+    @property
+    def _commands_sent(self):
+        return self.connection.pending
+
+    def start_event_handlers(self):
+        # Created here so they belong to the running loop.
+        self._auth_request_event = asyncio.Event()
+        self._esl_event_queue = asyncio.Queue()
+        self._receive_events_task = asyncio.ensure_future(
+            self.receive_events())
+        self._process_events_task = asyncio.ensure_future(
+            self.process_events())
+
+    async def receive_events(self):
+        connection = self.connection
+        while True:
+            try:
+                data = await self._reader.read(self.read_size)
+            except (OSError, asyncio.IncompleteReadError):
+                data = b''
+            connection.receive_data(data)
+            if not data:
+                if self.connected:
+                    logging.debug("Error receiving data, is FreeSWITCH running?")
+                break
+            self._handle_received()
+        self._connection_lost()
+
+    def _handle_received(self):
+        """Handle every complete message buffered in the connection."""
+        while True:
+            kind, event, future = self.connection.next_event()
+            if kind is NEED_DATA or kind is CLOSED:
+                return
+            self.handle_event(kind, event, future)
+
+    def handle_event(self, kind, event, future=None):
+        if kind == AUTH_REQUEST or kind == RUDE_REJECTION:
+            self._auth_request_event.set()
+        elif kind == REPLY:
+            # Replies nobody waits for, like the one of bgapi, have no future.
+            if future is not None and not future.done():
+                future.set_result(event)
+        else:
+            if future is not None and not future.done():
+                # BACKGROUND_JOB of a bgapi command.
+                future.set_result(event)
+            self._esl_event_queue.put_nowait(event)
+
+    def _connection_lost(self):
+        self.connected = False
+        # Nothing will answer the pending commands anymore.
+        for future in self.connection.clear_pending():
+            if not future.done():
+                future.set_exception(self._connection_lost_error())
+        for job_uuid in list(self.connection.background_jobs):
+            future = self.connection.cancel_background_job(job_uuid)
+            if not future.done():
+                future.set_exception(NotConnectedError())
+        self._auth_request_event.set()
+        self._esl_event_queue.put_nowait(None)
+
+    async def _safe_exec_handler(self, handler, event):
+        try:
+            result = handler(event)
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            logging.exception('ESL %s raised exception.' % handler.__name__)
+            logging.error(pprint.pformat(event.headers))
+
+    async def process_events(self):
+        logging.debug('Event Processor Running')
+        while True:
+            event = await self._esl_event_queue.get()
+            if event is None:
+                break
+
+            for queue in self._event_iterators:
+                queue.put_nowait(event)
+
+            handlers = self._get_handlers(event)
+            if not handlers:
+                continue
+
+            before_handle, after_handle = self._dispatch_hooks
+            if before_handle is not None:
+                await self._safe_exec_handler(before_handle, event)
+
+            for handle in handlers:
+                await self._safe_exec_handler(handle, event)
+
+            if after_handle is not None:
+                await self._safe_exec_handler(after_handle, event)
+
+        for queue in self._event_iterators:
+            queue.put_nowait(None)
+
+    async def events(self):
+        """Iterate over every received event until the connection closes.
+
+        Events are delivered to iterators whether or not they have
+        handlers, each iterator gets its own copy of the stream.
+        """
+        queue = asyncio.Queue()
+        self._event_iterators.add(queue)
+        self._update_wanted_events()
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            self._event_iterators.discard(queue)
+            self._update_wanted_events()
+
+    def _handled_event_names(self):
+        # Iterators want every event.
+        if self._event_iterators:
+            return None
+        return super(AsyncESLProtocol, self)._handled_event_names()
+
+    def __aiter__(self):
+        return self.events()
+
+    async def send(self, data, timeout=None):
+        """Send a command and return its reply.
+
+        If no reply comes in timeout seconds (command_timeout by default)
+        CommandTimeoutError is raised, the late reply is still consumed
+        when it arrives so the following replies keep their order.
+        """
+        if timeout is None:
+            timeout = self.command_timeout
+        future = self.send_async(data)
+        if timeout is None:
+            return await future
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise CommandTimeoutError('No reply to %s after %s seconds' %
+                                      (data.split('\n', 1)[0], timeout))
+
+    def send_async(self, data):
+        """Send a command without waiting, returns a future of its reply."""
+        if not self.connected:
+            raise NotConnectedError()
+        future = asyncio.get_event_loop().create_future()
+        self._writer.write(self.connection.send(data, future))
+        return future
+
+    def send_many(self, commands):
+        """Send several commands with a single write.
+
+        Returns a list of futures, one for each command reply.
+        """
+        if not self.connected:
+            raise NotConnectedError()
+        loop = asyncio.get_event_loop()
+        futures = [loop.create_future() for _ in commands]
+        self._writer.write(self.connection.send_many(commands, futures))
+        return futures
+
+    async def api(self, command):
+        return await self.send('api %s' % command)
+
+    def bgapi(self, command, timeout=None):
+        """Run an api command in background without blocking the connection.
+
+        Returns a future of the BACKGROUND_JOB event of the job, its
+        ``data`` is the command output. The job is forgotten when the
+        future is cancelled or, raising CommandTimeoutError, when timeout
+        seconds pass first, bgapi_timeout is used when timeout is None.
+        """
+        if not self.connected:
+            raise NotConnectedError()
+        if timeout is None:
+            timeout = self.bgapi_timeout
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        job_uuid = str(uuid.uuid4())
+        self._writer.write(self.connection.bgapi(command, job_uuid, future))
+        future.add_done_callback(
+            lambda f: self.connection.cancel_background_job(job_uuid))
+        if timeout is not None:
+            timer = loop.call_later(timeout, self._expire_background_job,
+                                    job_uuid)
+            future.add_done_callback(lambda f: timer.cancel())
+        return future
+
+    def _expire_background_job(self, job_uuid):
+        future = self.connection.cancel_background_job(job_uuid)
+        if future is not None and not future.done():
+            future.set_exception(CommandTimeoutError(
+                'Background job %s timed out' % job_uuid))
+
+    async def subscribe(self, events='ALL', event_format='plain'):
+        """Subscribe to events, event_format may be plain, json or xml."""
+        if not isinstance(events, six.string_types):
+            events = ' '.join(events)
+        return await self.send('event %s %s' % (event_format, events))
+
+    async def stop(self):
+        if self.connected:
+            try:
+                await self.send('exit')
+            except (NotConnectedError, OSError, OutboundSessionHasGoneAway):
+                pass
+        if self._writer is not None:
+            self._writer.close()
+        if self._receive_events_task:
+            logging.info("Waiting for receive task exit")
+            await self._receive_events_task
+        if self._process_events_task:
+            logging.info("Waiting for event processing task exit")
+            await self._process_events_task
+
+
+class AsyncInboundESL(AsyncESLProtocol):
+    def __init__(self, host, port, password, timeout=5, lazy_events=False,
+                 json_decoder=None, auto_subscribe=False):
+        super(AsyncInboundESL, self).__init__(lazy_events=lazy_events,
+                                              json_decoder=json_decoder)
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.auto_subscribe = auto_subscribe
+
+    async def connect(self):
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+        except asyncio.TimeoutError:
+            raise NotConnectedError('Connection timed out after %s seconds'
+                                    % self.timeout)
+        self.connected = True
+        self.start_event_handlers()
+        await self._auth_request_event.wait()
+        if not self.connected:
+            raise NotConnectedError('Server closed connection, check '
+                                    'FreeSWITCH config.')
+        await self.authenticate()
+        if self.auto_subscribe:
+            await asyncio.gather(*self._sync_subscriptions())
+
+    async def authenticate(self):
+        future = asyncio.get_event_loop().create_future()
+        self._writer.write(self.connection.auth(self.password, future))
+        await future
+        if not self.connection.authenticated:
+            raise ValueError('Invalid password.')
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+
+class AsyncOutboundSession(OutboundSessionMixin, AsyncESLProtocol):
+    _connection_lost_error = OutboundSessionHasGoneAway
+
+    def __init__(self, client_address, reader, writer, handshake=None):
+        super(AsyncOutboundSession, self).__init__()
+        self.client_address = client_address
+        self._reader = reader
+        self._writer = writer
+        self.connected = True
+        self.session_data = None
+        self.start_event_handlers()
+        self.register_handle('*', self.on_event)
+        self.register_handle('CHANNEL_HANGUP', self.on_hangup)
+        self.register_handle('DISCONNECT', self.on_disconnect)
+        self.expected_events = {}
+        self._outbound_connected = False
+        if handshake is not None:
+            self.handshake = tuple(handshake)
+
+    def _connection_lost(self):
+        self._outbound_connected = False
+        self._fail_waiters(OutboundSessionHasGoneAway)
+        super(AsyncOutboundSession, self)._connection_lost()
+
+    async def call_command(self, app_name, app_args=None, block=False,
+                           response_timeout=None):
+        """Execute a dialplan application in the channel.
+
+        With block=True it returns the CHANNEL_EXECUTE_COMPLETE event of the
+        application instead of the command reply.
+        """
+        # We're not allowed to send more commands.
+        # lingering True means we already received a hangup from the caller
+        # and any commands sent at this time to the session will fail
+        if self._lingering:
+            raise OutboundSessionHasGoneAway()
+
+        if not block:
+            return await self.send(self._execute_command(app_name, app_args))
+
+        future = await self.execute_async(app_name, app_args)
+        return await asyncio.wait_for(future, response_timeout)
+
+    async def execute_async(self, app_name, app_args=None):
+        """Execute app_name without waiting for it to complete.
+
+        Returns, once the command is accepted, a future set with the
+        CHANNEL_EXECUTE_COMPLETE event of this execution, matched by its
+        Application-UUID. Cancelling the future forgets the execution.
+        """
+        if self._lingering:
+            raise OutboundSessionHasGoneAway()
+
+        event_uuid = str(uuid.uuid4())
+        future = asyncio.get_event_loop().create_future()
+        self._expect_execute_complete(event_uuid, future)
+        future.add_done_callback(
+            lambda f: self._forget_execute_complete(event_uuid, f))
+        try:
+            await self.send(
+                self._execute_command(app_name, app_args, event_uuid))
+        except BaseException:
+            future.cancel()
+            raise
+        return future
+
+    async def connect(self):
+        if self._outbound_connected:
+            return self.session_data
+
+        try:
+            if self.handshake:
+                # One write and one round trip for the whole handshake.
+                replies = await asyncio.gather(
+                    *self.send_many(self._handshake_commands()))
+                resp = replies[0]
+            else:
+                resp = await self.send('connect')
+        except OutboundSessionHasGoneAway:
+            # cleanup before raising exception
+            await self.stop()
+            raise
+        self.session_data = resp.headers
+        self._outbound_connected = True
+
+    async def myevents(self):
+        if self._sent_in_handshake('myevents'):
+            return
+        await self.send('myevents')
+
+    async def answer(self):
+        resp = await self.call_command('answer')
+        return resp.data
+
+    async def park(self):
+        await self.call_command('park')
+
+    async def linger(self, timeout=None):
+        command = 'linger' if timeout is None else 'linger %s' % timeout
+        if self._sent_in_handshake(command):
+            return
+        await self.send(command)
+
+    async def playback(self, path, block=True):
+        event = await self.call_command('playback', path, block=block)
+        if block:
+            return event
+
+    async def play_and_get_digits(self, min_digits=None, max_digits=None,
+                                  max_attempts=None, timeout=None,
+                                  terminators=None, prompt_file=None,
+                                  error_file=None, variable=None,
+                                  digits_regex=None, digit_timeout=None,
+                                  transfer_on_fail=None, block=True,
+                                  response_timeout=30):
+        args = "%s %s %s %s %s %s %s %s %s %s %s" % (min_digits, max_digits,
+                                                     max_attempts, timeout,
+                                                     terminators, prompt_file,
+                                                     error_file, variable,
+                                                     digits_regex,
+                                                     digit_timeout,
+                                                     transfer_on_fail)
+        event = await self.call_command('play_and_get_digits', args,
+                                        block=block,
+                                        response_timeout=response_timeout)
+        if not block or not event:
+            return
+        return event.headers.get('variable_%s' % variable)
+
+    async def say(self, module_name='en', lang=None, say_type='NUMBER',
+                  say_method='pronounced', gender='FEMININE', text=None,
+                  block=True, response_timeout=30):
+        if lang:
+            module_name += ':%s' % lang
+
+        args = "%s %s %s %s %s" % (module_name, say_type, say_method, gender,
+                                   text)
+        event = await self.call_command('say', args, block=block,
+                                        response_timeout=response_timeout)
+        if block:
+            return event
+
+    async def bridge(self, args, block=True, response_timeout=None):
+        return await self.call_command("bridge", args, block=block,
+                                       response_timeout=response_timeout)
+
+    async def hangup(self, cause='NORMAL_CLEARING'):
+        await self.call_command('hangup', cause)
+
+    async def uuid_break(self):
+        if self._lingering:
+            raise OutboundSessionHasGoneAway
+        await self.send('api uuid_break %s' % self.uuid)
+
+
+class AsyncOutboundESLServer(object):
+    """asyncio version of OutboundESLServer.
+
+    application is instantiated with an AsyncOutboundSession for every call
+    and its ``run`` coroutine is awaited, every call runs in its own task.
+    """
+
+    # Seconds a rejected call gets to read our commands and close.
+    reject_timeout = 5
+    # Seconds between event loop lag samples, see max_loop_lag.
+    loop_lag_interval = 0.5
+
+    def __init__(self, bind_address='127.0.0.1', bind_port=8000,
+                 application=None, max_connections=100, handshake=None,
+                 reject_hangup_cause=None, max_pending_accepts=None,
+                 max_loop_lag=None, listen_all=False, backlog=100):
+        self.bind_address = bind_address
+        # See OutboundESLServer, asyncio already accepts every pending
+        # connection of a listener per wakeup.
+        self.listen_all = listen_all
+        self.backlog = backlog
+        # Commands pipelined with connect, e.g. ['myevents', 'linger'].
+        self.handshake = handshake
+        if not isinstance(bind_port, (list, tuple)):
+            bind_port = [bind_port]
+        if not bind_port:
+            raise ValueError('bind_port must be a string or list with port '
+                             'numbers')
+
+        self.bind_port = bind_port
+        self.max_connections = max_connections
+        self.connection_count = 0
+        # Admission control, see OutboundESLServer.
+        self.max_pending_accepts = max_pending_accepts
+        self.max_loop_lag = max_loop_lag
+        self.reject_hangup_cause = reject_hangup_cause
+        self.pending_accepts = 0
+        self.rejected = 0
+        self.loop_lag = 0.0
+        if not application:
+            raise ValueError('You need an Application to control your calls.')
+        self.application = application
+        self._tasks = set()
+        self._running = False
+        self._stop_event = None
+        self.server = None
+        self.servers = []
+        # Active calls of each listener, by its (address, port).
+        self.listener_connections = {}
+        logging.info('Starting AsyncOutboundESLServer at %s:%s' %
+                     (self.bind_address, self.bind_port))
+        self.bound_port = None
+
+    async def listen(self):
+        self._stop_event = asyncio.Event()
+        self.servers = await self._bind()
+        self.server = self.servers[0]
+        self.bound_port = self.server.sockets[0].getsockname()[1]
+        self._running = True
+        lag_watcher = None
+        if self.max_loop_lag is not None:
+            lag_watcher = asyncio.ensure_future(self._watch_loop_lag())
+
+        await self._stop_event.wait()
+
+        if lag_watcher is not None:
+            lag_watcher.cancel()
+        logging.info('Closing socket connection...')
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+
+        logging.info('Waiting for calls to be ended. Currently, there are '
+                     '%s active calls' % self.connection_count)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+        logging.info('AsyncOutboundESLServer stopped')
+
+    async def _bind(self):
+        """Return the listening servers, exits if none could be bound."""
+        addresses = self.bind_address
+        if not isinstance(addresses, (list, tuple)):
+            addresses = [addresses]
+        servers = []
+        for address in addresses:
+            for port in self.bind_port:
+                # Accepted sockets of a wildcard address have the concrete
+                # local address, so calls are counted by the listener key.
+                key = (address, port)
+                try:
+                    server = await asyncio.start_server(
+                        functools.partial(self._accept_call, listener=key),
+                        address, port, backlog=self.backlog)
+                except OSError:
+                    logging.info('Failed to bind to %s:%s, trying next in '
+                                 'range...' % (address, port))
+                    continue
+                logging.info('Successfully bound to %s:%s' % (address, port))
+                self.listener_connections[key] = 0
+                servers.append(server)
+                if not self.listen_all:
+                    return servers
+        if not servers:
+            logging.error('Could not bind server, no ports available.')
+            sys.exit()
+        return servers
+
+    async def _accept_call(self, reader, writer, listener=None):
+        reason = self._over_capacity()
+        if reason:
+            self.rejected += 1
+            logging.info('Rejecting call from %s, %s' %
+                         (writer.get_extra_info('peername'), reason))
+            await self._reject_call(reader, writer)
+            return
+
+        self.pending_accepts += 1
+        session = AsyncOutboundSession(writer.get_extra_info('peername'),
+                                       reader, writer,
+                                       handshake=self.handshake)
+        try:
+            await session.connect()
+        finally:
+            self.pending_accepts -= 1
+        await self._handle_call(session, listener)
+
+    def _over_capacity(self):
+        """Return why a new call must be rejected, None to accept it."""
+        if self.connection_count + self.pending_accepts >= self.max_connections:
+            return ('server is at full capacity, current connection count '
+                    'is %s/%s with %s pending' %
+                    (self.connection_count, self.max_connections,
+                     self.pending_accepts))
+        if (self.max_pending_accepts is not None and
+                self.pending_accepts >= self.max_pending_accepts):
+            return ('%s calls are pending their handshake' %
+                    self.pending_accepts)
+        if self.max_loop_lag is not None and self.loop_lag > self.max_loop_lag:
+            return 'event loop lags %.3f seconds' % self.loop_lag
+        return None
+
+    async def _reject_call(self, reader, writer):
+        """Reject a call on the raw stream, no session is started."""
+        writer.write(AsyncOutboundSession._reject_data(
+            self.reject_hangup_cause))
+        try:
+            # FreeSWITCH closes the socket after exit.
+            await asyncio.wait_for(reader.read(), self.reject_timeout)
+        except (asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def _watch_loop_lag(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.loop_lag_interval)
+            self.loop_lag = max(0.0, loop.time() - started -
+                                self.loop_lag_interval)
+
+    async def _handle_call(self, session, listener=None):
+        await session.connect()
+        app = self.application(session)
+        handler = asyncio.ensure_future(app.run())
+        self._tasks.add(handler)
+        self.connection_count += 1
+        if listener in self.listener_connections:
+            self.listener_connections[listener] += 1
+        logging.debug('Connection count %d' % self.connection_count)
+        try:
+            await handler
+        except Exception:
+            logging.exception('Application raised exception.')
+        finally:
+            if listener in self.listener_connections:
+                self.listener_connections[listener] -= 1
+            await self._handle_call_finish(handler, session)
+
+    async def _handle_call_finish(self, handler, session):
+        logging.info('Call from %s ended' % session.caller_id_number)
+        self._tasks.discard(handler)
+        self.connection_count -= 1
+        logging.debug('Connection count %d' % self.connection_count)
+        await session.stop()
+
+    def stop(self):
+        self._running = False
+        if self._stop_event is not None:
+            self._stop_event.set()
@@ -0,0 +1,1111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Sans-IO implementation of the FreeSWITCH Event Socket protocol.
+
+Nothing in this module touches sockets, greenlets or event loops, the
+transports in ``greenswitch.esl`` are thin drivers feeding bytes to
+``ESLConnection`` and acting on what it returns.
+"""
+
+from collections import deque
+import functools
+import inspect
+import logging
+import time
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from six.moves.urllib.parse import unquote
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
+
+
+# Kinds of messages returned by ESLConnection.next_event().
+NEED_DATA = 'NEED_DATA'
+CLOSED = 'CLOSED'
+AUTH_REQUEST = 'AUTH_REQUEST'
+REPLY = 'REPLY'
+EVENT = 'EVENT'
+DISCONNECT = 'DISCONNECT'
+RUDE_REJECTION = 'RUDE_REJECTION'
+
+
+class NotConnectedError(Exception):
+    pass
+
+
+class OutboundSessionHasGoneAway(Exception):
+    pass
+
+
+class CommandTimeoutError(Exception):
+    pass
+
+
+class _BackgroundJob(object):
+    """Pending reply token of a bgapi command."""
+
+    __slots__ = ('job_uuid',)
+
+    def __init__(self, job_uuid):
+        self.job_uuid = job_uuid
+
+
+def _split_event_names(names):
+    """Split the names of an event command into events and CUSTOM subclasses.
+
+    FreeSWITCH takes every name following CUSTOM as a subclass.
+    """
+    if 'CUSTOM' not in names:
+        return names, []
+    index = names.index('CUSTOM') + 1
+    return names[:index], names[index:]
+
+
+def _join_event_names(events, subclasses):
+    """Join event names and CUSTOM subclasses for an event command."""
+    names = sorted(set(events) - {'CUSTOM'})
+    if subclasses or 'CUSTOM' in events:
+        # Every name after CUSTOM is taken as a subclass.
+        names.append('CUSTOM')
+        names.extend(sorted(subclasses))
+    return ' '.join(names)
+
+
+def _split_event_body(body):
+    """Split a text/event-plain payload into its headers and its own body.
+
+    Events carrying a body, like BACKGROUND_JOB, end their headers with a
+    Content-Length header followed by a blank line.
+    """
+    index = body.find(b'\n\n')
+    if index < 0:
+        return body, None
+    line_start = body.rfind(b'\n', 0, index) + 1
+    if not body.startswith(b'Content-Length: ', line_start):
+        return body, None
+    return body[:index + 1], body[index + 2:]
+
+
+class ESLEvent(object):
+    def __init__(self, data):
+        self.headers = {}
+        self.parse_data(data)
+
+    def parse_data(self, data):
+        _parse_headers(data, self.headers)
+
+
+def _parse_headers(data, headers):
+    data = unquote(data)
+    data = data.strip().splitlines()
+    last_key = None
+    value = ''
+    for line in data:
+        if ': ' in line:
+            key, value = line.split(': ', 1)
+            last_key = key
+        else:
+            key = last_key
+            value += '\n' + line
+        headers[key.strip()] = value.strip()
+
+
+class LazyHeaders(MutableMapping):
+    """Headers mapping decoded on demand from a raw event body.
+
+    Looking up a single header searches the raw bytes for its line and only
+    URL-decodes that value. The full dict is only built when the headers
+    are iterated, counted or modified. Headers from the body take
+    precedence over the envelope ones, as in ``ESLEvent.parse_data``.
+    """
+
+    __slots__ = ('_raw', '_envelope', '_cache', '_headers')
+
+    def __init__(self, raw, envelope=None):
+        self._raw = b'\n' + raw
+        self._envelope = envelope or {}
+        self._cache = {}
+        self._headers = None
+
+    def _lookup(self, key):
+        raw = self._raw
+        needle = ('\n%s: ' % key).encode('utf-8')
+        # Last occurrence wins, like overwriting a dict key when parsing.
+        start = raw.rfind(needle)
+        if start < 0:
+            return None
+        start += len(needle)
+        end = raw.find(b'\n', start)
+        # Lines without a "key: value" pair continue the previous value.
+        while end >= 0:
+            next_end = raw.find(b'\n', end + 1)
+            line_end = len(raw) if next_end < 0 else next_end
+            if raw.find(b': ', end + 1, line_end) >= 0:
+                break
+            end = next_end
+        value = raw[start:] if end < 0 else raw[start:end]
+        return unquote(value.decode('utf-8')).strip()
+
+    def _materialize(self):
+        if self._headers is None:
+            headers = dict(self._envelope)
+            _parse_headers(self._raw.decode('utf-8'), headers)
+            self._headers = headers
+            self._raw = self._envelope = self._cache = None
+        return self._headers
+
+    def __getitem__(self, key):
+        if self._headers is not None:
+            return self._headers[key]
+        if key in self._cache:
+            return self._cache[key]
+        value = self._lookup(key)
+        if value is None:
+            value = self._envelope[key]
+        self._cache[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._materialize()[key] = value
+
+    def __delitem__(self, key):
+        del self._materialize()[key]
+
+    def __iter__(self):
+        return iter(self._materialize())
+
+    def __len__(self):
+        return len(self._materialize())
+
+    def __repr__(self):
+        return repr(self._materialize())
+
+
+class LazyESLEvent(object):
+    """ESLEvent keeping its raw body and decoding headers on demand.
+
+    It offers the same ``headers`` API as ``ESLEvent`` while avoiding to
+    allocate strings for the headers nobody reads.
+    """
+
+    __slots__ = ('headers', 'data')
+
+    def __init__(self, raw, envelope=None):
+        self.headers = LazyHeaders(raw, envelope)
+        self.data = None
+
+    def parse_data(self, data):
+        _parse_headers(data, self.headers)
+
+
+
+class ESLConnection(object):
+    """Event Socket protocol state machine.
+
+    Received bytes are given to ``receive_data`` (or written straight into
+    ``get_buffer()`` followed by ``buffer_updated``) and parsed messages are
+    then taken from ``next_event``, which returns a ``(kind, event, token)``
+    tuple. Commands are turned into bytes by ``send``, the token given
+    there is returned along with the matching reply, so callers can attach
+    whatever they wait on to it.
+    """
+
+    EOL = '\n'
+
+    def __init__(self, lazy_events=False, json_decoder=None,
+                 buffer_size=65536):
+        self.lazy_events = lazy_events
+        # Any callable taking bytes and returning a dict, the fastest JSON
+        # library installed is used by default.
+        self.json_decoder = json_decoder or json_loads
+        self.pending = deque()
+        # Monotonic time each pending command was sent, in the same order.
+        self._pending_since = deque()
+        # Job-UUID -> token of the bgapi commands waiting for their
+        # BACKGROUND_JOB event.
+        self.background_jobs = {}
+        self.event_format = 'plain'
+        self.subscribed_events = set()
+        self.subscribed_subclasses = set()
+        # (header, value) of the event filters added, in order.
+        self.filters = []
+        # Last myevents command sent, if any.
+        self.myevents = None
+        # Names (or CUSTOM subclasses) of the text/event-plain events to
+        # parse, the others are dropped unparsed. None parses every event.
+        self.wanted_events = None
+        self.skipped_events = 0
+        self.connected = False
+        self.lingering = False
+        self.auth_requested = False
+        self.authenticated = False
+        self.closed = False
+        self._auth_token = None
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._scan_offset = 0
+        self._envelope = None
+        self._length = 0
+
+    @property
+    def buffered(self):
+        """Number of received bytes not parsed yet."""
+        return self._end - self._start
+
+    @property
+    def pending_count(self):
+        """Number of commands waiting for their reply."""
+        return len(self.pending)
+
+    def pending_age(self, now=None):
+        """Seconds the oldest command has been waiting for its reply."""
+        if not self._pending_since:
+            return 0
+        if now is None:
+            now = time.monotonic()
+        return now - self._pending_since[0]
+
+    def pending_tokens(self):
+        """Return the tokens given by callers of the pending commands.
+
+        Commands sent without a token and the internal tokens of bgapi
+        commands are left out.
+        """
+        return [token for token in self.pending
+                if token is not None and token.__class__ is not _BackgroundJob]
+
+    def clear_pending(self):
+        """Forget every pending command, returns their caller tokens."""
+        tokens = self.pending_tokens()
+        self.pending.clear()
+        self._pending_since.clear()
+        return tokens
+
+    def reset(self):
+        """Forget the state of the last transport to start over in a new one.
+
+        Subscriptions, filters and myevents are kept so they can be sent
+        again with ``replay_commands``. Returns the tokens of the commands
+        and background jobs that will never be answered.
+        """
+        tokens = [token for token in self.clear_pending()
+                  if token is not self._auth_token]
+        tokens.extend(self.background_jobs.values())
+        self.background_jobs.clear()
+        self.connected = False
+        self.lingering = False
+        self.auth_requested = False
+        self.authenticated = False
+        self.closed = False
+        self._auth_token = None
+        self._start = self._end = self._scan_offset = 0
+        self._envelope = None
+        self._length = 0
+        return tokens
+
+    def replay_commands(self):
+        """Return the commands restoring the subscriptions and filters."""
+        commands = []
+        if self.myevents is not None:
+            commands.append(self.myevents)
+        events = _join_event_names(self.subscribed_events,
+                                   self.subscribed_subclasses)
+        if events:
+            commands.append('event %s %s' % (self.event_format, events))
+        for header, value in self.filters:
+            commands.append('filter %s %s' % (header, value))
+        return commands
+
+    def subscription_commands(self, events, subclasses=(), filters=()):
+        """Return the commands changing the subscriptions to the given ones.
+
+        Only the differences with what was sent before are returned, no
+        nixevent is sent while ALL is wanted. BACKGROUND_JOB is kept subscribed for bgapi, and allowed by the
+        filters, once it was subscribed.
+        """
+        events = set(events)
+        subclasses = set(subclasses)
+        if 'BACKGROUND_JOB' in self.subscribed_events:
+            events.add('BACKGROUND_JOB')
+        if subclasses:
+            events.add('CUSTOM')
+        filters = list(filters)
+        if filters and 'BACKGROUND_JOB' in events:
+            filters.append(('Event-Name', 'BACKGROUND_JOB'))
+
+        commands = []
+        removed_events = self.subscribed_events - events
+        removed_subclasses = self.subscribed_subclasses - subclasses
+        if 'ALL' in removed_events:
+            commands.append('noevents')
+            added_events, added_subclasses = events, subclasses
+            removed_events = removed_subclasses = ()
+        else:
+            added_events = events - self.subscribed_events
+            added_subclasses = subclasses - self.subscribed_subclasses
+        names = _join_event_names(added_events, added_subclasses)
+        if names:
+            commands.append('event %s %s' % (self.event_format, names))
+        if 'ALL' in events:
+            # nixevent under ALL clears ALL and excludes the events named,
+            # they keep coming with ALL so only forget them.
+            self.subscribed_events.difference_update(removed_events)
+            self.subscribed_subclasses.difference_update(removed_subclasses)
+            removed_events = removed_subclasses = ()
+        names = _join_event_names(removed_events, removed_subclasses)
+        if names:
+            commands.append('nixevent %s' % names)
+
+        # New filters go first so no wanted event is dropped meanwhile.
+        for header, value in filters:
+            if (header, value) not in self.filters:
+                commands.append('filter %s %s' % (header, value))
+        for header, value in self.filters:
+            if (header, value) not in filters:
+                commands.append('filter delete %s %s' % (header, value))
+        return commands
+
+    def get_buffer(self, sizehint=-1):
+        """Return a writable memoryview for the transport to receive into.
+
+        The buffer is compacted or grown so at least sizehint (or a quarter
+        of the buffer) bytes are free.
+        """
+        if self._start == self._end:
+            self._start = self._end = 0
+        needed = max(sizehint, len(self._buffer) // 4)
+        if len(self._buffer) - self._end < needed:
+            size = self._end - self._start
+            if size + needed <= len(self._buffer):
+                self._buffer[:size] = self._buffer[self._start:self._end]
+            else:
+                buffer = bytearray(max(len(self._buffer) * 2, size + needed))
+                buffer[:size] = self._view[self._start:self._end]
+                self._buffer = buffer
+                self._view = memoryview(buffer)
+            self._start, self._end = 0, size
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        """Account for nbytes written into the last ``get_buffer()``."""
+        self._end += nbytes
+
+    def receive_data(self, data):
+        """Feed bytes received from the transport, empty data means EOF."""
+        if not data:
+            self.closed = True
+            return
+        size = len(data)
+        self.get_buffer(size)[:size] = data
+        self._end += size
+
+    def _read_headers(self):
+        # Skip stray blank lines between frames.
+        while self._start < self._end and self._buffer[self._start] == 10:
+            self._start += 1
+        index = self._buffer.find(b'\n\n', self._start + self._scan_offset,
+                                  self._end)
+        if index < 0:
+            # Rescan the last byte, it may be the first half of the separator.
+            self._scan_offset = max(self._end - self._start - 1, 0)
+            return None
+        headers = str(self._view[self._start:index + 1], 'utf-8')
+        self._start = index + 2
+        self._scan_offset = 0
+        return headers
+
+    def next_event(self):
+        """Parse the next complete message from the buffered data.
+
+        Returns ``(NEED_DATA, None, None)`` when more bytes are needed and
+        ``(CLOSED, None, None)`` once EOF was received and no complete
+        message is left.
+        """
+        while True:
+            if self._envelope is None:
+                headers = self._read_headers()
+                if headers is None:
+                    return (CLOSED if self.closed else NEED_DATA), None, None
+                self._envelope = ESLEvent(headers)
+                self._length = int(
+                    self._envelope.headers.get('Content-Length') or 0)
+            if self._end - self._start < self._length:
+                return (CLOSED if self.closed else NEED_DATA), None, None
+            event = self._envelope
+            start = self._start
+            self._start += self._length
+            self._envelope = None
+            if (self.wanted_events is not None and
+                    event.headers.get('Content-Type') == 'text/event-plain' and
+                    not self._is_wanted(start, self._start)):
+                self.skipped_events += 1
+                continue
+            body = bytes(self._view[start:self._start])
+            return self._handle_frame(event, body)
+
+    def _peek_header(self, key, start, end):
+        """Return the value of header key from the buffer without a copy."""
+        buffer = self._buffer
+        if buffer.startswith(key, start, end):
+            index = start + len(key)
+        else:
+            index = buffer.find(b'\n' + key, start, end)
+            if index < 0:
+                return None
+            index += len(key) + 1
+        line_end = buffer.find(b'\n', index, end)
+        value = bytes(self._view[index:end if line_end < 0 else line_end])
+        if b'%' in value:
+            return unquote(value.decode('utf-8'))
+        return value.decode('utf-8')
+
+    def _is_wanted(self, start, end):
+        """Whether the event-plain body in the buffer must be parsed."""
+        name = self._peek_header(b'Event-Name: ', start, end)
+        if name == 'CUSTOM':
+            name = self._peek_header(b'Event-Subclass: ', start, end)
+        elif name == 'BACKGROUND_JOB' and self.background_jobs:
+            return True
+        return name is None or name in self.wanted_events
+
+    def _pop_pending(self, event):
+        token = self.pending.popleft() if self.pending else None
+        if self._pending_since:
+            self._pending_since.popleft()
+        if token.__class__ is _BackgroundJob:
+            # The job token is only resolved here if FreeSWITCH refused to
+            # start it, otherwise it waits for the BACKGROUND_JOB event.
+            if event.headers.get('Reply-Text', '').startswith('-ERR'):
+                return self.background_jobs.pop(token.job_uuid, None)
+            return None
+        if token is not None and token is self._auth_token:
+            self._auth_token = None
+            self.authenticated = \
+                event.headers.get('Reply-Text') == '+OK accepted'
+        return token
+
+    def _handle_frame(self, event, body):
+        content_type = event.headers.get('Content-Type')
+        if content_type == 'auth/request':
+            self.auth_requested = True
+            return AUTH_REQUEST, event, None
+        elif content_type == 'command/reply':
+            event.data = event.headers['Reply-Text']
+            return REPLY, event, self._pop_pending(event)
+        elif content_type == 'api/response':
+            event.data = body.decode('utf-8')
+            return REPLY, event, self._pop_pending(event)
+        elif content_type == 'text/disconnect-notice':
+            if event.headers.get('Content-Disposition') == 'linger':
+                self.lingering = True
+            else:
+                self.connected = False
+            event.data = body.decode('utf-8')
+            return DISCONNECT, event, None
+        elif content_type == 'text/rude-rejection':
+            self.connected = False
+            event.data = body.decode('utf-8')
+            return RUDE_REJECTION, event, None
+        elif content_type == 'text/event-json':
+            event.headers.update(self.json_decoder(body))
+            event.data = event.headers.get('_body')
+        elif content_type == 'text/event-plain':
+            body, event_body = _split_event_body(body)
+            if self.lazy_events:
+                event = LazyESLEvent(body, event.headers)
+            else:
+                event.parse_data(body.decode('utf-8'))
+            if event_body is not None:
+                event.data = event_body.decode('utf-8')
+        elif content_type == 'log/data':
+            event.data = body.decode('utf-8')
+        else:
+            event.parse_data(body.decode('utf-8'))
+
+        token = None
+        if (self.background_jobs and
+                event.headers.get('Event-Name') == 'BACKGROUND_JOB'):
+            token = self.background_jobs.pop(event.headers.get('Job-UUID'),
+                                             None)
+        return EVENT, event, token
+
+    def send(self, data, token=None):
+        """Return the bytes to write for a command.
+
+        token is queued and returned by ``next_event`` with the command
+        reply, replies always come in the same order commands were sent.
+        """
+        if not self.connected:
+            raise NotConnectedError()
+        self._track_command(data)
+        self.pending.append(token)
+        self._pending_since.append(time.monotonic())
+        return (data + self.EOL * 2).encode('utf-8')
+
+    def send_many(self, commands, tokens=None):
+        """Return the bytes to write a batch of commands at once.
+
+        tokens, if given, must have one token for each command.
+        """
+        if not self.connected:
+            raise NotConnectedError()
+        if tokens is None:
+            tokens = [None] * len(commands)
+        elif len(tokens) != len(commands):
+            raise ValueError('One token is needed for each command.')
+        for command in commands:
+            self._track_command(command)
+        self.pending.extend(tokens)
+        self._pending_since.extend([time.monotonic()] * len(tokens))
+        eol = self.EOL * 2
+        return ''.join([command + eol for command in commands]).encode('utf-8')
+
+    def _track_command(self, data):
+        """Keep track of the events and filters set by the commands sent."""
+        if data.startswith('event '):
+            parts = data.split()
+            if len(parts) > 1:
+                self.event_format = parts[1]
+            events, subclasses = _split_event_names(parts[2:])
+            self.subscribed_events.update(events)
+            self.subscribed_subclasses.update(subclasses)
+        elif data.startswith('nixevent '):
+            events, subclasses = _split_event_names(data.split()[1:])
+            self.subscribed_events.difference_update(events)
+            self.subscribed_subclasses.difference_update(subclasses)
+        elif data == 'noevents':
+            self.subscribed_events.clear()
+            self.subscribed_subclasses.clear()
+        elif data.startswith('filter delete '):
+            parts = data.split(None, 3)
+            if len(parts) < 3:
+                return
+            if parts[2] == 'all':
+                del self.filters[:]
+                return
+            self.filters = [
+                (header, value) for header, value in self.filters
+                if header != parts[2] or (len(parts) > 3 and value != parts[3])]
+        elif data.startswith('filter '):
+            parts = data.split(None, 2)
+            if len(parts) == 3 and tuple(parts[1:]) not in self.filters:
+                self.filters.append(tuple(parts[1:]))
+        elif data.startswith('myevents'):
+            self.myevents = data
+
+    def bgapi(self, command, job_uuid, token=None):
+        """Return the bytes to run an api command in background.
+
+        token is returned by ``next_event`` along with the BACKGROUND_JOB
+        event of job_uuid, or with the command reply if FreeSWITCH refuses
+        to run it. BACKGROUND_JOB is subscribed, and allowed by the event
+        filters, in the same write if needed.
+        """
+        commands = []
+        if not self.subscribed_events & {'ALL', 'BACKGROUND_JOB'}:
+            commands.append('event %s BACKGROUND_JOB' % self.event_format)
+        if self.filters and \
+                ('Event-Name', 'BACKGROUND_JOB') not in self.filters:
+            commands.append('filter Event-Name BACKGROUND_JOB')
+        commands.append('bgapi %s\nJob-UUID: %s' % (command, job_uuid))
+        tokens = [None] * (len(commands) - 1) + [_BackgroundJob(job_uuid)]
+        data = self.send_many(commands, tokens)
+        self.background_jobs[job_uuid] = token
+        return data
+
+    def cancel_background_job(self, job_uuid):
+        """Forget a background job, returns its token if it was pending."""
+        return self.background_jobs.pop(job_uuid, None)
+
+    def auth(self, password, token=None):
+        """Return the bytes to authenticate, ``authenticated`` is updated
+        when the reply is received."""
+        if token is None:
+            token = object()
+        data = self.send('auth %s' % password, token)
+        self._auth_token = token
+        return data
+
+
+class EventHandlersMixin(object):
+    """Registry of event handlers shared by every transport.
+
+    Classes using it must set ``event_handlers`` and ``handler_filters``
+    to dicts and, for ``auto_subscribe``, have ``connection``,
+    ``connected`` and a ``send_many`` method. Dispatch is compiled once,
+    updated as handlers are registered and unregistered, and compiled
+    again when ``before_handle`` or ``after_handle`` change.
+    """
+
+    # Keep the server side subscriptions and filters in sync with the
+    # registered handlers.
+    auto_subscribe = False
+
+    # Handler names which are not FreeSWITCH events.
+    _pseudo_events = frozenset(['DISCONNECT', 'RECONNECT', 'log'])
+
+    # Built on the first event after handlers change, see _build_dispatch.
+    _dispatch_table = None
+    _dispatch_fallback = None
+    _dispatch_hooks = (None, None)
+    _before_handle = None
+    _after_handle = None
+
+    _skip_unhandled_events = False
+
+    @property
+    def before_handle(self):
+        """Called with every event before its handlers."""
+        return self._before_handle
+
+    @before_handle.setter
+    def before_handle(self, handler):
+        self._before_handle = handler
+        self._dispatch_table = None
+
+    @property
+    def after_handle(self):
+        """Called with every event after its handlers."""
+        return self._after_handle
+
+    @after_handle.setter
+    def after_handle(self, handler):
+        self._after_handle = handler
+        self._dispatch_table = None
+
+    @property
+    def skip_unhandled_events(self):
+        """Drop plain events without handlers before parsing them."""
+        return self._skip_unhandled_events
+
+    @skip_unhandled_events.setter
+    def skip_unhandled_events(self, value):
+        self._skip_unhandled_events = value
+        self._update_wanted_events()
+
+    def _update_wanted_events(self):
+        if self._skip_unhandled_events:
+            self.connection.wanted_events = self._handled_event_names()
+        else:
+            self.connection.wanted_events = None
+
+    def _handled_event_names(self):
+        """Return the names with handlers, None if every event is handled."""
+        if '*' in self.event_handlers:
+            return None
+        return frozenset(self.event_handlers)
+
+    def register_handle(self, name, handler, filters=None):
+        """Call handler with the events called name.
+
+        CUSTOM events are named by their subclass, like sofia::register.
+        filters is a dict of header values the events must have, with
+        ``auto_subscribe`` they are also sent to FreeSWITCH as event
+        filters.
+        """
+        if name not in self.event_handlers:
+            self.event_handlers[name] = []
+        if self._is_registered(name, handler):
+            return
+        self.event_handlers[name].append(handler)
+        if filters:
+            self.handler_filters[(name, handler)] = dict(filters)
+        if self._dispatch_table is not None:
+            self._add_to_dispatch(self._dispatch_table, name, handler)
+        if self._skip_unhandled_events:
+            self._update_wanted_events()
+        if self.auto_subscribe and self.connected:
+            self._sync_subscriptions()
+
+    def unregister_handle(self, name, handler):
+        if name not in self.event_handlers:
+            raise ValueError('No handlers found for event: %s' % name)
+        self.event_handlers[name].remove(handler)
+        filters = self.handler_filters.pop((name, handler), None)
+        if not self.event_handlers[name]:
+            del self.event_handlers[name]
+        if self._dispatch_table is not None:
+            self._remove_from_dispatch(name, handler, filters)
+        if self._skip_unhandled_events:
+            self._update_wanted_events()
+        if self.auto_subscribe and self.connected:
+            self._sync_subscriptions()
+
+    def _is_registered(self, name, handler):
+        # Per-call handlers have filters, only the handlers without them
+        # are scanned.
+        if (name, handler) in self.handler_filters:
+            return True
+        if self._dispatch_table is None:
+            return handler in self.event_handlers[name]
+        entry = self._dispatch_table.get(name)
+        return entry is not None and handler in entry[0]
+
+    def _wanted_subscriptions(self):
+        """Return the events, subclasses and filters the handlers need."""
+        events = set()
+        subclasses = set()
+        filters = []
+        unfiltered = []
+        for name, handlers in self.event_handlers.items():
+            if name in self._pseudo_events:
+                continue
+            if name == '*':
+                events.add('ALL')
+            elif '::' in name:
+                subclasses.add(name)
+            else:
+                events.add(name)
+            for handler in handlers:
+                handler_filters = self.handler_filters.get((name, handler))
+                if handler_filters is None:
+                    unfiltered.append(name)
+                    continue
+                for header_value in handler_filters.items():
+                    if header_value not in filters:
+                        filters.append(header_value)
+        # Server filters let an event pass if it matches any of them, so
+        # events of handlers without filters must be let through too.
+        if filters:
+            if '*' in unfiltered:
+                filters = []
+            else:
+                for name in unfiltered:
+                    header = 'Event-Subclass' if '::' in name else 'Event-Name'
+                    if (header, name) not in filters:
+                        filters.append((header, name))
+        return events, subclasses, filters
+
+    def _sync_subscriptions(self):
+        """Send the commands matching the subscriptions to the handlers."""
+        commands = self.connection.subscription_commands(
+            *self._wanted_subscriptions())
+        if not commands:
+            return []
+        return self.send_many(commands)
+
+    def _build_dispatch(self):
+        """Compile the handlers into a table looked up once per event.
+
+        Each name maps to its handlers without filters and an index of
+        the filtered ones by the value of their first filter header, so
+        many per-call handlers cost a dict lookup instead of a scan.
+        register_handle and unregister_handle update the table in place.
+        """
+        table = {}
+        for name, handlers in self.event_handlers.items():
+            for handler in handlers:
+                self._add_to_dispatch(table, name, handler)
+        self._dispatch_table = table
+        self._dispatch_fallback = table.get('*')
+        self._dispatch_hooks = (self.before_handle, self.after_handle)
+        return table
+
+    def _add_to_dispatch(self, table, name, handler):
+        entry = table.get(name)
+        if entry is None:
+            entry = table[name] = ([], {})
+        unfiltered, index = entry
+        filters = self.handler_filters.get((name, handler))
+        if filters is None:
+            # Lists given to _get_handlers callers are never changed.
+            table[name] = (unfiltered + [handler], index)
+        else:
+            filters = list(filters.items())
+            header, value = filters[0]
+            index.setdefault(header, {}).setdefault(value, []).append(
+                (handler, filters[1:]))
+        if name == '*':
+            self._dispatch_fallback = table[name]
+
+    def _remove_from_dispatch(self, name, handler, filters):
+        table = self._dispatch_table
+        entry = table.get(name)
+        if entry is None:
+            return
+        unfiltered, index = entry
+        if filters is None:
+            unfiltered = [h for h in unfiltered if h != handler]
+            table[name] = entry = (unfiltered, index)
+        else:
+            header, value = next(iter(filters.items()))
+            handlers_by_value = index.get(header, {})
+            matches = [match for match in handlers_by_value.get(value, ())
+                       if match[0] != handler]
+            if matches:
+                handlers_by_value[value] = matches
+            else:
+                handlers_by_value.pop(value, None)
+                if not handlers_by_value:
+                    index.pop(header, None)
+        if not unfiltered and not index:
+            del table[name]
+            entry = None
+        if name == '*':
+            self._dispatch_fallback = entry
+
+    def _get_handlers(self, event):
+        """Return the handlers an event must be dispatched to."""
+        table = self._dispatch_table
+        if table is None:
+            table = self._build_dispatch()
+        headers = event.headers
+        name = headers.get('Event-Name')
+        if name == 'CUSTOM':
+            name = headers.get('Event-Subclass')
+        elif name is None:
+            content_type = headers.get('Content-Type')
+            if content_type == 'text/disconnect-notice':
+                name = 'DISCONNECT'
+            elif content_type == 'log/data':
+                name = 'log'
+        entry = table.get(name)
+        if entry is None:
+            entry = self._dispatch_fallback
+            if entry is None:
+                return None
+
+        handlers, index = entry
+        if not index:
+            return handlers
+        handlers = list(handlers)
+        for header, handlers_by_value in index.items():
+            matches = handlers_by_value.get(headers.get(header))
+            if not matches:
+                continue
+            for handler, filters in matches:
+                for header_, value in filters:
+                    if headers.get(header_) != value:
+                        break
+                else:
+                    handlers.append(handler)
+        return handlers
+
+
+class OutboundSessionMixin(object):
+    """Transport independent part of an outbound socket session.
+
+    Classes using it must set ``connection``, ``session_data``,
+    ``expected_events`` and ``_outbound_connected``. Waiters only need ``set_result``,
+    ``set_exception`` and ``done``, so both gevent's AsyncResult and
+    asyncio futures can be used.
+    """
+
+    # Commands pipelined with connect, in the same write, see connect().
+    handshake = ()
+
+    @property
+    def uuid(self):
+        return self.session_data.get('variable_uuid')
+
+    @property
+    def call_uuid(self):
+        return self.session_data.get('variable_call_uuid')
+
+    @property
+    def caller_id_number(self):
+        return self.session_data.get('Caller-Caller-ID-Number')
+
+    def on_disconnect(self, event):
+        if self._lingering:
+            logging.debug('Socket lingering..')
+        elif not self.connected:
+            logging.debug('Socket closed: %s' % event.headers)
+        logging.debug('Raising OutboundSessionHasGoneAway for all pending'
+                      'results')
+        self._outbound_connected = False
+        self._fail_waiters(OutboundSessionHasGoneAway)
+
+    def _fail_waiters(self, exception_class):
+        """Raise exception_class on every pending command and event."""
+        for by_header in self.expected_events.values():
+            for by_value in by_header.values():
+                for waiters in by_value.values():
+                    for async_result in waiters:
+                        if not async_result.done():
+                            async_result.set_exception(exception_class())
+        self.expected_events.clear()
+
+        for cmd in self.connection.pending_tokens():
+            if not cmd.done():
+                cmd.set_exception(exception_class())
+
+    def _handshake_commands(self):
+        return ['connect'] + list(self.handshake)
+
+    def _sent_in_handshake(self, command):
+        """Whether command was already sent by the connect handshake."""
+        return self._outbound_connected and command in self.handshake
+
+    def on_hangup(self, event):
+        self._outbound_connected = False
+        logging.info('Caller %s has gone away.' % self.caller_id_number)
+
+    def on_event(self, event):
+        by_header = self.expected_events.get(event.headers.get('Event-Name'))
+        if not by_header:
+            return
+
+        for header, by_value in list(by_header.items()):
+            value = event.headers.get(header)
+            if value is None:
+                continue
+            waiters = by_value.pop(value, None)
+            if waiters is None:
+                continue
+            if not by_value:
+                del by_header[header]
+            for async_response in waiters:
+                if not async_response.done():
+                    async_response.set_result(event)
+        if not by_header:
+            del self.expected_events[event.headers.get('Event-Name')]
+
+    def register_expected_event(self, expected_event, expected_variable,
+                                expected_value, async_response):
+        """Set async_response with the next expected_event whose
+        ``variable_<expected_variable>`` header is expected_value.
+
+        Waiters are indexed by event name, header and value. Callers
+        giving up waiting must call ``unregister_expected_event``.
+        """
+        self._register_waiter(expected_event,
+                              'variable_%s' % expected_variable,
+                              expected_value, async_response)
+
+    def unregister_expected_event(self, expected_event, expected_variable,
+                                  expected_value, async_response):
+        """Forget a waiter, nothing happens if it was already resolved."""
+        self._unregister_waiter(expected_event,
+                                'variable_%s' % expected_variable,
+                                expected_value, async_response)
+
+    def _register_waiter(self, event_name, header, value, async_response):
+        by_header = self.expected_events.setdefault(event_name, {})
+        by_value = by_header.setdefault(header, {})
+        by_value.setdefault(value, []).append(async_response)
+
+    def _unregister_waiter(self, event_name, header, value, async_response):
+        by_header = self.expected_events.get(event_name)
+        if not by_header:
+            return
+        by_value = by_header.get(header)
+        if not by_value:
+            return
+        waiters = by_value.get(value)
+        if not waiters or async_response not in waiters:
+            return
+        waiters.remove(async_response)
+        if not waiters:
+            del by_value[value]
+            if not by_value:
+                del by_header[header]
+                if not by_header:
+                    del self.expected_events[event_name]
+
+    def _expect_execute_complete(self, event_uuid, async_response):
+        """Set async_response with the CHANNEL_EXECUTE_COMPLETE event of the
+        application executed with event_uuid."""
+        self._register_waiter('CHANNEL_EXECUTE_COMPLETE', 'Application-UUID',
+                              event_uuid, async_response)
+
+    def _forget_execute_complete(self, event_uuid, async_response):
+        self._unregister_waiter('CHANNEL_EXECUTE_COMPLETE',
+                                'Application-UUID', event_uuid,
+                                async_response)
+
+    @classmethod
+    def _reject_data(cls, hangup_cause=None):
+        """Return the bytes rejecting a call without starting a session.
+
+        The channel is hung up with hangup_cause, if given, before exit
+        hands it back to the dialplan.
+        """
+        commands = ['connect']
+        if hangup_cause:
+            commands.append(cls._execute_command('hangup', hangup_cause))
+        commands.append('exit')
+        return ''.join('%s\n\n' % command
+                       for command in commands).encode('utf-8')
+
+    @staticmethod
+    def _execute_command(app_name, app_args=None, event_uuid=None):
+        """Return the sendmsg command executing app_name in the channel.
+
+        FreeSWITCH copies event_uuid to the Application-UUID header of the
+        CHANNEL_EXECUTE and CHANNEL_EXECUTE_COMPLETE events of this
+        execution.
+        """
+        command = "sendmsg\n" \
+                  "call-command: execute\n" \
+                  "execute-app-name: %s" % app_name
+        if app_args:
+            command += "\nexecute-app-arg: %s" % app_args
+        if event_uuid:
+            command += "\nEvent-UUID: %s" % event_uuid
+        return command
+
+    def raise_if_disconnected(self):
+        """This function will raise the exception
+        esl.OutboundSessionHasGoneAway if the caller hung up the call
+        """
+        if not self._outbound_connected:
+            raise OutboundSessionHasGoneAway
+
+    def while_connected(self):
+        """Returns an object that check if the session is connected in
+        the __enter__ and __exit__ steps, if disconnected will
+        raise greenswitch.esl.OutboundSessionHasGoneAway exception.
+
+        This method can be used as a context manager or decorator, also
+        for coroutine functions.
+
+        Examples:
+        >>> with outbound_session.while_connected():
+        >>>    do_something()
+        >>>
+        >>> @outbound_session.while_connected()
+        >>> def do_something():
+        >>>     ...
+        """
+        class _while_connected(object):
+            def __init__(self, outbound_session):
+                self.outbound_session = outbound_session
+
+            def __enter__(self):
+                self.outbound_session.raise_if_disconnected()
+                return self
+
+            def __exit__(self, exit_type, exit_value, exit_traceback):
+                self.outbound_session.raise_if_disconnected()
+
+            def __call__(self, func):
+                if inspect.iscoroutinefunction(func):
+                    @functools.wraps(func)
+                    async def coroutine_decorator(*args, **kwargs):
+                        with self:
+                            return await func(*args, **kwargs)
+
+                    return coroutine_decorator
+
+                @functools.wraps(func)
+                def decorator(*args, **kwargs):
+                    with self:
+                        return func(*args, **kwargs)
+
+                return decorator
+
+        return _while_connected(self)
@@ -1,163 +1,558 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import errno
-import functools
+import array
+from collections import deque
 import logging
+import multiprocessing
+import os
 import pprint
+import random
+import signal
+import struct
 import sys
+import time
+import uuid
 
 import gevent
+import gevent.os
 import gevent.socket as socket
 from gevent.event import Event
+from gevent.lock import BoundedSemaphore, Semaphore
+from gevent.pool import Pool
 from gevent.queue import Queue
-from six.moves.urllib.parse import unquote
+import six
 
+from .connection import (
+    AUTH_REQUEST, CLOSED, DISCONNECT, NEED_DATA, REPLY, RUDE_REJECTION,
+    CommandTimeoutError, ESLConnection, ESLEvent, EventHandlersMixin, LazyESLEvent,
+    NotConnectedError, OutboundSessionHasGoneAway, OutboundSessionMixin)
 
-class NotConnectedError(Exception):
-    pass
 
+class KeyedPool(object):
+    """Run event handlers on a bounded pool of greenlets.
 
-class OutboundSessionHasGoneAway(Exception):
-    pass
+    Events with the same value of the key header, by default the call
+    Unique-ID, are handled one at a time in the order they arrived, while
+    events of different calls are handled concurrently. spawn blocks when
+    size greenlets are busy or max_pending events are waiting.
+    """
 
+    def __init__(self, size=10, key='Unique-ID', max_pending=None):
+        self.key = key
+        self.max_pending = max_pending
+        self.submitted = 0
+        self.completed = 0
+        self._pool = Pool(size)
+        self._slots = BoundedSemaphore(max_pending) if max_pending else None
+        # key -> (func, event, args) waiting for the running one of the key.
+        self._queues = {}
 
-class ESLEvent(object):
-    def __init__(self, data):
-        self.headers = {}
-        self.parse_data(data)
+    @property
+    def pending(self):
+        """Number of events submitted and not handled yet."""
+        return self.submitted - self.completed
 
-    def parse_data(self, data):
-        data = unquote(data)
-        data = data.strip().splitlines()
-        last_key = None
-        value = ''
-        for line in data:
-            if ': ' in line:
-                key, value = line.split(': ', 1)
-                last_key = key
-            else:
-                key = last_key
-                value += '\n' + line
-            self.headers[key.strip()] = value.strip()
+    @property
+    def running(self):
+        return len(self._pool)
 
+    @property
+    def active_keys(self):
+        return len(self._queues)
+
+    def spawn(self, func, event, *args):
+        if self._slots is not None:
+            self._slots.acquire()
+        self.submitted += 1
+        key = event.headers.get(self.key)
+        if key is None:
+            self._pool.spawn(self._run, func, event, args)
+            return
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append((func, event, args))
+            return
+        self._queues[key] = deque()
+        self._pool.spawn(self._run_key, key, func, event, args)
 
-class ESLProtocol(object):
-    def __init__(self):
+    def _run(self, func, event, args):
+        try:
+            func(event, *args)
+        finally:
+            self.completed += 1
+            if self._slots is not None:
+                self._slots.release()
+
+    def _run_key(self, key, func, event, args):
+        queue = self._queues[key]
+        try:
+            while True:
+                self._run(func, event, args)
+                if not queue:
+                    return
+                func, event, args = queue.popleft()
+        finally:
+            del self._queues[key]
+            # Only left over when killed.
+            for _ in queue:
+                self.completed += 1
+                if self._slots is not None:
+                    self._slots.release()
+
+    def join(self, timeout=None):
+        return self._pool.join(timeout)
+
+    def kill(self):
+        self._pool.kill()
+
+
+class EventQueue(Queue):
+    """Event queue holding at most maxsize events.
+
+    When full, the policy decides what happens to a new event:
+
+    - ``block``: the reader waits, so TCP backpressure reaches FreeSWITCH.
+      Handlers waiting for a command reply would then wait forever, run
+      them on a handler_pool or give send a timeout.
+    - ``drop_oldest``: the oldest queued event is dropped.
+    - ``drop_newest``: the new event is dropped.
+    - ``priority``: the event with the lowest priority, the oldest among
+      equals, is dropped. priorities maps event names (or CUSTOM
+      subclasses) to numbers, missing names have priority 0.
+    - ``coalesce``: a queued event with the same coalesce_key as the new
+      one, by default its Event-Name and Unique-ID, is replaced by it.
+      The oldest event is dropped when there is none.
+
+    disconnect-notice and RECONNECT events are never dropped nor wait.
+    ``dropped``, ``coalesced`` and ``high_water`` count what happened.
+    """
+
+    policies = ('block', 'drop_oldest', 'drop_newest', 'priority', 'coalesce')
+
+    def __init__(self, maxsize=None, policy='block', priorities=None,
+                 coalesce_key=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown overflow policy: %s' % policy)
+        super(EventQueue, self).__init__()
+        self.limit = maxsize
+        self.policy = policy
+        self.priorities = priorities or {}
+        self.coalesce_key = coalesce_key or _coalesce_key
+        self.dropped = 0
+        self.coalesced = 0
+        self.high_water = 0
+        self._room = Event()
+
+    def put(self, item, block=True, timeout=None):
+        if (self.limit is not None and self.qsize() >= self.limit and
+                not _is_protected(item)):
+            if self.policy == 'block':
+                self._wait_for_room(block, timeout)
+            elif not self._make_room(item):
+                return
+        super(EventQueue, self).put(item, block, timeout)
+        size = self.qsize()
+        if size > self.high_water:
+            self.high_water = size
+
+    def put_nowait(self, item):
+        self.put(item, False)
+
+    def get(self, block=True, timeout=None):
+        item = super(EventQueue, self).get(block, timeout)
+        self._room.set()
+        return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def _wait_for_room(self, block, timeout):
+        _wait_for_room(self, block, timeout)
+
+    def _make_room(self, item):
+        """Apply the policy to a full queue, False if item must not be put."""
+        queue = self.queue
+        if self.policy == 'coalesce':
+            key = self.coalesce_key(item)
+            for index in range(len(queue) - 1, -1, -1):
+                if not _is_protected(queue[index]) and \
+                        self.coalesce_key(queue[index]) == key:
+                    queue[index] = item
+                    self.coalesced += 1
+                    return False
+        if self.policy == 'drop_newest':
+            self.dropped += 1
+            return False
+        if self.policy == 'priority':
+            lowest = _event_priority(item, self.priorities)
+            victim = None
+            for index, event in enumerate(queue):
+                if _is_protected(event):
+                    continue
+                priority = _event_priority(event, self.priorities)
+                if priority < lowest:
+                    lowest, victim = priority, index
+        else:
+            victim = next((index for index, event in enumerate(queue)
+                           if not _is_protected(event)), None)
+        self.dropped += 1
+        if victim is None:
+            return False
+        del queue[victim]
+        return True
+
+
+def _wait_for_room(queue, block, timeout):
+    """Wait until queue holds less than its limit, raise Full otherwise."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while queue.qsize() >= queue.limit:
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+        if not block or (remaining is not None and remaining <= 0):
+            raise gevent.queue.Full()
+        queue._room.clear()
+        queue._room.wait(remaining)
+
+
+# Control messages, the disconnect-notice and the RECONNECT notification
+# put by InboundESL after reconnecting.
+_control_events = frozenset(['DISCONNECT', 'RECONNECT'])
+
+
+def _is_protected(event):
+    """Whether event must never be dropped, None wakes process_events up."""
+    return event is None or _event_name(event) in _control_events
+
+
+def _event_name(event):
+    """Return the name handlers of event are registered with."""
+    headers = event.headers
+    name = headers.get('Event-Name')
+    if name == 'CUSTOM':
+        return headers.get('Event-Subclass')
+    if name is None:
+        content_type = headers.get('Content-Type')
+        if content_type == 'text/disconnect-notice':
+            return 'DISCONNECT'
+        if content_type == 'log/data':
+            return 'log'
+    return name
+
+
+def _event_priority(event, priorities):
+    return priorities.get(_event_name(event), 0)
+
+
+def _coalesce_key(event):
+    return _event_name(event), event.headers.get('Unique-ID')
+
+
+class PriorityEventQueue(object):
+    """Event queue with high, normal and low priority lanes.
+
+    Events are named like their handlers: CUSTOM events by subclass,
+    ``DISCONNECT`` for disconnect-notice and ``log`` for log/data. Events
+    named in high are always taken first and those named in low only when
+    the other lanes are empty, at most low_rate of them per second if
+    given. Each lane keeps its events in order.
+
+    Like EventQueue it holds at most maxsize events, when full the policy
+    decides what happens to a new event:
+
+    - ``block``: the reader waits for room.
+    - ``drop_oldest``: the oldest event of the lowest lane is dropped, or
+      the new event when every queued event is in a higher lane.
+    - ``drop_newest``: the new event is dropped.
+    - ``coalesce``: a queued event with the same coalesce_key as the new
+      one is replaced by it, otherwise it is dropped like drop_oldest.
+
+    disconnect-notice and RECONNECT events always go to the high lane and
+    are never dropped nor wait. ``dropped``, ``coalesced`` and
+    ``high_water`` count what happened.
+    """
+
+    default_high = frozenset([
+        'DISCONNECT', 'RECONNECT', 'BACKGROUND_JOB', 'CHANNEL_HANGUP',
+        'CHANNEL_HANGUP_COMPLETE', 'CHANNEL_EXECUTE_COMPLETE'])
+    default_low = frozenset([
+        'log', 'HEARTBEAT', 'PRESENCE_IN', 'PRESENCE_PROBE', 'RE_SCHEDULE',
+        'MESSAGE_QUERY', 'API'])
+
+    policies = ('block', 'drop_oldest', 'drop_newest', 'coalesce')
+
+    def __init__(self, high=None, low=None, low_rate=None, maxsize=None,
+                 policy='block', coalesce_key=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown overflow policy: %s' % policy)
+        self.high = frozenset(high) if high is not None else self.default_high
+        self.low = frozenset(low) if low is not None else self.default_low
+        self.low_rate = low_rate
+        self.limit = maxsize
+        self.policy = policy
+        self.coalesce_key = coalesce_key or _coalesce_key
+        self.dropped = 0
+        self.coalesced = 0
+        self.high_water = 0
+        self._lanes = (deque(), deque(), deque())
+        self._burst = max(low_rate or 0, 1)
+        self._tokens = self._burst
+        self._refilled_at = time.monotonic()
+        self._ready = Event()
+        self._room = Event()
+
+    def qsize(self):
+        return sum(len(lane) for lane in self._lanes)
+
+    @property
+    def lane_sizes(self):
+        """Number of events waiting in the high, normal and low lanes."""
+        return tuple(len(lane) for lane in self._lanes)
+
+    def put(self, event, block=True, timeout=None):
+        if _is_protected(event):
+            # Sentinels and control events go first.
+            lane = 0
+        else:
+            name = _event_name(event)
+            lane = 0 if name in self.high else 2 if name in self.low else 1
+            if self.limit is not None and self.qsize() >= self.limit:
+                if self.policy == 'block':
+                    _wait_for_room(self, block, timeout)
+                elif not self._make_room(event, lane):
+                    return
+        self._lanes[lane].append(event)
+        size = self.qsize()
+        if size > self.high_water:
+            self.high_water = size
+        self._ready.set()
+
+    def put_nowait(self, event):
+        self.put(event, False)
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        high, normal, low = self._lanes
+        while True:
+            if high:
+                self._room.set()
+                return high.popleft()
+            if normal:
+                self._room.set()
+                return normal.popleft()
+            wait = None
+            if low:
+                wait = self._low_wait()
+                if not wait:
+                    self._room.set()
+                    return low.popleft()
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise gevent.queue.Empty()
+                wait = remaining if wait is None else min(wait, remaining)
+            if not block:
+                raise gevent.queue.Empty()
+            self._ready.clear()
+            self._ready.wait(wait)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def _make_room(self, event, lane):
+        """Apply the policy to a full queue, False if event must not be put."""
+        if self.policy == 'coalesce':
+            key = self.coalesce_key(event)
+            queue = self._lanes[lane]
+            for index in range(len(queue) - 1, -1, -1):
+                if not _is_protected(queue[index]) and \
+                        self.coalesce_key(queue[index]) == key:
+                    queue[index] = event
+                    self.coalesced += 1
+                    return False
+        self.dropped += 1
+        if self.policy == 'drop_newest':
+            return False
+        # Events of a higher lane than the new one are never dropped for it.
+        for queue in reversed(self._lanes[lane:]):
+            for index, queued in enumerate(queue):
+                if not _is_protected(queued):
+                    del queue[index]
+                    return True
+        return False
+
+    def _low_wait(self):
+        """Take a low lane token, return the seconds to wait if none."""
+        if self.low_rate is None:
+            return 0
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens +
+                           (now - self._refilled_at) * self.low_rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.low_rate
+
+
+class ESLProtocol(EventHandlersMixin):
+    # Default timeouts in seconds of commands and bgapi jobs, None waits
+    # forever. Jobs nobody waits for anymore are forgotten after
+    # bgapi_timeout, unless cancel_bgapi forgets them first.
+    command_timeout = None
+    bgapi_timeout = 300
+
+    def __init__(self, lazy_events=False, json_decoder=None,
+                 handler_pool=None, event_queue=None, inline_events=False,
+                 buffer_size=65536):
         self._run = True
-        self._EOL = '\n'
-        self._commands_sent = []
+        self.connection = ESLConnection(lazy_events=lazy_events,
+                                        json_decoder=json_decoder,
+                                        buffer_size=buffer_size)
+        # KeyedPool running the handlers, they run in process_events itself
+        # when None.
+        self.handler_pool = handler_pool
         self._auth_request_event = Event()
         self._receive_events_greenlet = None
         self._process_events_greenlet = None
         self.event_handlers = {}
-        self._esl_event_queue = Queue()
-        self._process_esl_event_queue = True
-        self._lingering = False
+        # (name, handler) -> header values the events must have.
+        self.handler_filters = {}
+        # AsyncResult of each running bgapi job -> (job uuid, timeout
+        # greenlet).
+        self._background_jobs = {}
+        # Dispatch events right from receive_events, saving the queue and
+        # the process_events greenlet. Handlers must not wait for replies
+        # then, as no reply is read until they return.
+        self.inline_events = inline_events
+        # An EventQueue bounds the events waiting for process_events.
+        if event_queue is None and not inline_events:
+            event_queue = Queue()
+        self._esl_event_queue = event_queue
+        self._processing = Event()
+        self._processing.set()
+        # Keeps the bytes on the wire in the same order as the pending
+        # replies when several greenlets send on the same connection.
+        self._send_lock = Semaphore()
         self.connected = False
 
-    def start_event_handlers(self):
-        self._receive_events_greenlet = gevent.spawn(self.receive_events)
-        self._process_events_greenlet = gevent.spawn(self.process_events)
+    @property
+    def connected(self):
+        return self.connection.connected
 
-    def register_handle(self, name, handler):
-        if name not in self.event_handlers:
-            self.event_handlers[name] = []
-        if handler in self.event_handlers[name]:
-            return
-        self.event_handlers[name].append(handler)
+    @connected.setter
+    def connected(self, value):
+        self.connection.connected = value
+
+    @property
+    def _lingering(self):
+        return self.connection.lingering
+
+    @property
+    def _commands_sent(self):
+        return self.connection.pending
 
-    def unregister_handle(self, name, handler):
-        if name not in self.event_handlers:
-            raise ValueError('No handlers found for event: %s' % name)
-        self.event_handlers[name].remove(handler)
-        if not self.event_handlers[name]:
-            del self.event_handlers[name]
+    @property
+    def lazy_events(self):
+        return self.connection.lazy_events
+
+    @lazy_events.setter
+    def lazy_events(self, value):
+        self.connection.lazy_events = value
+
+    @property
+    def json_decoder(self):
+        return self.connection.json_decoder
+
+    @json_decoder.setter
+    def json_decoder(self, value):
+        self.connection.json_decoder = value
+
+    def start_event_handlers(self):
+        self._receive_events_greenlet = gevent.spawn(self.receive_events)
+        if not self.inline_events:
+            self._process_events_greenlet = gevent.spawn(self.process_events)
 
     def receive_events(self):
-        buf = ''
+        connection = self.connection
         while self._run:
             try:
-                data = self.sock_file.readline()
-                if data is not None:
-                    data = data.decode('utf-8')
+                received = self.sock.recv_into(connection.get_buffer())
             except Exception:
-                self._run = False
+                self._stop_running()
                 self.connected = False
                 self.sock.close()
                 # logging.exception("Error reading from socket.")
                 break
 
-            if not data:
+            if not received:
+                connection.receive_data(b'')
                 if self.connected:
                     logging.debug("Error receiving data, is FreeSWITCH running?")
                     self.connected = False
-                    self._run = False
+                    self._stop_running()
                 break
-            # Empty line
-            if data == self._EOL:
-                event = ESLEvent(buf)
-                buf = ''
-                self.handle_event(event)
-                continue
-            buf += data
-
-    @staticmethod
-    def _read_socket(sock, length):
-        """Receive data from socket until the length is reached."""
-        data = sock.read(length)
-        data_length = len(data)
-        while data_length < length:
-            logging.warn(
-                'Socket should read %s bytes, but actually read %s bytes. '
-                'Consider increasing "net.core.rmem_default".' %
-                (length, data_length)
-            )
-            # FIXME(italo): if not data raise error
-            data += sock.read(length - data_length)
-            data_length = len(data)
-        if data is not None:
-            data = data.decode('utf-8')
-        return data
-
-    def handle_event(self, event):
-        if event.headers['Content-Type'] == 'auth/request':
+            connection.buffer_updated(received)
+            self._handle_received()
+
+        self._connection_lost()
+
+    def _connection_lost(self):
+        connection = self.connection
+        # Nothing will answer the pending commands anymore.
+        for async_response in connection.clear_pending():
+            if not async_response.ready():
+                async_response.set_exception(NotConnectedError())
+        # Nor complete the background jobs.
+        for job_uuid in list(connection.background_jobs):
+            async_response = connection.cancel_background_job(job_uuid)
+            async_response.set_exception(NotConnectedError())
+
+    def _handle_received(self):
+        """Handle every complete message buffered in the connection."""
+        while True:
+            kind, event, token = self.connection.next_event()
+            if kind is NEED_DATA or kind is CLOSED:
+                return
+            self.handle_event(kind, event, token)
+
+    def handle_event(self, kind, event, token=None):
+        if kind == AUTH_REQUEST:
+            self._auth_request_event.set()
+        elif kind == REPLY:
+            # Replies nobody waits for, like the one of bgapi, have no token.
+            if token is not None:
+                token.set(event)
+        elif kind == RUDE_REJECTION:
             self._auth_request_event.set()
-        elif event.headers['Content-Type'] == 'command/reply':
-            async_response = self._commands_sent.pop(0)
-            event.data = event.headers['Reply-Text']
-            async_response.set(event)
-        elif event.headers['Content-Type'] == 'api/response':
-            length = int(event.headers['Content-Length'])
-            data = self._read_socket(self.sock_file, length)
-            event.data = data
-            async_response = self._commands_sent.pop(0)
-            async_response.set(event)
-        elif event.headers['Content-Type'] == 'text/disconnect-notice':
-            if event.headers.get('Content-Disposition') == 'linger':
+        else:
+            if token is not None:
+                # BACKGROUND_JOB of a bgapi command.
+                token.set(event)
+            if kind == DISCONNECT and self._lingering:
                 logging.debug('Linger activated')
-                self._lingering = True
-            else:
-                self.connected = False
             # disconnect-notice is now a propagated event both for inbound
             # and outbound socket modes.
             # This is useful for outbound mode to notify all remaining
             # waiting commands to stop blocking and send a NotConnectedError
-            self._esl_event_queue.put(event)
-        elif event.headers['Content-Type'] == 'text/rude-rejection':
-            self.connected = False
-            length = int(event.headers['Content-Length'])
-            self._read_socket(self.sock_file, length)
-            self._auth_request_event.set()
+            self._deliver_event(event)
+
+    def _deliver_event(self, event):
+        if self.inline_events:
+            self._dispatch_event(event)
         else:
-            length = int(event.headers['Content-Length'])
-            data = self._read_socket(self.sock_file, length)
-            if event.headers.get('Content-Type') == 'log/data':
-                event.data = data
-            else:
-                event.parse_data(data)
             self._esl_event_queue.put(event)
 
+    def _dispatch_event(self, event):
+        handlers = self._get_handlers(event)
+        if not handlers:
+            return
+        if self.handler_pool is not None:
+            self.handler_pool.spawn(self._run_handlers, event, handlers)
+        else:
+            self._run_handlers(event, handlers)
+
     def _safe_exec_handler(self, handler, event):
         try:
             handler(event)
@@ -165,53 +560,147 @@ class ESLProtocol(object):
             logging.exception('ESL %s raised exception.' % handler.__name__)
             logging.error(pprint.pformat(event.headers))
 
+    @property
+    def _process_esl_event_queue(self):
+        return self._processing.is_set()
+
+    @_process_esl_event_queue.setter
+    def _process_esl_event_queue(self, value):
+        # Pauses or resumes process_events.
+        if value:
+            self._processing.set()
+        else:
+            self._processing.clear()
+
+    def _stop_running(self):
+        """Stop the loops, waking up process_events wherever it waits."""
+        self._run = False
+        self._processing.set()
+        if self._esl_event_queue is not None:
+            self._esl_event_queue.put(None)
+
     def process_events(self):
         logging.debug('Event Processor Running')
         while self._run:
-            if not self._process_esl_event_queue:
-                gevent.sleep(1)
+            if not self._processing.is_set():
+                self._processing.wait()
                 continue
 
-            try:
-                event = self._esl_event_queue.get(timeout=1)
-            except gevent.queue.Empty:
-                continue
+            event = self._esl_event_queue.get()
+            # None only wakes the loop up.
+            if event is not None:
+                self._dispatch_event(event)
 
-            if event.headers.get('Event-Name') == 'CUSTOM':
-                handlers = self.event_handlers.get(event.headers.get('Event-Subclass'))
-            else:
-                handlers = self.event_handlers.get(event.headers.get('Event-Name'))
+    def _run_handlers(self, event, handlers):
+        before_handle, after_handle = self._dispatch_hooks
+        if before_handle is not None:
+            self._safe_exec_handler(before_handle, event)
 
-            if event.headers.get('Content-Type') == 'text/disconnect-notice':
-                handlers = self.event_handlers.get('DISCONNECT')
+        for handle in handlers:
+            self._safe_exec_handler(handle, event)
 
-            if not handlers and event.headers.get('Content-Type') == 'log/data':
-                handlers = self.event_handlers.get('log')
+        if after_handle is not None:
+            self._safe_exec_handler(after_handle, event)
 
-            if not handlers and '*' in self.event_handlers:
-                handlers = self.event_handlers.get('*')
+    def send(self, data, timeout=None):
+        """Send a command and return its reply.
 
-            if not handlers:
-                continue
-
-            if hasattr(self, 'before_handle'):
-                self._safe_exec_handler(self.before_handle, event)
-
-            for handle in handlers:
-                self._safe_exec_handler(handle, event)
+        If no reply comes in timeout seconds (command_timeout by default)
+        CommandTimeoutError is raised, the late reply is still consumed
+        when it arrives so the following replies keep their order.
+        """
+        if timeout is None:
+            timeout = self.command_timeout
+        async_response = self.send_async(data)
+        if not async_response.wait(timeout) and not async_response.ready():
+            raise CommandTimeoutError('No reply to %s after %s seconds' %
+                                      (data.split('\n', 1)[0], timeout))
+        return async_response.get()
+
+    def send_async(self, data):
+        """Send a command without waiting for its reply.
+
+        Returns a gevent AsyncResult set with the reply event.
+        """
+        if not self.connected:
+            raise NotConnectedError()
+        async_response = gevent.event.AsyncResult()
+        with self._send_lock:
+            self.sock.sendall(self.connection.send(data, async_response))
+        return async_response
 
-            if hasattr(self, 'after_handle'):
-                self._safe_exec_handler(self.after_handle, event)
+    def send_many(self, commands):
+        """Send several commands with a single write.
 
-    def send(self, data):
+        Returns a list of AsyncResult, one for each command reply.
+        """
         if not self.connected:
             raise NotConnectedError()
+        async_responses = [gevent.event.AsyncResult() for _ in commands]
+        with self._send_lock:
+            self.sock.sendall(
+                self.connection.send_many(commands, async_responses))
+        return async_responses
+
+    def bgapi(self, command, timeout=None):
+        """Run an api command in background without blocking the connection.
+
+        Returns a gevent AsyncResult set with the BACKGROUND_JOB event of
+        the job, its ``data`` is the command output. If timeout seconds
+        pass first the job is forgotten and CommandTimeoutError is raised
+        by the AsyncResult, bgapi_timeout is used when timeout is None.
+        BACKGROUND_JOB events are subscribed if needed.
+        """
+        if not self.connected:
+            raise NotConnectedError()
+        if timeout is None:
+            timeout = self.bgapi_timeout
         async_response = gevent.event.AsyncResult()
-        self._commands_sent.append(async_response)
-        raw_msg = (data + self._EOL*2).encode('utf-8')
-        self.sock.send(raw_msg)
-        response = async_response.get()
-        return response
+        job_uuid = str(uuid.uuid4())
+        with self._send_lock:
+            self.sock.sendall(
+                self.connection.bgapi(command, job_uuid, async_response))
+        timer = None
+        if timeout is not None:
+            timer = gevent.spawn_later(timeout, self._expire_background_job,
+                                       job_uuid)
+        self._background_jobs[async_response] = (job_uuid, timer)
+        async_response.rawlink(self._forget_background_job)
+        return async_response
+
+    def cancel_bgapi(self, job):
+        """Forget a job returned by bgapi whose result is not wanted.
+
+        Its BACKGROUND_JOB event is ignored and job is never set. Returns
+        False if the job was already done.
+        """
+        job_uuid = self._forget_background_job(job)
+        if job_uuid is None:
+            return False
+        self.connection.cancel_background_job(job_uuid)
+        return True
+
+    def _forget_background_job(self, job):
+        job_uuid, timer = self._background_jobs.pop(job, (None, None))
+        if timer is not None:
+            timer.kill(block=False)
+        return job_uuid
+
+    def _expire_background_job(self, job_uuid):
+        async_response = self.connection.cancel_background_job(job_uuid)
+        if async_response is not None:
+            async_response.set_exception(CommandTimeoutError(
+                'Background job %s timed out' % job_uuid))
+
+    def subscribe(self, events='ALL', event_format='plain'):
+        """Subscribe to events, event_format may be plain, json or xml.
+
+        events is a space separated string or a list of event names, CUSTOM
+        subclasses must follow the CUSTOM name.
+        """
+        if not isinstance(events, six.string_types):
+            events = ' '.join(events)
+        return self.send('event %s %s' % (event_format, events))
 
     def stop(self):
         if self.connected:
@@ -219,27 +708,64 @@ class ESLProtocol(object):
                 self.send('exit')
             except (NotConnectedError, socket.error, OutboundSessionHasGoneAway):
                 pass
-        self._run = False
+        self._stop_running()
         if self._receive_events_greenlet:
             logging.info("Waiting for receive greenlet exit")
             self._receive_events_greenlet.join()
         if self._process_events_greenlet:
             logging.info("Waiting for event processing greenlet exit")
             self._process_events_greenlet.join()
+        if self.handler_pool is not None:
+            logging.info("Waiting for event handlers to finish")
+            self.handler_pool.join()
         self.sock.close()
-        self.sock_file.close()
 
 
 class InboundESL(ESLProtocol):
-    def __init__(self, host, port, password, timeout=5):
-        super(InboundESL, self).__init__()
+    # Seconds to wait before the first reconnect attempt, doubled after
+    # each failed attempt up to max_reconnect_delay.
+    reconnect_delay = 1
+    max_reconnect_delay = 60
+
+    def __init__(self, host, port, password, timeout=5, lazy_events=False,
+                 json_decoder=None, auto_reconnect=False,
+                 auto_subscribe=False, handler_pool=None, event_queue=None):
+        super(InboundESL, self).__init__(lazy_events=lazy_events,
+                                         json_decoder=json_decoder,
+                                         handler_pool=handler_pool,
+                                         event_queue=event_queue)
         self.host = host
         self.port = port
         self.password = password
         self.timeout = timeout
+        self.auto_reconnect = auto_reconnect
+        self.auto_subscribe = auto_subscribe
+        self._stopping = False
+        self._reconnect_greenlet = None
+        # Only a connection which worked once is reconnected.
+        self._established = False
         self.connected = False
 
     def connect(self):
+        self._established = False
+        try:
+            self._open_socket()
+            self.start_event_handlers()
+            self._auth_request_event.wait()
+            if not self.connected:
+                raise NotConnectedError('Server closed connection, check '
+                                        'FreeSWITCH config.')
+            self.authenticate()
+            if self.auto_subscribe:
+                for async_response in self._sync_subscriptions():
+                    async_response.get()
+        except Exception:
+            if self._reconnect_greenlet is not None:
+                self._reconnect_greenlet.kill()
+            raise
+        self._established = True
+
+    def _open_socket(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.settimeout(self.timeout)
         try:
@@ -249,17 +775,80 @@ class InboundESL(ESLProtocol):
                                     % self.timeout)
         self.connected = True
         self.sock.settimeout(None)
-        self.sock_file = self.sock.makefile('rb')
-        self.start_event_handlers()
+
+    def _connection_lost(self):
+        super(InboundESL, self)._connection_lost()
+        if not self.auto_reconnect or not self._established or \
+                self._stopping:
+            return
+        # A failed attempt also ends here, the running supervisor retries.
+        if self._reconnect_greenlet is None or self._reconnect_greenlet.dead:
+            self._reconnect_greenlet = gevent.spawn(self._reconnect)
+
+    def _reconnect(self):
+        """Reconnect with exponential backoff until it works or stop()."""
+        delay = self.reconnect_delay
+        while not self._stopping:
+            gevent.sleep(delay / 2.0 + random.uniform(0, delay / 2.0))
+            if self._stopping:
+                return
+            try:
+                with gevent.Timeout(self.timeout, NotConnectedError(
+                        'Reconnect timed out after %s seconds' % self.timeout)):
+                    self._resume()
+            except (socket.error, NotConnectedError, ValueError) as e:
+                logging.warning('Reconnecting to %s:%s failed: %s',
+                                self.host, self.port, e)
+                self.connected = False
+                self.sock.close()
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+            logging.info('Reconnected to %s:%s', self.host, self.port)
+            # Handlers registered for RECONNECT know events may be missing.
+            event = ESLEvent('Event-Name: RECONNECT')
+            event.data = None
+            self._deliver_event(event)
+            return
+
+    def _resume(self):
+        """Open a new connection and send the subscriptions again."""
+        for async_response in self.connection.reset():
+            if not async_response.ready():
+                async_response.set_exception(NotConnectedError())
+        self._auth_request_event.clear()
+        self._run = True
+        self._open_socket()
+        self._receive_events_greenlet = gevent.spawn(self.receive_events)
+        if self._process_events_greenlet is not None and \
+                self._process_events_greenlet.dead:
+            self._process_events_greenlet = gevent.spawn(self.process_events)
         self._auth_request_event.wait()
         if not self.connected:
             raise NotConnectedError('Server closed connection, check '
                                     'FreeSWITCH config.')
         self.authenticate()
+        commands = self.connection.replay_commands()
+        if commands:
+            for async_response in self.send_many(commands):
+                async_response.get()
+        if self.auto_subscribe:
+            # Handlers may have changed while disconnected.
+            for async_response in self._sync_subscriptions():
+                async_response.get()
+
+    def stop(self):
+        self._stopping = True
+        if self._reconnect_greenlet is not None:
+            self._reconnect_greenlet.kill()
+        super(InboundESL, self).stop()
 
     def authenticate(self):
-        response = self.send('auth %s' % self.password)
-        if response.headers['Reply-Text'] != '+OK accepted':
+        async_response = gevent.event.AsyncResult()
+        with self._send_lock:
+            self.sock.sendall(
+                self.connection.auth(self.password, async_response))
+        async_response.get()
+        if not self.connection.authenticated:
             raise ValueError('Invalid password.')
 
     def __enter__(self):
@@ -269,11 +858,22 @@ class InboundESL(ESLProtocol):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stop()
 
-class OutboundSession(ESLProtocol):
-    def __init__(self, client_address, sock):
-        super(OutboundSession, self).__init__()
+class OutboundSession(OutboundSessionMixin, ESLProtocol):
+    # Initial receive buffer of lean sessions, it grows for larger events.
+    lean_buffer_size = 4096
+
+    def __init__(self, client_address, sock, lean=False, handshake=None,
+                 event_queue=None):
+        # Lean sessions dispatch events from their reader greenlet, see
+        # inline_events, and start with a small receive buffer.
+        if lean:
+            if event_queue is not None:
+                raise ValueError('Lean sessions have no event queue.')
+            super(OutboundSession, self).__init__(
+                inline_events=True, buffer_size=self.lean_buffer_size)
+        else:
+            super(OutboundSession, self).__init__(event_queue=event_queue)
         self.sock = sock
-        self.sock_file = self.sock.makefile('rb')
         self.connected = True
         self.session_data = None
         self.start_event_handlers()
@@ -282,56 +882,13 @@ class OutboundSession(ESLProtocol):
         self.register_handle('DISCONNECT', self.on_disconnect)
         self.expected_events = {}
         self._outbound_connected = False
+        if handshake is not None:
+            self.handshake = tuple(handshake)
 
-    @property
-    def uuid(self):
-        return self.session_data.get('variable_uuid')
-
-    @property
-    def call_uuid(self):
-        return self.session_data.get('variable_call_uuid')
-
-    @property
-    def caller_id_number(self):
-        return self.session_data.get('Caller-Caller-ID-Number')
-
-    def on_disconnect(self, event):
-        if self._lingering:
-            logging.debug('Socket lingering..')
-        elif not self.connected:
-            logging.debug('Socket closed: %s' % event.headers)
-        logging.debug('Raising OutboundSessionHasGoneAway for all pending'
-                      'results')
+    def _connection_lost(self):
         self._outbound_connected = False
-
-        for event_name in self.expected_events:
-            for variable, value, async_result in \
-                    self.expected_events[event_name]:
-                async_result.set_exception(OutboundSessionHasGoneAway())
-
-        for cmd in self._commands_sent:
-            cmd.set_exception(OutboundSessionHasGoneAway())
-
-    def on_hangup(self, event):
-        self._outbound_connected = False
-        logging.info('Caller %s has gone away.' % self.caller_id_number)
-
-    def on_event(self, event):
-        # FIXME(italo): Decide if we really need a list of expected events
-        # for each expected event. Since we're interacting with the call from
-        # just one greenlet we don't have more than one item on this list.
-        event_name = event.headers.get('Event-Name')
-        if event_name not in self.expected_events:
-            return
-
-        for expected_event in self.expected_events[event_name]:
-            event_variable, expected_value, async_response = expected_event
-            expected_variable = 'variable_%s' % event_variable
-            if expected_variable not in event.headers:
-                return
-            elif expected_value == event.headers.get(expected_variable):
-                async_response.set(event)
-                self.expected_events[event_name].remove(expected_event)
+        self._fail_waiters(OutboundSessionHasGoneAway)
+        super(OutboundSession, self)._connection_lost()
 
     def call_command(self, app_name, app_args=None, block=False, response_timeout=None):
         """Wraps app_name and app_args into FreeSWITCH Outbound protocol:
@@ -340,42 +897,57 @@ class OutboundSession(ESLProtocol):
                 call-command: execute
                 execute-app-name: answer\n\n
 
+        With block=True it returns the CHANNEL_EXECUTE_COMPLETE event of this
+        execution instead of the command reply.
         """
-        # We're not allowed to send more commands.
-        # lingering True means we already received a hangup from the caller
-        # and any commands sent at this time to the session will fail
-
-        def _perform_call_command(app_name, app_args):
+        if not block:
+            # We're not allowed to send more commands.
+            # lingering True means we already received a hangup from the
+            # caller and any commands sent at this time to the session will
+            # fail
             if self._lingering:
                 raise OutboundSessionHasGoneAway()
+            return self.send(self._execute_command(app_name, app_args))
 
-            command = "sendmsg\n" \
-                      "call-command: execute\n" \
-                      "execute-app-name: %s" % app_name
-            if app_args:
-                command += "\nexecute-app-arg: %s" % app_args
+        event_uuid = str(uuid.uuid4())
+        async_response = self.execute_async(app_name, app_args, event_uuid)
+        try:
+            return async_response.get(block=True, timeout=response_timeout)
+        finally:
+            self._forget_execute_complete(event_uuid, async_response)
 
-            return self.send(command)
-
-        if not block:
-            return _perform_call_command(app_name, app_args)
+    def execute_async(self, app_name, app_args=None, event_uuid=None):
+        """Execute app_name without waiting for it to complete.
 
+        Returns a gevent AsyncResult set with the CHANNEL_EXECUTE_COMPLETE
+        event of this execution, matched by its Application-UUID, so several
+        executions may be in flight at once.
+        """
+        if self._lingering:
+            raise OutboundSessionHasGoneAway()
+        if event_uuid is None:
+            event_uuid = str(uuid.uuid4())
         async_response = gevent.event.AsyncResult()
-        expected_event = "CHANNEL_EXECUTE_COMPLETE"
-        expected_variable = "current_application"
-        expected_variable_value = app_name
-        self.register_expected_event(expected_event, expected_variable,
-                                     expected_variable_value, async_response)
-        _perform_call_command(app_name, app_args)
-        event = async_response.get(block=True, timeout=response_timeout)
-        return event
+        self._expect_execute_complete(event_uuid, async_response)
+        try:
+            self.send(self._execute_command(app_name, app_args, event_uuid))
+        except Exception:
+            self._forget_execute_complete(event_uuid, async_response)
+            raise
+        return async_response
 
     def connect(self):
         if self._outbound_connected:
             return self.session_data
 
         try:
-            resp = self.send('connect')
+            if self.handshake:
+                # One write and one round trip for the whole handshake.
+                replies = [async_response.get() for async_response in
+                           self.send_many(self._handshake_commands())]
+                resp = replies[0]
+            else:
+                resp = self.send('connect')
         except OutboundSessionHasGoneAway as e:
             # cleanup before raising exception
             self.stop()
@@ -384,6 +956,8 @@ class OutboundSession(ESLProtocol):
         self._outbound_connected = True
 
     def myevents(self):
+        if self._sent_in_handshake('myevents'):
+            return
         self.send('myevents')
 
     def answer(self):
@@ -394,24 +968,17 @@ class OutboundSession(ESLProtocol):
         self.call_command('park')
 
     def linger(self, timeout=None):
-        if timeout is not None:
-            self.send(f'linger {timeout}')
-        else:
-            self.send('linger')
+        command = 'linger' if timeout is None else f'linger {timeout}'
+        if self._sent_in_handshake(command):
+            return
+        self.send(command)
 
     def playback(self, path, block=True):
         if not block:
             self.call_command('playback', path)
             return
 
-        async_response = gevent.event.AsyncResult()
-        expected_event = "CHANNEL_EXECUTE_COMPLETE"
-        expected_variable = "current_application"
-        expected_variable_value = "playback"
-        self.register_expected_event(expected_event, expected_variable,
-                                     expected_variable_value, async_response)
-        self.call_command('playback', path)
-        event = async_response.get(block=True)
+        event = self.call_command('playback', path, block=True)
         # TODO(italo): Decide what we need to return.
         #   Returning whole event right now
         return event
@@ -433,14 +1000,8 @@ class OutboundSession(ESLProtocol):
             self.call_command('play_and_get_digits', args)
             return
 
-        async_response = gevent.event.AsyncResult()
-        expected_event = "CHANNEL_EXECUTE_COMPLETE"
-        expected_variable = "current_application"
-        expected_variable_value = "play_and_get_digits"
-        self.register_expected_event(expected_event, expected_variable,
-                                     expected_variable_value, async_response)
-        self.call_command('play_and_get_digits', args)
-        event = async_response.get(block=True, timeout=response_timeout)
+        event = self.call_command('play_and_get_digits', args, block=True,
+                                  response_timeout=response_timeout)
         if not event:
             return
         digit = event.headers.get('variable_%s' % variable)
@@ -458,27 +1019,13 @@ class OutboundSession(ESLProtocol):
             self.call_command('say', args)
             return
 
-        async_response = gevent.event.AsyncResult()
-        expected_event = "CHANNEL_EXECUTE_COMPLETE"
-        expected_variable = "current_application"
-        expected_variable_value = "say"
-        self.register_expected_event(expected_event, expected_variable,
-                                     expected_variable_value, async_response)
-        self.call_command('say', args)
-        event = async_response.get(block=True, timeout=response_timeout)
+        event = self.call_command('say', args, block=True,
+                                  response_timeout=response_timeout)
         return event
 
     def bridge(self, args, block=True, response_timeout=None):
         return self.call_command("bridge", args, block=block, response_timeout=response_timeout)
 
-    def register_expected_event(self, expected_event, expected_variable,
-                                expected_value, async_response):
-        if expected_event not in self.expected_events:
-            self.expected_events[expected_event] = []
-        self.expected_events[expected_event].append((expected_variable,
-                                                    expected_value,
-                                                    async_response))
-
     def hangup(self, cause='NORMAL_CLEARING'):
         self.call_command('hangup', cause)
 
@@ -494,54 +1041,61 @@ class OutboundSession(ESLProtocol):
             raise OutboundSessionHasGoneAway
         self.send('api uuid_break %s' % self.uuid)
 
-    def raise_if_disconnected(self):
-        """This function will raise the exception
-        esl.OutboundSessionHasGoneAway if the caller hung up the call
-        """
-        if not self._outbound_connected:
-            raise OutboundSessionHasGoneAway
-
-    def while_connected(self):
-        """Returns an object that check if the session is connected in
-        the __enter__ and __exit__ steps, if disconnected will
-        raise greenswitch.esl.OutboundSessionHasGoneAway exception.
-
-        This method can be used as a context manager or decorator.
-
-        Examples:
-        >>> with outbound_session.while_connected():
-        >>>    do_something()
-        >>>
-        >>> @outbound_session.while_connected()
-        >>> def do_something():
-        >>>     ...
-        """
-        class _while_connected(object):
-            def __init__(self, outbound_session):
-                self.outbound_session = outbound_session
-
-            def __enter__(self):
-                self.outbound_session.raise_if_disconnected()
-                return self
-
-            def __exit__(self, exit_type, exit_value, exit_traceback):
-                self.outbound_session.raise_if_disconnected()
-
-            def __call__(self, func):
-                @functools.wraps(func)
-                def decorator(*args, **kwargs):
-                    with self:
-                        return func(*args, **kwargs)
-
-                return decorator
-
-        return _while_connected(self)
-
 
 class OutboundESLServer(object):
+    # Seconds a rejected call gets to read our commands and close.
+    reject_timeout = 5
+    # Seconds between event loop lag samples, see max_loop_lag.
+    loop_lag_interval = 0.5
+    # Seconds between progress logs while draining.
+    drain_progress_interval = 5
+    # Hangup cause of the calls still active at drain_timeout, see
+    # drain_policy.
+    drain_hangup_cause = 'SYSTEM_SHUTDOWN'
+    # Seconds to wait for the listening sockets of the previous server.
+    handoff_timeout = 5
+    drain_policies = ('wait', 'hangup', 'kill')
+
     def __init__(self, bind_address='127.0.0.1', bind_port=8000,
-                 application=None, max_connections=100):
+                 application=None, max_connections=100, lean_sessions=False,
+                 handshake=None, reject_hangup_cause=None,
+                 max_pending_accepts=None, max_loop_lag=None,
+                 listen_all=False, backlog=100, accept_batch=1,
+                 reuse_port=False, drain_timeout=None, drain_policy='wait',
+                 handoff_path=None, event_queue_factory=None):
         self.bind_address = bind_address
+        # After stop() calls are waited for, up to drain_timeout seconds if
+        # set. Then calls still active are waited for, hung up or killed
+        # by drain_policy.
+        if drain_policy not in self.drain_policies:
+            raise ValueError('drain_policy must be one of %s' %
+                             ', '.join(self.drain_policies))
+        self.drain_timeout = drain_timeout
+        self.drain_policy = drain_policy
+        self.draining = False
+        # Unix socket path where the listening sockets are handed to the
+        # next server started with the same path, which then replaces this
+        # one while it drains.
+        self.handoff_path = handoff_path
+        self._handed_off = False
+        # Lets several processes listen on the same port, see
+        # PreforkOutboundESLServer.
+        self.reuse_port = reuse_port
+        # With listen_all every address in bind_address and port in
+        # bind_port is listened on, instead of the first port that binds.
+        self.listen_all = listen_all
+        self.backlog = backlog
+        # Connections accepted per wakeup of a listener.
+        self.accept_batch = accept_batch
+        # Sessions read and dispatch their events in a single greenlet.
+        self.lean_sessions = lean_sessions
+        # Commands pipelined with connect, e.g. ['myevents', 'linger'].
+        self.handshake = handshake
+        # Called without arguments for the event queue of each session,
+        # e.g. functools.partial(PriorityEventQueue, maxsize=1000).
+        if event_queue_factory is not None and lean_sessions:
+            raise ValueError('Lean sessions have no event queue.')
+        self.event_queue_factory = event_queue_factory
         if not isinstance(bind_port, (list, tuple)):
             bind_port = [bind_port]
         if not bind_port:
@@ -551,90 +1105,525 @@ class OutboundESLServer(object):
         self.bind_port = bind_port
         self.max_connections = max_connections
         self.connection_count = 0
+        # Admission control, calls over any limit are rejected before a
+        # session is created: max_connections counts accepted calls still
+        # in their handshake too, max_pending_accepts only those and
+        # max_loop_lag is in seconds.
+        self.max_pending_accepts = max_pending_accepts
+        self.max_loop_lag = max_loop_lag
+        self.reject_hangup_cause = reject_hangup_cause
+        self.pending_accepts = 0
+        self.rejected = 0
+        self.loop_lag = 0.0
         if not application:
             raise ValueError('You need an Application to control your calls.')
         self.application = application
         self._greenlets = set()
         self._running = False
         self.server = None
+        self.listeners = []
+        # Active calls of each listener, by its (address, port).
+        self.listener_connections = {}
         logging.info('Starting OutboundESLServer at %s:%s' %
                      (self.bind_address, self.bind_port))
         self.bound_port = None
 
-    def listen(self):
-        self.server = socket.socket()
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        for port in self.bind_port:
-            try:
-                self.server.bind((self.bind_address, port))
-                self.bound_port = port
-                break
-            except socket.error:
-                logging.info('Failed to bind to port %s, '
-                             'trying next in range...' % port)
-                continue
-        if not self.bound_port:
+    def _bind(self):
+        """Return the listening sockets, exits if none could be bound."""
+        addresses = self.bind_address
+        if not isinstance(addresses, (list, tuple)):
+            addresses = [addresses]
+        listeners = []
+        for address in addresses:
+            for port in self.bind_port:
+                family = socket.AF_INET6 if ':' in address else socket.AF_INET
+                listener = socket.socket(family, socket.SOCK_STREAM)
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if self.reuse_port:
+                    listener.setsockopt(socket.SOL_SOCKET,
+                                        socket.SO_REUSEPORT, 1)
+                try:
+                    listener.bind((address, port))
+                except socket.error:
+                    listener.close()
+                    logging.info('Failed to bind to %s:%s, trying next in '
+                                 'range...' % (address, port))
+                    continue
+                logging.info('Successfully bound to %s:%s' % (address, port))
+                listener.listen(self.backlog)
+                listeners.append(listener)
+                if not self.listen_all:
+                    return listeners
+        if not listeners:
             logging.error('Could not bind server, no ports available.')
             sys.exit()
-        logging.info('Successfully bound to port %s' % self.bound_port)
-        self.server.setblocking(0)
-        self.server.listen(100)
-        self._running = True
-
-        while self._running:
-            try:
-                sock, client_address = self.server.accept()
-            except socket.error as error:
-                if error.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
-                    # no data available
-                    gevent.sleep(0.1)
-                    continue
-                raise
+        return listeners
 
-            session = OutboundSession(client_address, sock)
-            gevent.spawn(self._accept_call, session)
+    def listen(self):
+        handoff = None
+        listeners = None
+        if self.handoff_path:
+            listeners = self._take_over()
+        self.listeners = listeners or self._bind()
+        self.server = self.listeners[0]
+        self.bound_port = self.server.getsockname()[1]
+        for listener in self.listeners:
+            self.listener_connections[listener.getsockname()[:2]] = 0
+        self._running = True
+        self._handed_off = False
+        if self.handoff_path:
+            handoff = self._listen_handoff()
+        lag_watcher = None
+        if self.max_loop_lag is not None:
+            lag_watcher = gevent.spawn(self._watch_loop_lag)
+
+        if len(self.listeners) == 1:
+            self._accept_loop(self.server)
+        else:
+            gevent.joinall([gevent.spawn(self._accept_loop, listener)
+                            for listener in self.listeners],
+                           raise_error=True)
 
+        if lag_watcher is not None:
+            lag_watcher.kill()
         logging.info('Closing socket connection...')
-        self.server.shutdown(socket.SHUT_RD)
-        self.server.close()
+        for listener in self.listeners:
+            listener.close()
+        if handoff is not None:
+            handoff.close()
+            # The path belongs to the next server after a handoff.
+            if not self._handed_off:
+                self._unlink_handoff_path()
 
         logging.info('Waiting for calls to be ended. Currently, there are '
                      '%s active calls' % self.connection_count)
-        gevent.joinall(self._greenlets)
-        self._greenlets.clear()
+        self._drain()
 
         logging.info('OutboundESLServer stopped')
 
-    def _accept_call(self, session):
-        if self.connection_count >= self.max_connections:
-            logging.info(
-                'Rejecting call, server is at full capacity, current '
-                'connection count is %s/%s' %
-                (self.connection_count, self.max_connections))
-            session.connect()
-            session.stop()
-            return
+    def _drain(self):
+        """Wait for the active calls to end, see drain_timeout."""
+        self.draining = True
+        deadline = None
+        if self.drain_timeout is not None:
+            deadline = time.monotonic() + self.drain_timeout
+        while self._greenlets:
+            timeout = self.drain_progress_interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._drain_expired()
+                    deadline = None
+                    continue
+                timeout = min(timeout, remaining)
+            gevent.joinall(list(self._greenlets), timeout=timeout)
+            if self._greenlets:
+                logging.info('Draining, %s active calls' %
+                             self.connection_count)
+        self.draining = False
+
+    def _drain_expired(self):
+        handlers = list(self._greenlets)
+        logging.warning('%s calls still active after %s seconds, applying '
+                        'the %s drain policy' % (len(handlers),
+                                                 self.drain_timeout,
+                                                 self.drain_policy))
+        if self.drain_policy == 'hangup':
+            for handler in handlers:
+                gevent.spawn(self._hangup_call, handler.session)
+        elif self.drain_policy == 'kill':
+            gevent.killall(handlers, block=False)
+
+    def _hangup_call(self, session):
+        try:
+            session.hangup(self.drain_hangup_cause)
+        except (NotConnectedError, OutboundSessionHasGoneAway, socket.error):
+            pass
+
+    def _take_over(self):
+        """Return the listening sockets handed off by the server running at
+        handoff_path, None when there is none."""
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.handoff_path)
+        except socket.error:
+            client.close()
+            return None
+        fds = array.array('i')
+        try:
+            client.settimeout(self.handoff_timeout)
+            msg, ancdata, flags, address = client.recvmsg(
+                1024, socket.CMSG_SPACE(256 * fds.itemsize))
+        except socket.error:
+            logging.exception('Listening sockets handoff failed')
+            return None
+        finally:
+            client.close()
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+        # The family of each socket comes in the message, Python 3.6 can
+        # not detect the family of a file descriptor.
+        families = [int(family) for family in msg.split()]
+        if not fds or len(families) != len(fds):
+            for fd in fds:
+                os.close(fd)
+            logging.warning('No listening sockets handed off by %s' %
+                            self.handoff_path)
+            return None
+        logging.info('Took over %s listening sockets from %s' %
+                     (len(fds), self.handoff_path))
+        return [socket.socket(family, socket.SOCK_STREAM, fileno=fd)
+                for family, fd in zip(families, fds)]
+
+    def _listen_handoff(self):
+        self._unlink_handoff_path()
+        handoff = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        handoff.bind(self.handoff_path)
+        os.chmod(self.handoff_path, 0o600)
+        handoff.listen(1)
+        gevent.spawn(self._serve_handoff, handoff)
+        return handoff
+
+    def _serve_handoff(self, handoff):
+        """Hand the listening sockets to the next server, then drain."""
+        while True:
+            try:
+                conn, _ = handoff.accept()
+            except socket.error:
+                # Closed by listen() when the server stops.
+                return
+            try:
+                if not self._handoff_allowed(conn):
+                    logging.warning('Refused listening sockets handoff to '
+                                    'a process of another user')
+                    continue
+                fds = array.array('i', [listener.fileno()
+                                        for listener in self.listeners])
+                families = ' '.join(['%d' % listener.family
+                                     for listener in self.listeners])
+                conn.sendmsg([families.encode('ascii')],
+                             [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+            except socket.error:
+                logging.exception('Listening sockets handoff failed')
+                continue
+            finally:
+                conn.close()
+            break
+        logging.info('Listening sockets handed off, draining')
+        self._handed_off = True
+        self.stop()
+
+    def _handoff_allowed(self, conn):
+        """Whether the peer of conn runs as the same user as this server."""
+        if not hasattr(socket, 'SO_PEERCRED'):
+            # Without peer credentials only the 0600 mode of the path
+            # keeps other users out.
+            return True
+        credentials = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                      struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', credentials)
+        return uid == os.getuid()
+
+    def _unlink_handoff_path(self):
+        try:
+            os.unlink(self.handoff_path)
+        except OSError:
+            pass
+
+    def _accept_loop(self, listener):
+        key = listener.getsockname()[:2]
+        while self._running:
+            try:
+                accepted = self._accept_many(listener)
+            except socket.error:
+                # stop() closes the socket to wake accept up.
+                if not self._running:
+                    break
+                raise
 
-        self._handle_call(session)
+            for sock, client_address in accepted:
+                reason = self._over_capacity()
+                if reason:
+                    self.rejected += 1
+                    logging.info('Rejecting call from %s, %s' %
+                                 (client_address, reason))
+                    gevent.spawn(self._reject_call, sock)
+                    continue
+
+                self.pending_accepts += 1
+                event_queue = None
+                if self.event_queue_factory is not None:
+                    event_queue = self.event_queue_factory()
+                session = OutboundSession(client_address, sock,
+                                          lean=self.lean_sessions,
+                                          handshake=self.handshake,
+                                          event_queue=event_queue)
+                gevent.spawn(self._accept_call, session, key)
+
+    def _accept_many(self, listener):
+        """Wait for a connection, then take up to accept_batch pending ones
+        without waiting again."""
+        accepted = [listener.accept()]
+        if self.accept_batch <= 1:
+            return accepted
+        listener.settimeout(0)
+        try:
+            while len(accepted) < self.accept_batch:
+                accepted.append(listener.accept())
+        except socket.error:
+            # Nothing else is pending, or the listener was closed and the
+            # next accept raises.
+            pass
+        finally:
+            if self._running:
+                listener.settimeout(None)
+        return accepted
+
+    def _over_capacity(self):
+        """Return why a new call must be rejected, None to accept it."""
+        if self.connection_count + self.pending_accepts >= self.max_connections:
+            return ('server is at full capacity, current connection count '
+                    'is %s/%s with %s pending' %
+                    (self.connection_count, self.max_connections,
+                     self.pending_accepts))
+        if (self.max_pending_accepts is not None and
+                self.pending_accepts >= self.max_pending_accepts):
+            return ('%s calls are pending their handshake' %
+                    self.pending_accepts)
+        if self.max_loop_lag is not None and self.loop_lag > self.max_loop_lag:
+            return 'event loop lags %.3f seconds' % self.loop_lag
+        return None
+
+    def _reject_call(self, sock):
+        """Reject a call on the raw socket, no session is started."""
+        try:
+            sock.settimeout(self.reject_timeout)
+            sock.sendall(OutboundSession._reject_data(self.reject_hangup_cause))
+            # FreeSWITCH closes the socket after exit.
+            while sock.recv(4096):
+                pass
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+
+    def _watch_loop_lag(self):
+        while True:
+            started = time.monotonic()
+            gevent.sleep(self.loop_lag_interval)
+            self.loop_lag = max(0.0, time.monotonic() - started -
+                                self.loop_lag_interval)
+
+    def _accept_call(self, session, listener=None):
+        try:
+            self._handle_call(session, listener)
+        finally:
+            self.pending_accepts -= 1
 
-    def _handle_call(self, session):
+    def _handle_call(self, session, listener=None):
         session.connect()
         app = self.application(session)
         handler = gevent.spawn(app.run)
         self._greenlets.add(handler)
         handler.session = session
+        handler.listener = listener
         handler.link(self._handle_call_finish)
         self.connection_count += 1
+        if listener in self.listener_connections:
+            self.listener_connections[listener] += 1
         logging.debug('Connection count %d' % self.connection_count)
 
     def _handle_call_finish(self, handler):
         logging.info('Call from %s ended' % handler.session.caller_id_number)
         self._greenlets.remove(handler)
         self.connection_count -= 1
+        if handler.listener in self.listener_connections:
+            self.listener_connections[handler.listener] -= 1
         logging.debug('Connection count %d' % self.connection_count)
         handler.session.stop()
 
     def stop(self):
         self._running = False
+        for listener in self.listeners:
+            listener.close()
+
+
+
+class _PreforkWorkerServer(OutboundESLServer):
+    """OutboundESLServer run by each PreforkOutboundESLServer worker."""
+
+    def __init__(self, connections, slot, max_total_connections, **kwargs):
+        super(_PreforkWorkerServer, self).__init__(reuse_port=True, **kwargs)
+        # Calls of every worker, shared with them, this one counts in slot.
+        self.connections = connections
+        self.slot = slot
+        self.max_total_connections = max_total_connections
+
+    def _over_capacity(self):
+        """Check the limits of this worker, then reserve a slot of
+        max_total_connections, released when the call ends."""
+        reason = super(_PreforkWorkerServer, self)._over_capacity()
+        if reason:
+            return reason
+        with self.connections.get_lock():
+            total = sum(self.connections.get_obj())
+            if (self.max_total_connections is not None and
+                    total >= self.max_total_connections):
+                return ('workers are at full capacity, total connection '
+                        'count is %s/%s' % (total, self.max_total_connections))
+            self.connections[self.slot] += 1
+        return None
+
+    def _release(self):
+        with self.connections.get_lock():
+            self.connections[self.slot] -= 1
+
+    def _accept_call(self, session, listener=None):
+        try:
+            super(_PreforkWorkerServer, self)._accept_call(session, listener)
+        except BaseException:
+            self._release()
+            raise
+
+    def _handle_call_finish(self, handler):
+        try:
+            super(_PreforkWorkerServer, self)._handle_call_finish(handler)
+        finally:
+            self._release()
+
+
+class PreforkOutboundESLServer(object):
+    """Run an OutboundESLServer in each of several forked worker processes.
+
+    Every worker listens on the same ports with SO_REUSEPORT, so the kernel
+    balances calls across them. Workers that die are restarted after
+    restart_delay seconds. Workers failing before they listen, like when
+    the ports can not be bound, are restarted with a delay doubled after
+    each failure up to max_restart_delay, and the server stops after
+    max_start_failures of them in a row. max_total_connections limits the
+    calls of all workers together, on top of max_connections of each one.
+    server_kwargs are passed to OutboundESLServer.
+
+    SIGTERM, SIGINT or stop() make the workers stop accepting calls and
+    listen returns once they ended their calls. Workers are forked from the
+    listen greenlet, call it before starting anything else in the process.
+    """
+
+    max_restart_delay = 60
+    max_start_failures = 5
+    # Exit status of workers which failed before listening.
+    _start_failed_status = 3
+
+    def __init__(self, workers=None, max_total_connections=None,
+                 restart_delay=1, **server_kwargs):
+        if not server_kwargs.get('application'):
+            raise ValueError('You need an Application to control your calls.')
+        if server_kwargs.get('handoff_path'):
+            # Workers share their ports, a new deployment can start its
+            # own workers before this one stops.
+            raise ValueError('handoff_path is not supported by '
+                             'PreforkOutboundESLServer.')
+        # Workers always set it.
+        server_kwargs.pop('reuse_port', None)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.max_total_connections = max_total_connections
+        self.restart_delay = restart_delay
+        self.server_kwargs = server_kwargs
+        # Calls of each worker, in memory shared with them.
+        self._connections = multiprocessing.Array('i', self.workers)
+        # Worker slot by pid, a worker leaves only after exiting.
+        self.pids = {}
+        # Failures in a row of the workers of each slot before listening.
+        self._start_failures = [0] * self.workers
+        self._running = False
+        self._stopped = Event()
+        self._signal_handlers = []
+
+    @property
+    def connection_count(self):
+        return sum(self._connections.get_obj())
+
+    def listen(self):
+        self._running = True
+        self._stopped.clear()
+        self._signal_handlers = [gevent.signal_handler(signum, self.stop)
+                                 for signum in (signal.SIGTERM, signal.SIGINT)]
+        try:
+            for slot in range(self.workers):
+                self._spawn_worker(slot)
+            self._stopped.wait()
+        finally:
+            for handler in self._signal_handlers:
+                handler.cancel()
+        logging.info('PreforkOutboundESLServer stopped')
+
+    def _spawn_worker(self, slot):
+        if not self._running:
+            return
+        pid = gevent.os.fork_and_watch(self._worker_exited, ref=True)
+        if pid == 0:
+            self._run_worker(slot)
+        self.pids[pid] = slot
+        logging.info('Started worker %s' % pid)
+
+    def _run_worker(self, slot):
+        """Serve calls in the worker process, never returns."""
+        status = self._start_failed_status
+        server = None
+        try:
+            for handler in self._signal_handlers:
+                handler.cancel()
+            self.pids.clear()
+            self._running = False
+            server = _PreforkWorkerServer(self._connections, slot,
+                                          self.max_total_connections,
+                                          **self.server_kwargs)
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                gevent.signal_handler(signum, server.stop)
+            server.listen()
+            status = 0
+        except BaseException:
+            logging.exception('Worker %s failed' % os.getpid())
+            # _bind exits when no port could be bound.
+            if server is not None and server.listeners:
+                status = 1
+        finally:
+            os._exit(status)
+
+    def _worker_exited(self, watcher):
+        slot = self.pids.pop(watcher.pid)
+        # Calls of a killed worker never release their slots.
+        with self._connections.get_lock():
+            self._connections[slot] = 0
+        if not self._running:
+            if not self.pids:
+                self._stopped.set()
+            return
+        delay = self.restart_delay
+        if os.WIFEXITED(watcher.rstatus) and \
+                os.WEXITSTATUS(watcher.rstatus) == self._start_failed_status:
+            self._start_failures[slot] += 1
+            failures = self._start_failures[slot]
+            if failures >= self.max_start_failures:
+                logging.error('Worker %s failed to start %s times in a row, '
+                              'stopping' % (watcher.pid, failures))
+                self.stop()
+                return
+            delay = min(delay * 2 ** failures, self.max_restart_delay)
+        else:
+            self._start_failures[slot] = 0
+        logging.error('Worker %s exited with status %s, restarting in '
+                      '%s seconds' % (watcher.pid, watcher.rstatus, delay))
+        gevent.spawn_later(delay, self._spawn_worker, slot)
 
+    def stop(self):
+        """Stop accepting calls and wait for the workers to end theirs."""
+        self._running = False
+        if not self.pids:
+            self._stopped.set()
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
@@ -13,6 +13,7 @@ class FakeESLServer(object):
         self._client_socket = None
         self._running = False
         self.commands = {}
+        self.requests = []
         self.setup_commands()
 
     def setup_commands(self):
@@ -20,6 +21,13 @@ class FakeESLServer(object):
                                                          'B01L00:kesOk,sync\n' +
                                                          'B01L01:[ksigInactive]\n')
         self.commands['api fake show-special-chars'] = u'%^ć%$éí#$'
+        self.commands['event plain ALL'] = '+OK event listener enabled plain'
+        self.commands['event plain BACKGROUND_JOB'] = \
+            '+OK event listener enabled plain'
+        self.commands['event json CHANNEL_CREATE CUSTOM sofia::register'] = \
+            '+OK event listener enabled json'
+        self.commands['filter Event-Name HEARTBEAT'] = \
+            '+OK filter added. [Event-Name]=[HEARTBEAT]'
 
     def start_server(self):
         self.server = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
@@ -47,6 +55,7 @@ class FakeESLServer(object):
         self._client_socket.send(data.encode('utf-8'))
 
     def handle_request(self, request):
+        self.requests.append(request)
         if request.startswith('auth'):
             received_password = request.split()[-1].strip()
             if received_password == self._password:
@@ -54,6 +63,14 @@ class FakeESLServer(object):
             else:
                 self.command_reply('-ERR invalid')
                 self.disconnect()
+        elif request.startswith('bgapi'):
+            self.background_job(request)
+        elif request == 'api fake slow':
+            time.sleep(0.3)
+            self.api_response('+OK slow')
+        elif request == 'api fake no-reply':
+            # Lets tests drop the connection with a reply pending.
+            pass
         elif request == 'exit':
             self.command_reply('+OK bye')
             self.disconnect()
@@ -91,12 +108,33 @@ class FakeESLServer(object):
                 break
             self.handle_request(request)
 
+    def background_job(self, request):
+        command, job_uuid = request.split('\nJob-UUID: ')
+        command = 'api %s' % command[len('bgapi '):]
+        self.command_reply('+OK Job-UUID: %s' % job_uuid)
+        # Jobs of commands unknown by the server never complete.
+        if command not in self.commands:
+            return
+        data = self.commands[command]
+        body = ('Event-Name: BACKGROUND_JOB\n'
+                'Job-UUID: %s\n'
+                'Job-Command: %s\n'
+                'Content-Length: %d\n\n' % (job_uuid, command,
+                                             len(data.encode('utf-8'))))
+        self.fake_event_plain(body.encode('utf-8') + data.encode('utf-8'))
+
     def fake_event_plain(self, data):
         data_length = len(data)
         self.protocol_send(['Content-Type: text/event-plain',
                             'Content-Length: %s' % data_length])
         self._client_socket.send(data)
 
+    def fake_event_json(self, data):
+        data_length = len(data)
+        self.protocol_send(['Content-Type: text/event-json',
+                            'Content-Length: %s' % data_length])
+        self._client_socket.send(data)
+
     def fake_raw_event_plain(self, data):
         self._client_socket.send(data)
 
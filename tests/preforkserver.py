@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Runs a PreforkOutboundESLServer, usage:
+
+    preforkserver.py PORT WORKERS [MAX_TOTAL_CONNECTIONS]
+"""
+
+from gevent import monkey; monkey.patch_all()
+
+import os
+import sys
+
+from greenswitch import esl
+
+
+class Application(object):
+    def __init__(self, session):
+        self.session = session
+
+    def run(self):
+        self.session.myevents()
+        # Tells the test which worker handled the call.
+        self.session.send('getpid %s' % os.getpid())
+
+
+if __name__ == '__main__':
+    max_total_connections = None
+    if len(sys.argv) > 3:
+        max_total_connections = int(sys.argv[3])
+    server = esl.PreforkOutboundESLServer(
+        workers=int(sys.argv[2]), max_total_connections=max_total_connections,
+        restart_delay=0.1,
+        # Workers set reuse_port themselves, passing it too must work.
+        reuse_port=True,
+        bind_port=int(sys.argv[1]), application=Application)
+    server.listen()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import functools
+from textwrap import dedent
+import unittest
+
+from greenswitch import aioesl
+from greenswitch import esl
+from tests import fakeeslserver
+
+
+class AsyncTestCase(unittest.TestCase):
+    """Runs asyncSetUp, the test coroutine and asyncTearDown in a new event
+    loop, like IsolatedAsyncioTestCase which needs Python 3.8."""
+
+    def __init__(self, methodName='runTest'):
+        super(AsyncTestCase, self).__init__(methodName)
+        test = getattr(self, methodName, None)
+        if asyncio.iscoroutinefunction(test):
+            setattr(self, methodName, functools.partial(self._run, test))
+
+    def _run(self, test):
+        self.loop.run_until_complete(test())
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.asyncSetUp())
+
+    def tearDown(self):
+        try:
+            self.loop.run_until_complete(self.asyncTearDown())
+        finally:
+            all_tasks = getattr(asyncio, 'all_tasks', None) or \
+                asyncio.Task.all_tasks
+            tasks = [task for task in all_tasks(self.loop) if not task.done()]
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+            asyncio.set_event_loop(None)
+
+    async def asyncSetUp(self):
+        pass
+
+    async def asyncTearDown(self):
+        pass
+
+
+class TestAsyncInboundESL(AsyncTestCase):
+
+    async def asyncSetUp(self):
+        self.switch_esl = fakeeslserver.FakeESLServer('0.0.0.0', 8021, 'ClueCon')
+        self.switch_esl.start_server()
+        self.esl = aioesl.AsyncInboundESL('127.0.0.1', 8021, 'ClueCon')
+        await self.esl.connect()
+
+    async def asyncTearDown(self):
+        await self.esl.stop()
+        self.switch_esl.stop()
+
+    async def send_fake_event_plain(self, data):
+        self.switch_esl.fake_event_plain(data.encode('utf-8'))
+        await asyncio.sleep(0.1)
+
+    async def test_connect(self):
+        """Should connect and authenticate in FreeSWITCH ESL Server."""
+        self.assertTrue(self.esl.connected)
+        self.assertTrue(self.esl.connection.authenticated)
+
+    async def test_connect_wrong_password(self):
+        """Should raises ValueError when using wrong ESL password."""
+        switch_esl = fakeeslserver.FakeESLServer('0.0.0.0', 8022, 'ClueCon')
+        switch_esl.start_server()
+        esl_ = aioesl.AsyncInboundESL('127.0.0.1', 8022, 'wrongpassword')
+        with self.assertRaises(ValueError):
+            await esl_.connect()
+        await esl_.stop()
+        switch_esl.stop()
+        self.assertFalse(esl_.connected)
+
+    async def test_api(self):
+        """Should properly read api response from ESL."""
+        response = await self.esl.api('khomp show links concise')
+        self.assertEqual('api/response', response.headers['Content-Type'])
+        self.assertEqual(self.switch_esl.commands['api khomp show links concise'],
+                         response.data)
+
+    async def test_concurrent_send(self):
+        """Should correlate replies of concurrent commands in order."""
+        responses = await asyncio.gather(
+            self.esl.send('unknown_command'),
+            self.esl.api('fake show-special-chars'),
+            self.esl.subscribe())
+        self.assertEqual('-ERR command not found', responses[0].data)
+        self.assertEqual(self.switch_esl.commands['api fake show-special-chars'],
+                         responses[1].data)
+        self.assertEqual('+OK event listener enabled plain', responses[2].data)
+
+    async def test_send_timeout(self):
+        """Should raise on timeout and keep correlating later replies."""
+        with self.assertRaises(esl.CommandTimeoutError):
+            await self.esl.send('api fake slow', timeout=0.1)
+        response = await self.esl.send('api fake show-special-chars', timeout=1)
+        self.assertEqual(self.switch_esl.commands['api fake show-special-chars'],
+                         response.data)
+        self.assertEqual(self.esl.connection.pending_count, 0)
+
+    async def test_send_many(self):
+        """Should pipeline several commands and return their futures."""
+        futures = self.esl.send_many(['unknown_command', 'event plain ALL'])
+        responses = await asyncio.gather(*futures)
+        self.assertEqual([r.data for r in responses], [
+            '-ERR command not found', '+OK event listener enabled plain'])
+
+    async def test_bgapi(self):
+        """Should resolve bgapi futures with their BACKGROUND_JOB events."""
+        slow = self.esl.bgapi('fake never-completes', timeout=0.2)
+        event = await asyncio.wait_for(
+            self.esl.bgapi('fake show-special-chars'), 1)
+        self.assertEqual(event.data,
+                         self.switch_esl.commands['api fake show-special-chars'])
+        with self.assertRaises(esl.CommandTimeoutError):
+            await slow
+        self.assertFalse(self.esl.connection.background_jobs)
+
+    async def test_bgapi_cancel(self):
+        """Should forget jobs whose futures were cancelled."""
+        future = self.esl.bgapi('fake never-completes')
+        future.cancel()
+        await asyncio.sleep(0)
+        self.assertFalse(self.esl.connection.background_jobs)
+
+    async def test_coroutine_and_plain_handlers(self):
+        """Should call both coroutine and plain handlers."""
+        events = []
+
+        async def on_heartbeat(event):
+            await asyncio.sleep(0)
+            events.append(event)
+
+        self.esl.register_handle('HEARTBEAT', on_heartbeat)
+        self.esl.register_handle('HEARTBEAT', events.append)
+        await self.send_fake_event_plain('Event-Name: HEARTBEAT')
+        self.assertEqual(len(events), 2)
+
+    async def test_events_iterator(self):
+        """Should deliver every event to async iterators."""
+        async def consume():
+            async for event in self.esl:
+                return event
+
+        consumer = asyncio.ensure_future(consume())
+        await asyncio.sleep(0)
+        await self.send_fake_event_plain(dedent("""\
+            Event-Name: CUSTOM
+            Event-Subclass: sofia::register"""))
+        event = await asyncio.wait_for(consumer, 1)
+        self.assertEqual(event.headers['Event-Subclass'], 'sofia::register')
+        self.assertFalse(self.esl._event_iterators)
+
+    async def test_skip_unhandled_events(self):
+        """Should keep delivering every event to async iterators."""
+        self.esl.skip_unhandled_events = True
+        await self.send_fake_event_plain('Event-Name: HEARTBEAT')
+        self.assertEqual(self.esl.connection.skipped_events, 1)
+
+        async def consume():
+            async for event in self.esl:
+                return event
+
+        consumer = asyncio.ensure_future(consume())
+        await asyncio.sleep(0)
+        await self.send_fake_event_plain('Event-Name: HEARTBEAT')
+        event = await asyncio.wait_for(consumer, 1)
+        self.assertEqual(event.headers['Event-Name'], 'HEARTBEAT')
+        self.assertEqual(self.esl.connection.skipped_events, 1)
+        self.assertEqual(self.esl.connection.wanted_events, frozenset())
+
+    async def test_server_disconnect(self):
+        """Should detect server disconnection and fail new commands."""
+        self.switch_esl.stop()
+        await asyncio.sleep(0.1)
+        self.assertFalse(self.esl.connected)
+        with self.assertRaises(esl.NotConnectedError):
+            await self.esl.send('api status')
+
+    async def test_server_disconnect_with_bgapi_pending(self):
+        """Should fail commands and jobs whose replies were pending."""
+        slow = asyncio.ensure_future(self.esl.send('api fake slow'))
+        await asyncio.sleep(0)
+        job = self.esl.bgapi('fake show-special-chars')
+        await asyncio.sleep(0.05)
+        self.switch_esl.stop()
+        await asyncio.sleep(0.1)
+        with self.assertRaises(esl.NotConnectedError):
+            await slow
+        with self.assertRaises(esl.NotConnectedError):
+            await job
+        self.assertIsNone(self.esl._receive_events_task.exception())
+
+
+class FakeOutboundChannel(object):
+    """Plays FreeSWITCH's side of an outbound socket connection."""
+
+    def __init__(self, reader, writer, digits='1'):
+        self.reader = reader
+        self.writer = writer
+        self.digits = digits
+        self.commands = []
+
+    def command_reply(self, text, extra=''):
+        self.writer.write(('Content-Type: command/reply\nReply-Text: %s\n%s\n'
+                           % (text, extra)).encode('utf-8'))
+
+    def execute_complete(self, app_name, event_uuid):
+        body = ('Event-Name: CHANNEL_EXECUTE_COMPLETE\n'
+                'Application-UUID: %s\n'
+                'variable_current_application: %s\n'
+                'variable_test: %s\n' % (event_uuid, app_name, self.digits))
+        self.writer.write(('Content-Type: text/event-plain\n'
+                           'Content-Length: %d\n\n%s'
+                           % (len(body), body)).encode('utf-8'))
+
+    async def run(self):
+        while True:
+            try:
+                command = await self.reader.readuntil(b'\n\n')
+            except asyncio.IncompleteReadError:
+                return
+            command = command.decode('utf-8').strip()
+            self.commands.append(command)
+            if command == 'connect':
+                self.command_reply('+OK', 'variable_uuid: abc\n'
+                                          'Caller-Caller-ID-Number: 100\n')
+            elif command == 'exit':
+                self.command_reply('+OK bye')
+                self.writer.close()
+                return
+            elif command.startswith('sendmsg'):
+                self.command_reply('+OK')
+                headers = dict(line.split(': ', 1)
+                               for line in command.splitlines()[1:])
+                app_name = headers['execute-app-name']
+                if app_name in ('playback', 'play_and_get_digits'):
+                    self.execute_complete(app_name, headers.get('Event-UUID'))
+            else:
+                self.command_reply('+OK')
+
+
+class TestAsyncOutboundESLServer(AsyncTestCase):
+
+    async def asyncSetUp(self):
+        self.results = results = []
+
+        class Application(object):
+            def __init__(self, session):
+                self.session = session
+
+            async def run(self):
+                await self.session.myevents()
+                await self.session.linger()
+                await self.session.answer()
+                await self.session.playback('ivr/ivr-welcome')
+                digit = await self.session.play_and_get_digits(
+                    1, 1, 3, 5000, '#', 'prompt.wav', 'invalid.wav', 'test',
+                    '\\d', 1000, "''", response_timeout=1)
+                results.append((self.session.uuid, digit))
+                await self.session.hangup()
+
+        self.server = aioesl.AsyncOutboundESLServer(
+            bind_port=[8023, 8024], application=Application)
+        self.listen = asyncio.ensure_future(self.server.listen())
+        while not self.server._running:
+            await asyncio.sleep(0.01)
+
+    async def asyncTearDown(self):
+        self.server.stop()
+        await asyncio.wait_for(self.listen, 1)
+
+    async def call(self):
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', self.server.bound_port)
+        channel = FakeOutboundChannel(reader, writer)
+        await asyncio.wait_for(channel.run(), 2)
+        return channel
+
+    async def test_call(self):
+        """Should run the application for every call."""
+        channels = await asyncio.gather(self.call(), self.call())
+        self.assertEqual(self.results, [('abc', '1'), ('abc', '1')])
+        self.assertEqual(channels[0].commands[:3],
+                         ['connect', 'myevents', 'linger'])
+        self.assertEqual(channels[0].commands[-1], 'exit')
+        self.assertEqual(self.server.connection_count, 0)
+
+    async def test_reject_over_capacity(self):
+        """Should hang up calls over max_connections."""
+        self.server.max_connections = 0
+        channel = await self.call()
+        self.assertEqual(channel.commands, ['connect', 'exit'])
+        self.assertEqual(self.results, [])
+        self.assertEqual(self.server.rejected, 1)
+
+    async def test_reject_hangup_cause(self):
+        """Should hang up rejected calls with reject_hangup_cause."""
+        self.server.max_connections = 0
+        self.server.reject_hangup_cause = 'CALL_REJECTED'
+        channel = await self.call()
+        self.assertEqual(channel.commands[1].splitlines()[-1],
+                         'execute-app-arg: CALL_REJECTED')
+        self.assertEqual(channel.commands[-1], 'exit')
+
+    async def test_handshake(self):
+        """Should pipeline the handshake and skip repeated commands."""
+        self.server.handshake = ['myevents', 'linger']
+        channel = await self.call()
+        self.assertEqual(self.results, [('abc', '1')])
+        self.assertEqual(channel.commands[:3],
+                         ['connect', 'myevents', 'linger'])
+        self.assertEqual(channel.commands.count('myevents'), 1)
+        self.assertEqual(channel.commands.count('linger'), 1)
+
+    async def test_listen_all(self):
+        """Should accept calls on every configured port."""
+        self.server.stop()
+        await asyncio.wait_for(self.listen, 1)
+        self.server = aioesl.AsyncOutboundESLServer(
+            bind_port=[8023, 8024], application=self.server.application,
+            listen_all=True, backlog=512)
+        self.listen = asyncio.ensure_future(self.server.listen())
+        while not self.server._running:
+            await asyncio.sleep(0.01)
+        self.assertEqual(sorted(self.server.listener_connections),
+                         [('127.0.0.1', 8023), ('127.0.0.1', 8024)])
+        for port in (8023, 8024):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            channel = FakeOutboundChannel(reader, writer)
+            await asyncio.wait_for(channel.run(), 2)
+        self.assertEqual(len(self.results), 2)
+        self.assertEqual(self.server.listener_connections,
+                         {('127.0.0.1', 8023): 0, ('127.0.0.1', 8024): 0})
+
+    async def test_listener_connections_wildcard(self):
+        """Should count calls of listeners bound to a wildcard address."""
+        self.server.stop()
+        await asyncio.wait_for(self.listen, 1)
+        counts = []
+
+        class Application(object):
+            def __init__(self, session):
+                self.session = session
+
+            async def run(self):
+                counts.append(dict(server.listener_connections))
+
+        server = self.server = aioesl.AsyncOutboundESLServer(
+            bind_address='0.0.0.0', bind_port=8023, application=Application)
+        self.listen = asyncio.ensure_future(self.server.listen())
+        while not self.server._running:
+            await asyncio.sleep(0.01)
+        await self.call()
+        self.assertEqual(counts, [{('0.0.0.0', 8023): 1}])
+        self.assertEqual(server.listener_connections, {('0.0.0.0', 8023): 0})
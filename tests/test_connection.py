@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from greenswitch import connection
+
+
+class ESLConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = connection.ESLConnection(buffer_size=16)
+        self.connection.connected = True
+
+    def test_headers_across_chunks(self):
+        """
+        `next_event` joins header blocks split across several
+        `receive_data` calls, including a split blank line separator.
+        """
+        self.connection.receive_data(b'Content-Type: auth/req')
+        self.assertEqual(self.connection.next_event()[0], connection.NEED_DATA)
+        self.connection.receive_data(b'uest\n')
+        self.assertEqual(self.connection.next_event()[0], connection.NEED_DATA)
+        self.connection.receive_data(b'\n')
+        kind, event, token = self.connection.next_event()
+        self.assertEqual(kind, connection.AUTH_REQUEST)
+        self.assertEqual(event.headers['Content-Type'], 'auth/request')
+        self.assertTrue(self.connection.auth_requested)
+
+    def test_body_after_headers(self):
+        """
+        `next_event` waits for the whole "Content-Length" body, growing
+        the buffer for bodies larger than it.
+        """
+        body = b'Event-Name: HEARTBEAT\nEvent-Info: System%20Ready\n'
+        self.connection.receive_data(
+            b'Content-Type: text/event-plain\nContent-Length: %d\n\n' %
+            len(body) + body[:10])
+        self.assertEqual(self.connection.next_event()[0], connection.NEED_DATA)
+        self.connection.receive_data(body[10:])
+        kind, event, token = self.connection.next_event()
+        self.assertEqual(kind, connection.EVENT)
+        self.assertEqual(event.headers['Event-Info'], 'System Ready')
+        self.assertEqual(self.connection.buffered, 0)
+
+    def test_skip_unwanted_events(self):
+        """
+        Plain events not in `wanted_events` are dropped without parsing.
+        """
+        self.connection.wanted_events = frozenset(['sofia::register'])
+        for body in [b'Event-Name: HEARTBEAT\n',
+                     b'Event-Name: CUSTOM\nEvent-Subclass: sofia%3A%3Aexpire\n',
+                     b'Event-Name: CUSTOM\nEvent-Subclass: sofia%3A%3Aregister\n']:
+            self.connection.receive_data(
+                b'Content-Type: text/event-plain\nContent-Length: %d\n\n' %
+                len(body) + body)
+        kind, event, token = self.connection.next_event()
+        self.assertEqual(event.headers['Event-Subclass'], 'sofia::register')
+        self.assertEqual(self.connection.skipped_events, 2)
+        self.assertEqual(self.connection.next_event()[0], connection.NEED_DATA)
+
+    def test_get_buffer(self):
+        """
+        Bytes written in `get_buffer()` are parsed after `buffer_updated`.
+        """
+        data = b'Content-Type: command/reply\nReply-Text: +OK\n\n'
+        buffer = self.connection.get_buffer(len(data))
+        buffer[:len(data)] = data
+        self.connection.buffer_updated(len(data))
+        self.assertEqual(self.connection.next_event()[0], connection.REPLY)
+
+    def test_replies_are_correlated_in_order(self):
+        """
+        Replies return the tokens given to `send` in the same order.
+        """
+        self.assertEqual(self.connection.send('api status', 'first'),
+                         b'api status\n\n')
+        self.connection.send('noop', 'second')
+        self.connection.receive_data(
+            b'Content-Type: api/response\nContent-Length: 3\n\n+OK'
+            b'Content-Type: command/reply\nReply-Text: -ERR\n\n')
+        kind, event, token = self.connection.next_event()
+        self.assertEqual((kind, event.data, token),
+                         (connection.REPLY, '+OK', 'first'))
+        kind, event, token = self.connection.next_event()
+        self.assertEqual((kind, event.data, token),
+                         (connection.REPLY, '-ERR', 'second'))
+        self.assertFalse(self.connection.pending)
+
+    def test_send_many(self):
+        """
+        `send_many` returns a single batch and queues every token.
+        """
+        self.assertEqual(self.connection.send_many(['noop', 'api status'],
+                                                   ['first', 'second']),
+                         b'noop\n\napi status\n\n')
+        self.assertEqual(list(self.connection.pending), ['first', 'second'])
+        with self.assertRaises(ValueError):
+            self.connection.send_many(['noop'], [])
+
+    def test_pending_age(self):
+        """
+        `pending_age` measures the wait of the oldest unanswered command.
+        """
+        self.assertEqual(self.connection.pending_age(), 0)
+        self.connection.send('noop', 'first')
+        self.connection.send('noop', 'second')
+        sent_at = self.connection._pending_since[0]
+        self.assertEqual(self.connection.pending_count, 2)
+        self.assertEqual(self.connection.pending_age(sent_at + 2), 2)
+        self.connection.receive_data(
+            b'Content-Type: command/reply\nReply-Text: +OK\n\n')
+        self.connection.next_event()
+        self.assertEqual(self.connection.pending_count, 1)
+        self.assertEqual(self.connection.clear_pending(), ['second'])
+        self.assertEqual(self.connection.pending_age(), 0)
+
+    def test_replay_commands(self):
+        """
+        `replay_commands` restores the subscriptions, filters and myevents.
+        """
+        self.connection.send_many([
+            'myevents d0b1da34', 'event plain CHANNEL_CREATE CUSTOM a::b c::d',
+            'nixevent CUSTOM c::d', 'filter Unique-ID d0b1da34',
+            'filter Event-Name HEARTBEAT', 'filter delete Unique-ID'])
+        self.assertEqual(self.connection.replay_commands(), [
+            'myevents d0b1da34', 'event plain CHANNEL_CREATE CUSTOM a::b',
+            'filter Event-Name HEARTBEAT'])
+
+    def test_subscription_commands(self):
+        """
+        `subscription_commands` only sends the differences with the
+        current subscriptions and filters.
+        """
+        self.assertEqual(
+            self.connection.subscription_commands(
+                ['HEARTBEAT'], ['a::b'], [('Unique-ID', 'x')]),
+            ['event plain HEARTBEAT CUSTOM a::b', 'filter Unique-ID x'])
+        self.connection.send_many(self.connection.subscription_commands(
+            ['HEARTBEAT'], ['a::b'], [('Unique-ID', 'x')]))
+        self.assertEqual(
+            self.connection.subscription_commands(['CHANNEL_CREATE'], ['a::b']),
+            ['event plain CHANNEL_CREATE', 'nixevent HEARTBEAT',
+             'filter delete Unique-ID x'])
+        self.connection.send('filter delete Unique-ID x')
+        self.connection.send('event plain ALL')
+        self.assertEqual(
+            self.connection.subscription_commands(['HEARTBEAT']),
+            ['noevents', 'event plain HEARTBEAT'])
+
+    def test_subscription_commands_with_all(self):
+        """
+        `subscription_commands` never sends nixevent while ALL is wanted,
+        it would unsubscribe ALL.
+        """
+        self.connection.send_many(
+            self.connection.subscription_commands(['CHANNEL_ANSWER']))
+        self.assertEqual(
+            self.connection.subscription_commands(['CHANNEL_ANSWER', 'ALL']),
+            ['event plain ALL'])
+        self.connection.send('event plain ALL')
+        self.assertEqual(self.connection.subscription_commands(['ALL']), [])
+        self.assertEqual(self.connection.subscribed_events, {'ALL'})
+        self.assertEqual(self.connection.subscription_commands([]),
+                         ['noevents'])
+
+    def test_bgapi_with_filters(self):
+        """
+        `bgapi` keeps BACKGROUND_JOB subscribed and let through filters.
+        """
+        self.connection.send('filter Unique-ID x')
+        self.connection.bgapi('status', 'job-uuid')
+        self.assertIn(('Event-Name', 'BACKGROUND_JOB'), self.connection.filters)
+        self.assertEqual(
+            self.connection.subscription_commands(
+                ['HEARTBEAT'], filters=[('Unique-ID', 'x')]),
+            ['event plain HEARTBEAT'])
+
+    def test_reset(self):
+        """
+        `reset` returns the tokens nobody will answer and keeps subscriptions.
+        """
+        self.connection.send('event plain ALL', 'first')
+        self.connection.bgapi('status', 'job-uuid', 'job')
+        self.connection.receive_data(b'Content-Type: command/re')
+        self.assertEqual(self.connection.reset(), ['first', 'job'])
+        self.assertFalse(self.connection.connected)
+        self.assertEqual(self.connection.buffered, 0)
+        self.assertEqual(self.connection.replay_commands(),
+                         ['event plain ALL'])
+
+    def test_bgapi(self):
+        """
+        `bgapi` subscribes to BACKGROUND_JOB and returns the token with
+        the event of the job, whose body is the command output.
+        """
+        self.assertEqual(
+            self.connection.bgapi('status', 'job-1', 'token'),
+            b'event plain BACKGROUND_JOB\n\nbgapi status\nJob-UUID: job-1\n\n')
+        body = (b'Event-Name: BACKGROUND_JOB\nJob-UUID: job-1\n'
+                b'Content-Length: 4\n\n+OK\n')
+        self.connection.receive_data(
+            b'Content-Type: command/reply\nReply-Text: +OK\n\n'
+            b'Content-Type: command/reply\nReply-Text: +OK Job-UUID: job-1\n\n'
+            b'Content-Type: text/event-plain\nContent-Length: %d\n\n' %
+            len(body) + body)
+        self.assertEqual(self.connection.next_event()[2], None)
+        self.assertEqual(self.connection.next_event()[2], None)
+        kind, event, token = self.connection.next_event()
+        self.assertEqual((kind, token), (connection.EVENT, 'token'))
+        self.assertEqual(event.data, '+OK\n')
+        self.assertEqual(event.headers['Content-Length'], '4')
+        self.assertFalse(self.connection.background_jobs)
+
+    def test_bgapi_refused(self):
+        self.connection.subscribed_events.add('ALL')
+        self.assertEqual(self.connection.bgapi('status', 'job-1', 'token'),
+                         b'bgapi status\nJob-UUID: job-1\n\n')
+        self.connection.receive_data(
+            b'Content-Type: command/reply\nReply-Text: -ERR\n\n')
+        self.assertEqual(self.connection.next_event()[2], 'token')
+        self.assertFalse(self.connection.background_jobs)
+
+    def test_send_not_connected(self):
+        self.connection.connected = False
+        with self.assertRaises(connection.NotConnectedError):
+            self.connection.send('api status')
+
+    def test_auth(self):
+        self.assertEqual(self.connection.auth('ClueCon'), b'auth ClueCon\n\n')
+        self.connection.receive_data(
+            b'Content-Type: command/reply\nReply-Text: +OK accepted\n\n')
+        self.connection.next_event()
+        self.assertTrue(self.connection.authenticated)
+
+    def test_disconnect_notice(self):
+        self.connection.receive_data(
+            b'Content-Type: text/disconnect-notice\nContent-Length: 23\n\n'
+            b'Disconnected, goodbye.\n')
+        kind, event, token = self.connection.next_event()
+        self.assertEqual(kind, connection.DISCONNECT)
+        self.assertEqual(event.data, 'Disconnected, goodbye.\n')
+        self.assertFalse(self.connection.connected)
+
+    def test_closed(self):
+        """
+        `next_event` reports CLOSED once EOF was fed and no complete
+        message is left.
+        """
+        self.connection.receive_data(b'Content-Type: auth/request\n\nContent')
+        self.connection.receive_data(b'')
+        self.assertEqual(self.connection.next_event()[0],
+                         connection.AUTH_REQUEST)
+        self.assertEqual(self.connection.next_event()[0], connection.CLOSED)
+
+    def test_lazy_events(self):
+        self.connection.lazy_events = True
+        self.connection.receive_data(
+            b'Content-Type: text/event-plain\nContent-Length: 22\n\n'
+            b'Event-Name: HEARTBEAT\n')
+        kind, event, token = self.connection.next_event()
+        self.assertIsInstance(event, connection.LazyESLEvent)
+        self.assertEqual(event.headers['Event-Name'], 'HEARTBEAT')
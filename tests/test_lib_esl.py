@@ -7,7 +7,10 @@ except ImportError:
     import mock
 
 from textwrap import dedent
+import functools
+import json
 import types
+import unittest
 
 import gevent
 
@@ -44,6 +47,63 @@ class TestInboundESL(TestInboundESLBase):
         self.assertFalse(esl_.connected)
         esl_.stop()
 
+    def test_auto_reconnect_wrong_password(self):
+        """Should not reconnect when the first connect fails."""
+        switch_esl = fakeeslserver.FakeESLServer('0.0.0.0', 8022, 'ClueCon')
+        switch_esl.start_server()
+        esl_ = esl.InboundESL('127.0.0.1', 8022, 'wrongpassword',
+                              auto_reconnect=True)
+        esl_.reconnect_delay = 0.1
+        self.assertRaises(ValueError, esl_.connect)
+        gevent.sleep(0.3)
+        self.assertIsNone(esl_._reconnect_greenlet)
+        self.assertEqual(switch_esl.requests, ['auth wrongpassword'])
+        switch_esl.stop()
+        esl_.stop()
+
+    def test_auto_reconnect(self):
+        """Should reconnect and replay subscriptions and filters."""
+        switch_esl = fakeeslserver.FakeESLServer('0.0.0.0', 8022, 'ClueCon')
+        switch_esl.start_server()
+        esl_ = esl.InboundESL('127.0.0.1', 8022, 'ClueCon', auto_reconnect=True)
+        esl_.reconnect_delay = 0.1
+        esl_.connect()
+        esl_.subscribe(['CHANNEL_CREATE', 'CUSTOM', 'sofia::register'], 'json')
+        esl_.send('filter Event-Name HEARTBEAT')
+        reconnected = gevent.event.Event()
+        esl_.register_handle('RECONNECT', lambda event: reconnected.set())
+        switch_esl.stop()
+        gevent.sleep(0.3)
+        self.assertFalse(esl_.connected)
+
+        switch_esl = fakeeslserver.FakeESLServer('0.0.0.0', 8022, 'ClueCon')
+        switch_esl.start_server()
+        self.assertTrue(reconnected.wait(2))
+        self.assertTrue(esl_.connected)
+        self.assertEqual(switch_esl.requests, [
+            'auth ClueCon',
+            'event json CHANNEL_CREATE CUSTOM sofia::register',
+            'filter Event-Name HEARTBEAT'])
+        response = esl_.send('api fake show-special-chars')
+        self.assertEqual(switch_esl.commands['api fake show-special-chars'],
+                         response.data)
+        esl_.stop()
+        switch_esl.stop()
+
+    def test_auto_reconnect_fails_pending_at_once(self):
+        """Should fail pending commands before the reconnect delay."""
+        switch_esl = fakeeslserver.FakeESLServer('0.0.0.0', 8022, 'ClueCon')
+        switch_esl.start_server()
+        esl_ = esl.InboundESL('127.0.0.1', 8022, 'ClueCon', auto_reconnect=True)
+        esl_.reconnect_delay = 10
+        esl_.connect()
+        pending = esl_.send_async('api fake no-reply')
+        gevent.sleep(0.05)
+        switch_esl.stop()
+        with self.assertRaises(esl.NotConnectedError):
+            pending.get(timeout=1)
+        esl_.stop()
+
     def test_client_disconnect(self):
         """Should disconnect properly."""
         self.esl.stop()
@@ -100,6 +160,138 @@ class TestInboundESL(TestInboundESLBase):
         self.send_fake_event_plain(event_plain)
         self.assertTrue(self.esl.pre_register)
 
+    def test_handler_filters(self):
+        """Should only call handlers with the filtered header values."""
+        events = []
+        self.esl.register_handle('CHANNEL_ANSWER', events.append,
+                                 filters={'Unique-ID': 'abc'})
+        self.send_fake_event_plain(dedent("""\
+            Event-Name: CHANNEL_ANSWER
+            Unique-ID: def"""))
+        self.send_fake_event_plain(dedent("""\
+            Event-Name: CHANNEL_ANSWER
+            Unique-ID: abc"""))
+        self.assertEqual([e.headers['Unique-ID'] for e in events], ['abc'])
+        self.esl.unregister_handle('CHANNEL_ANSWER', events.append)
+        self.assertFalse(self.esl.handler_filters)
+
+    def test_handler_filters_index(self):
+        """Should only dispatch to the per-call handlers of the event."""
+        calls = []
+        for i in range(1000):
+            self.esl.register_handle(
+                'CHANNEL_ANSWER', functools.partial(calls.append, i),
+                filters={'Unique-ID': str(i), 'Caller-Context': 'default'})
+        self.esl.register_handle('CHANNEL_ANSWER', calls.append)
+        event = esl.ESLEvent(dedent("""\
+            Event-Name: CHANNEL_ANSWER
+            Unique-ID: 42
+            Caller-Context: default"""))
+        self.assertEqual(len(self.esl._get_handlers(event)), 2)
+        event.headers['Caller-Context'] = 'public'
+        self.assertEqual(self.esl._get_handlers(event), [calls.append])
+
+    def test_handler_filters_index_update(self):
+        """Should update the dispatch table in place for per-call handlers."""
+        calls = []
+        self.esl.register_handle('CHANNEL_ANSWER', calls.append)
+        event = esl.ESLEvent(dedent("""\
+            Event-Name: CHANNEL_ANSWER
+            Unique-ID: 42"""))
+        handlers = self.esl._get_handlers(event)
+        table = self.esl._dispatch_table
+        per_call = functools.partial(calls.append, 42)
+        self.esl.register_handle('CHANNEL_ANSWER', per_call,
+                                 filters={'Unique-ID': '42'})
+        self.esl.register_handle('CHANNEL_ANSWER', per_call,
+                                 filters={'Unique-ID': '42'})
+        self.esl.register_handle('*', calls.extend)
+        self.assertEqual(self.esl._get_handlers(event),
+                         [calls.append, per_call])
+        self.esl.unregister_handle('CHANNEL_ANSWER', per_call)
+        self.esl.unregister_handle('CHANNEL_ANSWER', calls.append)
+        self.assertEqual(self.esl._get_handlers(event), [calls.extend])
+        self.esl.unregister_handle('*', calls.extend)
+        self.assertIsNone(self.esl._get_handlers(event))
+        self.assertIs(self.esl._dispatch_table, table)
+        self.assertEqual(table, {})
+        # Lists already handed out to the dispatcher are left untouched.
+        self.assertEqual(handlers, [calls.append])
+
+    def test_handler_pool(self):
+        """Should run handlers of different calls concurrently, in order."""
+        self.esl.handler_pool = esl.KeyedPool(size=4, max_pending=10)
+        handled = []
+
+        def on_dtmf(event):
+            if event.headers['DTMF-Digit'] == '1':
+                gevent.sleep(0.2)
+            handled.append(event.headers['DTMF-Digit'])
+
+        self.esl.register_handle('DTMF', on_dtmf)
+        for uuid, digit in [('a', '1'), ('b', '2'), ('a', '3')]:
+            self.switch_esl.fake_event_plain(dedent("""\
+                Event-Name: DTMF
+                Unique-ID: %s
+                DTMF-Digit: %s""" % (uuid, digit)).encode('utf-8'))
+        gevent.sleep(0.1)
+        self.assertEqual(handled, ['2'])
+        self.assertEqual(self.esl.handler_pool.pending, 2)
+        self.assertEqual(self.esl.handler_pool.active_keys, 1)
+        self.esl.handler_pool.join(1)
+        self.assertEqual(handled, ['2', '1', '3'])
+        self.assertEqual(self.esl.handler_pool.completed, 3)
+
+    def test_skip_unhandled_events(self):
+        """Should drop events without handlers before parsing them."""
+        events = []
+        self.esl.skip_unhandled_events = True
+        self.esl.register_handle('HEARTBEAT', events.append)
+        self.send_fake_event_plain('Event-Name: CHANNEL_CREATE')
+        self.send_fake_event_plain('Event-Name: HEARTBEAT')
+        self.assertEqual(len(events), 1)
+        self.assertEqual(self.esl.connection.skipped_events, 1)
+        self.esl.register_handle('*', events.append)
+        self.send_fake_event_plain('Event-Name: CHANNEL_CREATE')
+        self.assertEqual(len(events), 2)
+        self.assertEqual(self.esl.connection.skipped_events, 1)
+
+    def test_wanted_subscriptions_catch_all(self):
+        """Should not filter events when a catch-all handler has no filters."""
+        self.esl.register_handle('*', lambda event: None)
+        self.esl.register_handle('CHANNEL_ANSWER', lambda event: None,
+                                 filters={'Unique-ID': 'abc'})
+        events, subclasses, filters = self.esl._wanted_subscriptions()
+        self.assertEqual(events, {'ALL', 'CHANNEL_ANSWER'})
+        self.assertEqual(filters, [])
+
+    def test_auto_subscribe(self):
+        """Should subscribe to the events of the registered handlers."""
+        switch_esl = fakeeslserver.FakeESLServer('0.0.0.0', 8022, 'ClueCon')
+        switch_esl.start_server()
+        esl_ = esl.InboundESL('127.0.0.1', 8022, 'ClueCon', auto_subscribe=True)
+        esl_.register_handle('HEARTBEAT', lambda event: None)
+        esl_.register_handle('sofia::register', lambda event: None)
+        esl_.register_handle('DISCONNECT', lambda event: None)
+        esl_.connect()
+        on_answer = lambda event: None
+        esl_.register_handle('CHANNEL_ANSWER', on_answer,
+                             filters={'Unique-ID': 'abc'})
+        esl_.unregister_handle('CHANNEL_ANSWER', on_answer)
+        esl_.send('api fake show-special-chars')
+        self.assertEqual(switch_esl.requests[1:-1], [
+            'event plain HEARTBEAT CUSTOM sofia::register',
+            'event plain CHANNEL_ANSWER',
+            'filter Unique-ID abc',
+            'filter Event-Name HEARTBEAT',
+            'filter Event-Subclass sofia::register',
+            'nixevent CHANNEL_ANSWER',
+            'filter delete Unique-ID abc',
+            'filter delete Event-Name HEARTBEAT',
+            'filter delete Event-Subclass sofia::register'])
+        esl_.stop()
+        switch_esl.stop()
+
     def test_event(self):
         """Should call registered handler for events."""
         def on_heartbeat(self, event):
@@ -369,12 +561,342 @@ class TestInboundESL(TestInboundESLBase):
         self.assertEqual('-ERR command not found',
                          response.headers['Reply-Text'])
 
+    def test_send_async(self):
+        """Should return the reply of a command without blocking."""
+        async_response = self.esl.send_async('api khomp show links concise')
+        self.assertEqual(self.switch_esl.commands['api khomp show links concise'],
+                         async_response.get(timeout=1).data)
+
+    def test_send_many(self):
+        """Should pipeline several commands and correlate their replies."""
+        async_responses = self.esl.send_many([
+            'api fake show-special-chars', 'unknown_command', 'event plain ALL'])
+        gevent.joinall(async_responses, timeout=1)
+        self.assertEqual([r.get().data for r in async_responses], [
+            self.switch_esl.commands['api fake show-special-chars'],
+            '-ERR command not found',
+            '+OK event listener enabled plain'])
+
+    def test_send_timeout(self):
+        """Should raise on timeout and keep correlating later replies."""
+        with self.assertRaises(esl.CommandTimeoutError):
+            self.esl.send('api fake slow', timeout=0.1)
+        self.assertEqual(self.esl.connection.pending_count, 1)
+        self.assertGreater(self.esl.connection.pending_age(), 0)
+        response = self.esl.send('api fake show-special-chars', timeout=1)
+        self.assertEqual(self.switch_esl.commands['api fake show-special-chars'],
+                         response.data)
+        self.assertEqual(self.esl.connection.pending_count, 0)
+        self.assertEqual(self.esl.connection.pending_age(), 0)
+
+    def test_bgapi(self):
+        """Should resolve bgapi with its BACKGROUND_JOB event."""
+        async_response = self.esl.bgapi('khomp show links concise')
+        event = async_response.get(timeout=1)
+        self.assertEqual(event.headers['Event-Name'], 'BACKGROUND_JOB')
+        self.assertEqual(event.data,
+                         self.switch_esl.commands['api khomp show links concise'])
+        self.assertIn('BACKGROUND_JOB', self.esl.connection.subscribed_events)
+        self.assertFalse(self.esl.connection.background_jobs)
+
+    def test_bgapi_does_not_block_other_commands(self):
+        """Should keep answering commands while a job is running."""
+        async_response = self.esl.bgapi('fake never-completes')
+        response = self.esl.send('api fake show-special-chars')
+        self.assertEqual(self.switch_esl.commands['api fake show-special-chars'],
+                         response.data)
+        self.assertFalse(async_response.ready())
+
+    def test_bgapi_timeout(self):
+        """Should forget jobs that do not complete before the timeout."""
+        async_response = self.esl.bgapi('fake never-completes', timeout=0.1)
+        with self.assertRaises(esl.CommandTimeoutError):
+            async_response.get(timeout=1)
+        self.assertFalse(self.esl.connection.background_jobs)
+
+    def test_bgapi_cancel(self):
+        """Should forget cancelled jobs and their timeout."""
+        async_response = self.esl.bgapi('fake never-completes')
+        self.assertEqual(len(self.esl.connection.background_jobs), 1)
+        self.assertTrue(self.esl.cancel_bgapi(async_response))
+        self.assertFalse(self.esl.connection.background_jobs)
+        self.assertFalse(self.esl._background_jobs)
+        self.assertFalse(self.esl.cancel_bgapi(async_response))
+        self.assertFalse(async_response.ready())
+
+    def test_bgapi_done_forgets_timeout(self):
+        """Should stop the timeout of jobs once they are done."""
+        async_response = self.esl.bgapi('khomp show links concise')
+        job_uuid, timer = self.esl._background_jobs[async_response]
+        async_response.get(timeout=1)
+        gevent.sleep(0)
+        self.assertTrue(timer.dead)
+        self.assertFalse(self.esl._background_jobs)
+        self.assertFalse(self.esl.cancel_bgapi(async_response))
+
+    def test_subscribe(self):
+        """Should send the event command in the requested format."""
+        response = self.esl.subscribe()
+        self.assertEqual('+OK event listener enabled plain', response.data)
+        response = self.esl.subscribe(
+            ['CHANNEL_CREATE', 'CUSTOM', 'sofia::register'], 'json')
+        self.assertEqual('+OK event listener enabled json', response.data)
+
+    def test_event_json(self):
+        """Should decode text/event-json events into headers."""
+        events = []
+        self.esl.register_handle('CHANNEL_CREATE', events.append)
+        self.send_fake_event_json(json.dumps({
+            'Event-Name': 'CHANNEL_CREATE',
+            'Unique-ID': 'd0b1da34-a727-11e4-9728-6f83a2e5e50a',
+            'variable_sip_full_from': '"edev - 100" <sip:100@192.168.50.4>',
+        }))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].headers['Content-Type'], 'text/event-json')
+        self.assertEqual(events[0].headers['variable_sip_full_from'],
+                         '"edev - 100" <sip:100@192.168.50.4>')
+
+    def test_event_json_custom_decoder(self):
+        """Should decode text/event-json events with the given decoder."""
+        self.esl.json_decoder = mock.Mock(return_value={'Event-Name': 'TEST'})
+        events = []
+        self.esl.register_handle('TEST', events.append)
+        self.send_fake_event_json('{}')
+        self.esl.json_decoder.assert_called_with(b'{}')
+        self.assertEqual(len(events), 1)
+
     def test_event_without_handler(self):
         """Should not break if receive an event without handler."""
         self.send_fake_event_plain('Event-Name: EVENT_UNKNOWN')
         self.assertTrue(self.esl.connected)
 
 
+class TestLazyInboundESL(TestInboundESL):
+    """Runs the inbound tests with lazily decoded events."""
+
+    esl_class = functools.partial(esl.InboundESL, lazy_events=True)
+
+
+class EventQueueTest(unittest.TestCase):
+    def event(self, name, uuid=None):
+        event = esl.ESLEvent('Event-Name: %s' % name)
+        if uuid is not None:
+            event.headers['Unique-ID'] = uuid
+        return event
+
+    def names(self, queue):
+        return [event.headers.get('Event-Name') for event in queue.queue]
+
+    def test_drop_oldest(self):
+        queue = esl.EventQueue(2, 'drop_oldest')
+        for name in ['A', 'B', 'C']:
+            queue.put(self.event(name))
+        self.assertEqual(self.names(queue), ['B', 'C'])
+        self.assertEqual((queue.dropped, queue.high_water), (1, 2))
+
+    def test_drop_newest(self):
+        queue = esl.EventQueue(2, 'drop_newest')
+        for name in ['A', 'B', 'C']:
+            queue.put(self.event(name))
+        self.assertEqual(self.names(queue), ['A', 'B'])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_priority(self):
+        queue = esl.EventQueue(2, 'priority',
+                               priorities={'CHANNEL_HANGUP': 10, 'HEARTBEAT': -1})
+        for name in ['CHANNEL_HANGUP', 'HEARTBEAT', 'CHANNEL_CREATE',
+                     'HEARTBEAT']:
+            queue.put(self.event(name))
+        self.assertEqual(self.names(queue), ['CHANNEL_HANGUP', 'CHANNEL_CREATE'])
+        self.assertEqual(queue.dropped, 2)
+
+    def test_coalesce(self):
+        queue = esl.EventQueue(2, 'coalesce')
+        queue.put(self.event('CHANNEL_CALLSTATE', 'a'))
+        queue.put(self.event('CHANNEL_CALLSTATE', 'b'))
+        latest = self.event('CHANNEL_CALLSTATE', 'a')
+        queue.put(latest)
+        self.assertEqual(list(queue.queue)[0], latest)
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual((queue.coalesced, queue.dropped), (1, 0))
+
+    def test_disconnect_is_never_dropped(self):
+        queue = esl.EventQueue(1, 'drop_newest')
+        queue.put(self.event('HEARTBEAT'))
+        queue.put(esl.ESLEvent('Content-Type: text/disconnect-notice'))
+        self.assertEqual(queue.qsize(), 2)
+
+    def test_reconnect_is_never_dropped(self):
+        for policy in ['drop_oldest', 'drop_newest', 'priority', 'block']:
+            queue = esl.EventQueue(1, policy)
+            queue.put(self.event('HEARTBEAT'))
+            queue.put(self.event('RECONNECT'), timeout=0.01)
+            self.assertEqual(self.names(queue), ['HEARTBEAT', 'RECONNECT'])
+            if policy != 'block':
+                queue.put(self.event('HEARTBEAT'))
+                self.assertIn('RECONNECT', self.names(queue))
+
+    def test_block(self):
+        queue = esl.EventQueue(1)
+        queue.put(self.event('HEARTBEAT'))
+        with self.assertRaises(gevent.queue.Full):
+            queue.put(self.event('HEARTBEAT'), timeout=0.01)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            esl.EventQueue(1, 'drop_all')
+
+
+class PriorityEventQueueTest(unittest.TestCase):
+    def put(self, queue, *names):
+        for name in names:
+            queue.put(esl.ESLEvent('Event-Name: %s' % name))
+
+    def test_lanes(self):
+        queue = esl.PriorityEventQueue()
+        self.put(queue, 'HEARTBEAT', 'CHANNEL_CREATE', 'CHANNEL_HANGUP',
+                 'CHANNEL_ANSWER')
+        queue.put(esl.ESLEvent('Content-Type: text/disconnect-notice'))
+        self.assertEqual(queue.lane_sizes, (2, 2, 1))
+        names = [esl._event_name(queue.get()) for _ in range(5)]
+        self.assertEqual(names, ['CHANNEL_HANGUP', 'DISCONNECT',
+                                 'CHANNEL_CREATE', 'CHANNEL_ANSWER',
+                                 'HEARTBEAT'])
+        with self.assertRaises(gevent.queue.Empty):
+            queue.get(timeout=0.01)
+
+    def test_low_rate(self):
+        queue = esl.PriorityEventQueue(low_rate=10)
+        self.put(queue, *['HEARTBEAT'] * 11)
+        for _ in range(10):
+            queue.get_nowait()
+        with self.assertRaises(gevent.queue.Empty):
+            queue.get_nowait()
+        # A normal event does not wait for the low lane.
+        self.put(queue, 'CHANNEL_CREATE')
+        self.assertEqual(queue.get_nowait().headers['Event-Name'],
+                         'CHANNEL_CREATE')
+        self.assertEqual(queue.get(timeout=1).headers['Event-Name'],
+                         'HEARTBEAT')
+
+    def names(self, queue):
+        return [[esl._event_name(event) for event in lane]
+                for lane in queue._lanes]
+
+    def test_drop_oldest(self):
+        queue = esl.PriorityEventQueue(maxsize=3, policy='drop_oldest')
+        self.put(queue, 'CHANNEL_HANGUP', 'HEARTBEAT', 'CHANNEL_CREATE',
+                 'CHANNEL_ANSWER', 'CHANNEL_BRIDGE', 'HEARTBEAT')
+        self.assertEqual(self.names(queue), [
+            ['CHANNEL_HANGUP'], ['CHANNEL_ANSWER', 'CHANNEL_BRIDGE'], []])
+        self.assertEqual((queue.dropped, queue.high_water), (3, 3))
+
+    def test_drop_newest(self):
+        queue = esl.PriorityEventQueue(maxsize=2, policy='drop_newest')
+        self.put(queue, 'HEARTBEAT', 'CHANNEL_CREATE', 'CHANNEL_HANGUP')
+        self.assertEqual(self.names(queue),
+                         [[], ['CHANNEL_CREATE'], ['HEARTBEAT']])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_coalesce(self):
+        queue = esl.PriorityEventQueue(maxsize=2, policy='coalesce')
+        self.put(queue, 'CHANNEL_CALLSTATE', 'HEARTBEAT')
+        latest = esl.ESLEvent('Event-Name: CHANNEL_CALLSTATE')
+        queue.put(latest)
+        self.assertIs(queue.get_nowait(), latest)
+        self.assertEqual((queue.coalesced, queue.dropped), (1, 0))
+
+    def test_block(self):
+        queue = esl.PriorityEventQueue(maxsize=1)
+        self.put(queue, 'HEARTBEAT')
+        with self.assertRaises(gevent.queue.Full):
+            queue.put(esl.ESLEvent('Event-Name: CHANNEL_HANGUP'),
+                      timeout=0.01)
+        putter = gevent.spawn(self.put, queue, 'CHANNEL_HANGUP')
+        gevent.sleep(0)
+        queue.get_nowait()
+        putter.join(timeout=1)
+        self.assertEqual(queue.lane_sizes, (1, 0, 0))
+
+    def test_control_events_bypass_policy(self):
+        queue = esl.PriorityEventQueue(high=[], maxsize=1,
+                                       policy='drop_newest')
+        self.put(queue, 'HEARTBEAT', 'RECONNECT')
+        queue.put(esl.ESLEvent('Content-Type: text/disconnect-notice'))
+        queue.put(None)
+        self.assertEqual(queue.lane_sizes, (3, 0, 1))
+        self.assertEqual(queue.dropped, 0)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            esl.PriorityEventQueue(maxsize=1, policy='priority')
+
+    def test_wakes_up_getter(self):
+        queue = esl.PriorityEventQueue()
+        getter = gevent.spawn(queue.get)
+        gevent.sleep(0)
+        self.put(queue, 'CHANNEL_CREATE')
+        self.assertEqual(getter.get(timeout=1).headers['Event-Name'],
+                         'CHANNEL_CREATE')
+
+    @mock.patch('greenswitch.esl.ESLProtocol._run', create=True, new_callable=mock.PropertyMock)
+    def test_process_events(self, private_run_property):
+        protocol = esl.ESLProtocol(event_queue=esl.PriorityEventQueue())
+        private_run_property.side_effect = [True, True, False]
+        handled = []
+        protocol.register_handle('*', handled.append)
+        self.put(protocol._esl_event_queue, 'HEARTBEAT', 'CHANNEL_HANGUP')
+        protocol.process_events()
+        self.assertEqual([e.headers['Event-Name'] for e in handled],
+                         ['CHANNEL_HANGUP', 'HEARTBEAT'])
+
+
+class LazyESLEventTest(unittest.TestCase):
+    def setUp(self):
+        raw = dedent("""\
+            Event-Name: CHANNEL_CREATE
+            Unique-ID: d0b1da34-a727-11e4-9728-6f83a2e5e50a
+            Event-Date-Local: 2015-01-28%2015%3A00%3A44
+            variable_switch_r_sdp: v=0
+            o=- 3631463817 3631463817 IN IP4 172.16.7.70
+            variable_endpoint_disposition: DELAYED NEGOTIATION
+            Event-Name: CHANNEL_DESTROY
+            """).encode('utf-8')
+        self.envelope = {'Content-Type': 'text/event-plain',
+                         'Content-Length': str(len(raw))}
+        self.event = esl.LazyESLEvent(raw, self.envelope)
+
+    def test_lookup_does_not_build_dict(self):
+        """
+        Reading a header decodes only that value, the full dict
+        is not built until the headers are iterated.
+        """
+        headers = self.event.headers
+        self.assertEqual(headers['Event-Date-Local'], '2015-01-28 15:00:44')
+        self.assertEqual(headers.get('Content-Type'), 'text/event-plain')
+        self.assertIsNone(headers.get('Not-There'))
+        self.assertNotIn('Not-There', headers)
+        self.assertIsNone(headers._headers)
+
+    def test_same_values_as_eager_parsing(self):
+        """
+        Lazy lookups, including multiline values and repeated
+        headers, match the eagerly parsed ESLEvent.
+        """
+        eager = esl.ESLEvent('')
+        eager.headers.update(self.envelope)
+        eager.parse_data(self.event.headers._raw.decode('utf-8'))
+        for key in eager.headers:
+            self.assertEqual(self.event.headers[key], eager.headers[key])
+        self.assertEqual(dict(self.event.headers), eager.headers)
+        self.assertEqual(self.event.headers['Event-Name'], 'CHANNEL_DESTROY')
+
+    def test_setitem_materializes(self):
+        self.event.headers['Custom'] = 'value'
+        self.assertEqual(self.event.headers['Custom'], 'value')
+        self.assertEqual(len(self.event.headers), 8)
+
+
 class ESLProtocolTest(TestInboundESLBase):
     def test_receive_events_io_error_handling(self):
         """
@@ -383,8 +905,7 @@ class ESLProtocolTest(TestInboundESLBase):
         """
         protocol = esl.ESLProtocol()
         protocol.sock = mock.Mock()
-        protocol.sock_file = mock.Mock()
-        protocol.sock_file.readline.side_effect = Exception()
+        protocol.sock.recv_into.side_effect = Exception()
 
         protocol.receive_events()
         self.assertTrue(protocol.sock.close.called)
@@ -399,8 +920,7 @@ class ESLProtocolTest(TestInboundESLBase):
         protocol = esl.ESLProtocol()
         protocol.connected = True
         protocol.sock = mock.Mock()
-        protocol.sock_file = mock.Mock()
-        protocol.sock_file.readline.return_value = None
+        protocol.sock.recv_into.return_value = 0
 
         protocol.receive_events()
         self.assertFalse(protocol.sock.close.called)
@@ -408,23 +928,24 @@ class ESLProtocolTest(TestInboundESLBase):
 
     def test_handle_event_with_packet_loss(self):
         """
-        `handle_event` detects if the data read by
-        socket doesn't have enough length that its
-        metadata "Content-Length" header says, and
-        concats more data on event's.
+        `receive_events` waits for the whole body when the socket
+        returns less data than its "Content-Length" header says.
         """
         protocol = esl.ESLProtocol()
-        protocol._commands_sent.append(mock.Mock())
+        async_response = mock.Mock()
+        protocol._commands_sent.append(async_response)
         protocol.sock = mock.Mock()
-        protocol.sock_file = mock.Mock()
-        protocol.sock_file.read.return_value = b'123456789'
-        event = mock.Mock()
-        event.headers = {
-            'Content-Type': 'api/response',
-            'Content-Length': '10',
-        }
+        chunks = [b'Content-Type: api/response\nContent-Length: 18\n\n',
+                  b'123456789', b'123456789', b'']
 
-        protocol.handle_event(event)
+        def recv_into(view):
+            chunk = chunks.pop(0)
+            view[:len(chunk)] = chunk
+            return len(chunk)
+        protocol.sock.recv_into.side_effect = recv_into
+
+        protocol.receive_events()
+        event = async_response.set.call_args[0][0]
         self.assertEqual(event.data, '123456789123456789')
 
     def test_handle_event_disconnect_with_linger(self):
@@ -437,15 +958,15 @@ class ESLProtocolTest(TestInboundESLBase):
         protocol.connected = True
         protocol._commands_sent.append(mock.Mock())
         protocol.sock = mock.Mock()
-        event = mock.Mock()
-        event.headers = {
-            'Content-Type': 'text/disconnect-notice',
-            'Content-Disposition': 'linger',
-        }
+        protocol.connection.receive_data(
+            b'Content-Type: text/disconnect-notice\n'
+            b'Content-Disposition: linger\n\n')
 
-        protocol.handle_event(event)
+        protocol._handle_received()
         self.assertTrue(protocol.connected)
+        self.assertTrue(protocol._lingering)
         self.assertFalse(protocol.sock.close.called)
+        self.assertEqual(protocol._esl_event_queue.qsize(), 1)
 
     def test_handle_event_rude_rejection(self):
         """
@@ -454,17 +975,13 @@ class ESLProtocolTest(TestInboundESLBase):
         """
         protocol = esl.ESLProtocol()
         protocol.connected = True
-        protocol.sock_file = mock.Mock()
-        protocol.sock_file.read.return_value = b'123'
-        event = mock.Mock()
-        event.headers = {
-            'Content-Type': 'text/rude-rejection',
-            'Content-Length': '3',
-        }
+        protocol.connection.receive_data(
+            b'Content-Type: text/rude-rejection\nContent-Length: 3\n\n123')
 
-        protocol.handle_event(event)
+        protocol._handle_received()
         self.assertFalse(protocol.connected)
-        self.assertTrue(protocol.sock_file.read.called)
+        self.assertTrue(protocol._auth_request_event.is_set())
+        self.assertEqual(protocol.connection.buffered, 0)
 
     def test_private_safe_exec_handler(self):
         """
@@ -481,21 +998,24 @@ class ESLProtocolTest(TestInboundESLBase):
         self.assertTrue(bad_handler.called)
         bad_handler.assert_called_with(event)
 
-    @mock.patch('greenswitch.esl.ESLProtocol._run', create=True, new_callable=mock.PropertyMock)
-    @mock.patch('gevent.sleep')
-    def test_process_events_quick_sleep_for_falsy_events_queue(self,
-                                                               gevent_sleep,
-                                                               private_run_property):
+    def test_process_events_pause(self):
         """
-        `process_events` sleeps for 1s if ESL queue has falsy value.
+        `process_events` waits without polling while paused and handles
+        the queued events once resumed.
         """
         protocol = esl.ESLProtocol()
-        private_run_property.side_effect = [True, False]
+        handler = mock.Mock()
+        protocol.register_handle('*', handler)
         protocol._process_esl_event_queue = False
-
-        protocol.process_events()
-        self.assertTrue(gevent_sleep.called)
-        gevent_sleep.assert_called_with(1)
+        greenlet = gevent.spawn(protocol.process_events)
+        protocol._esl_event_queue.put(esl.ESLEvent('Event-Name: HEARTBEAT'))
+        gevent.sleep(0.05)
+        self.assertFalse(handler.called)
+        protocol._process_esl_event_queue = True
+        gevent.sleep(0.01)
+        self.assertTrue(handler.called)
+        protocol._stop_running()
+        self.assertTrue(greenlet.join(timeout=1) or greenlet.dead)
 
     @mock.patch('greenswitch.esl.ESLProtocol._run', create=True, new_callable=mock.PropertyMock)
     def test_process_events_with_custom_name(self, private_run_property):
@@ -600,6 +1120,24 @@ class ESLProtocolTest(TestInboundESLBase):
         self.assertTrue(some_handlers[1].called)
         some_handlers[1].assert_called_with(event)
 
+    def test_hooks_set_after_dispatch(self):
+        """
+        `before_handle` and `after_handle` set after events were already
+        dispatched are called for the following events.
+        """
+        protocol = esl.ESLProtocol()
+        handler = mock.Mock()
+        protocol.register_handle('HEARTBEAT', handler)
+        event = esl.ESLEvent('Event-Name: HEARTBEAT\n')
+        protocol._dispatch_event(event)
+
+        protocol.before_handle = mock.Mock()
+        protocol.after_handle = mock.Mock()
+        protocol._dispatch_event(event)
+        protocol.before_handle.assert_called_once_with(event)
+        protocol.after_handle.assert_called_once_with(event)
+        self.assertEqual(handler.call_count, 2)
+
     @mock.patch('greenswitch.esl.ESLProtocol._run', create=True, new_callable=mock.PropertyMock)
     def test_process_events_with_post_handler(self, private_run_property):
         """
@@ -633,8 +1171,7 @@ class ESLProtocolTest(TestInboundESLBase):
         `stop` must, if connected, try to send "exit"
         but ignore any exception that `send` method may
         raise for `NotConnectedError` and keep
-        process/receiving until closing the socket
-        and its file.
+        process/receiving until closing the socket.
         """
         protocol = esl.ESLProtocol()
         protocol.connected = True
@@ -643,7 +1180,6 @@ class ESLProtocolTest(TestInboundESLBase):
         protocol._receive_events_greenlet = mock.Mock()
         protocol._process_events_greenlet = mock.Mock()
         protocol.sock = mock.Mock()
-        protocol.sock_file = mock.Mock()
 
         protocol.stop()
         self.assertTrue(protocol.send.called)
@@ -651,5 +1187,4 @@ class ESLProtocolTest(TestInboundESLBase):
         self.assertTrue(protocol._receive_events_greenlet.join.called)
         self.assertTrue(protocol._process_events_greenlet.join.called)
         self.assertTrue(protocol.sock.close.called)
-        self.assertTrue(protocol.sock_file.close.called)
 
@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+import gc
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest
+
+import gevent
+import greenlet
+import gevent.socket as socket
+
+from greenswitch import esl
+
+
+class FakeOutboundChannel(object):
+    """Plays FreeSWITCH's side of an outbound socket connection."""
+
+    def __init__(self, port, close_on_hangup=False):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.close_on_hangup = close_on_hangup
+        self.commands = []
+
+    def command_reply(self, text, extra=''):
+        self.sock.sendall(('Content-Type: command/reply\nReply-Text: %s\n%s\n'
+                           % (text, extra)).encode('utf-8'))
+
+    def run(self):
+        buf = b''
+        while True:
+            while b'\n\n' not in buf:
+                data = self.sock.recv(4096)
+                if not data:
+                    return
+                buf += data
+            command, buf = buf.split(b'\n\n', 1)
+            command = command.decode('utf-8').strip()
+            self.commands.append(command)
+            if command == 'connect':
+                self.command_reply('+OK', 'variable_uuid: abc\n'
+                                          'Caller-Caller-ID-Number: 100\n')
+            elif command == 'exit' or (self.close_on_hangup and
+                                       'execute-app-name: hangup' in command):
+                self.command_reply('+OK bye')
+                self.sock.close()
+                return
+            else:
+                self.command_reply('+OK')
+
+
+class TestOutboundESLServer(unittest.TestCase):
+
+    lean_sessions = False
+    handshake = None
+    event_queue_factory = None
+
+    def setUp(self):
+        self.results = results = []
+        self.sessions = sessions = []
+
+        class Application(object):
+            def __init__(self, session):
+                self.session = session
+
+            def run(self):
+                sessions.append(self.session)
+                self.session.myevents()
+                results.append(self.session.uuid)
+
+        self.server = esl.OutboundESLServer(
+            bind_port=8025, application=Application,
+            lean_sessions=self.lean_sessions, handshake=self.handshake,
+            event_queue_factory=self.event_queue_factory)
+        self.listen = gevent.spawn(self.server.listen)
+        gevent.sleep(0)
+
+    def tearDown(self):
+        self.server.stop()
+        self.listen.join(timeout=1)
+
+    def call(self):
+        channel = FakeOutboundChannel(self.server.bound_port)
+        gevent.with_timeout(2, channel.run)
+        return channel
+
+    def test_call(self):
+        """Should run the application for every call."""
+        channels = [gevent.spawn(self.call) for _ in range(2)]
+        gevent.joinall(channels, timeout=2)
+        self.assertEqual(self.results, ['abc', 'abc'])
+        self.assertEqual(channels[0].value.commands,
+                         ['connect', 'myevents', 'exit'])
+        self.assertEqual(self.server.connection_count, 0)
+
+    def test_reject_over_capacity(self):
+        """Should hang up calls over max_connections without a session."""
+        self.server.max_connections = 0
+        self.server.reject_hangup_cause = 'CALL_REJECTED'
+        channel = self.call()
+        self.assertEqual(channel.commands, [
+            'connect',
+            'sendmsg\ncall-command: execute\nexecute-app-name: hangup\n'
+            'execute-app-arg: CALL_REJECTED',
+            'exit'])
+        self.assertEqual(self.results, [])
+        self.assertEqual(self.server.rejected, 1)
+        self.assertEqual(self.server.pending_accepts, 0)
+
+    def test_reject_on_loop_lag(self):
+        """Should reject calls while the event loop lags."""
+        self.server.max_loop_lag = 0.1
+        self.server.loop_lag = 0.5
+        channel = self.call()
+        self.assertEqual(channel.commands, ['connect', 'exit'])
+        self.assertEqual(self.results, [])
+
+    def test_stop(self):
+        """Should stop listening at once, without polling accept."""
+        started = time.monotonic()
+        self.server.stop()
+        self.listen.join(timeout=1)
+        self.assertTrue(self.listen.dead)
+        self.assertLess(time.monotonic() - started, 0.05)
+
+
+class TestLeanOutboundESLServer(TestOutboundESLServer):
+    """Runs the outbound server tests with lean sessions."""
+
+    lean_sessions = True
+
+    def test_lean_session(self):
+        """Should read and dispatch events in a single greenlet."""
+        a, b = socket.socketpair()
+        session = esl.OutboundSession(('127.0.0.1', 0), a, lean=True)
+        self.assertIsNone(session._process_events_greenlet)
+        self.assertIsNone(session._esl_event_queue)
+        events = []
+        session.register_handle('CHANNEL_ANSWER', events.append)
+        body = b'Event-Name: CHANNEL_ANSWER\n'
+        b.sendall(b'Content-Type: text/event-plain\nContent-Length: %d\n\n%s'
+                  % (len(body), body))
+        gevent.sleep(0.01)
+        self.assertEqual(len(events), 1)
+        b.close()
+        session._receive_events_greenlet.join(timeout=1)
+        self.assertFalse(session.connected)
+
+    def session_budget(self, lean, count=100):
+        """Return the memory in bytes and greenlets used per session."""
+        pairs = [socket.socketpair() for _ in range(count)]
+        gc.collect()
+        greenlets = sum(isinstance(o, greenlet.greenlet)
+                        for o in gc.get_objects())
+        tracemalloc.start()
+        try:
+            sessions = [esl.OutboundSession(('127.0.0.1', 0), a, lean=lean)
+                        for a, b in pairs]
+            gevent.sleep(0)
+            memory = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        gc.collect()
+        greenlets = sum(isinstance(o, greenlet.greenlet)
+                        for o in gc.get_objects()) - greenlets
+        for a, b in pairs:
+            b.close()
+        for session in sessions:
+            session._receive_events_greenlet.join(timeout=1)
+        for a, b in pairs:
+            a.close()
+        return memory / count, greenlets / float(count)
+
+    def test_lean_session_budget(self):
+        """Should keep lean sessions to one greenlet and about 13 KB."""
+        memory, greenlets = self.session_budget(lean=False)
+        self.assertAlmostEqual(greenlets, 2, delta=0.1)
+        self.assertGreater(memory, 64 * 1024)
+        memory, greenlets = self.session_budget(lean=True)
+        self.assertAlmostEqual(greenlets, 1, delta=0.1)
+        self.assertLess(memory, 16 * 1024)
+
+
+class TestHandshakeOutboundESLServer(TestOutboundESLServer):
+    """Runs the outbound server tests with a pipelined handshake."""
+
+    handshake = ['myevents', 'linger']
+
+    def test_call(self):
+        """Should send the handshake once, in the connect write."""
+        channel = self.call()
+        self.assertEqual(self.results, ['abc'])
+        self.assertEqual(channel.commands,
+                         ['connect', 'myevents', 'linger', 'exit'])
+
+
+class TestEventQueueOutboundESLServer(TestOutboundESLServer):
+    """Runs the outbound server tests with bounded priority queues."""
+
+    @staticmethod
+    def event_queue_factory():
+        return esl.PriorityEventQueue(maxsize=10, policy='drop_oldest')
+
+    def test_call(self):
+        """Should give each session its own event queue."""
+        super(TestEventQueueOutboundESLServer, self).test_call()
+        queues = [session._esl_event_queue for session in self.sessions]
+        self.assertIsInstance(queues[0], esl.PriorityEventQueue)
+        self.assertIsNot(queues[0], queues[1])
+
+    def test_lean_sessions(self):
+        """Should refuse an event queue for lean sessions."""
+        with self.assertRaises(ValueError):
+            esl.OutboundESLServer(application=object, lean_sessions=True,
+                                  event_queue_factory=esl.EventQueue)
+
+
+class TestDrainOutboundESLServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.handoff_path = os.path.join(self.tmpdir, 'handoff.sock')
+        self.results = results = []
+
+        class Application(object):
+            def __init__(self, session):
+                self.session = session
+
+            def run(self):
+                results.append(self.session.uuid)
+                # Never completes, the fake channel sends no events.
+                self.session.playback('ivr/ivr-welcome')
+
+        self.application = Application
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def start(self, **kwargs):
+        server = esl.OutboundESLServer(bind_port=8032,
+                                       application=self.application,
+                                       handoff_path=self.handoff_path,
+                                       **kwargs)
+        listen = gevent.spawn(server.listen)
+        gevent.sleep(0.01)
+        return server, listen
+
+    def call(self, close_on_hangup=False):
+        channel = FakeOutboundChannel(8032, close_on_hangup)
+        greenlet = gevent.spawn(gevent.with_timeout, 2, channel.run)
+        gevent.sleep(0.05)
+        return channel, greenlet
+
+    def test_drain_kill(self):
+        """Should kill the calls still active at drain_timeout."""
+        server, listen = self.start(drain_timeout=0.1, drain_policy='kill')
+        channel, greenlet = self.call()
+        self.assertEqual(server.connection_count, 1)
+        server.stop()
+        gevent.sleep(0.05)
+        self.assertTrue(server.draining)
+        listen.join(timeout=1)
+        self.assertTrue(listen.dead)
+        self.assertFalse(server.draining)
+        self.assertEqual(server.connection_count, 0)
+        greenlet.join(timeout=1)
+        self.assertEqual(channel.commands[-1], 'exit')
+
+    def test_drain_hangup(self):
+        """Should hang up the calls still active at drain_timeout."""
+        server, listen = self.start(drain_timeout=0.1, drain_policy='hangup')
+        channel, greenlet = self.call(close_on_hangup=True)
+        server.stop()
+        listen.join(timeout=1)
+        self.assertTrue(listen.dead)
+        self.assertIn('execute-app-arg: SYSTEM_SHUTDOWN',
+                      channel.commands[-1])
+
+    def test_handoff(self):
+        """Should hand the listening socket to the next server."""
+        old, old_listen = self.start(drain_policy='kill', drain_timeout=1)
+        channel, greenlet = self.call()
+        new, new_listen = self.start()
+        self.assertTrue(old.draining)
+        self.assertEqual(new.bound_port, 8032)
+        self.call()
+        self.assertEqual(new.connection_count, 1)
+        self.assertEqual(old.connection_count, 1)
+        old_listen.join(timeout=2)
+        self.assertTrue(old_listen.dead)
+        self.assertTrue(os.path.exists(self.handoff_path))
+        new.drain_policy = 'kill'
+        new.drain_timeout = 0
+        new.stop()
+        new_listen.join(timeout=1)
+        self.assertTrue(new_listen.dead)
+        self.assertFalse(os.path.exists(self.handoff_path))
+
+    def test_handoff_ipv6(self):
+        """Should hand the listening sockets over with their family."""
+        kwargs = dict(bind_address=['127.0.0.1', '::1'], listen_all=True)
+        old, old_listen = self.start(drain_policy='kill', drain_timeout=0,
+                                     **kwargs)
+        new, new_listen = self.start(**kwargs)
+        self.assertEqual([listener.family for listener in new.listeners],
+                         [socket.AF_INET, socket.AF_INET6])
+        self.assertEqual(sorted(new.listener_connections),
+                         [('127.0.0.1', 8032), ('::1', 8032)])
+        old_listen.join(timeout=1)
+        self.assertTrue(old_listen.dead)
+        new.stop()
+        new_listen.join(timeout=1)
+        self.assertTrue(new_listen.dead)
+
+    def test_handoff_other_user(self):
+        """Should only hand the listening socket to the same user."""
+        old, old_listen = self.start(drain_policy='kill', drain_timeout=0)
+        self.assertEqual(os.stat(self.handoff_path).st_mode & 0o777, 0o600)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.handoff_path)
+        with mock.patch('os.getuid', return_value=os.getuid() + 1):
+            msg, ancdata, _, _ = client.recvmsg(16, socket.CMSG_SPACE(64))
+        client.close()
+        self.assertEqual((msg, ancdata), (b'', []))
+        self.assertFalse(old.draining)
+        self.assertFalse(old_listen.dead)
+
+        new, new_listen = self.start()
+        self.assertEqual(new.bound_port, 8032)
+        old_listen.join(timeout=1)
+        self.assertTrue(old_listen.dead)
+        new.stop()
+        new_listen.join(timeout=1)
+        self.assertTrue(new_listen.dead)
+
+
+class TestOutboundSessionDisconnect(unittest.TestCase):
+
+    def test_disconnect_with_bgapi_pending(self):
+        """Should fail commands and jobs whose replies were pending."""
+        a, b = socket.socketpair()
+        session = esl.OutboundSession(('127.0.0.1', 0), a)
+        command = session.send_async('api status')
+        job = session.bgapi('status')
+        b.close()
+        session._receive_events_greenlet.join(timeout=1)
+        self.assertTrue(session._receive_events_greenlet.successful())
+        with self.assertRaises(esl.OutboundSessionHasGoneAway):
+            command.get(timeout=0)
+        with self.assertRaises(esl.NotConnectedError):
+            job.get(timeout=0)
+
+
+class TestMultiListenerOutboundESLServer(unittest.TestCase):
+
+    def setUp(self):
+        self.results = results = []
+
+        class Application(object):
+            def __init__(self, session):
+                self.session = session
+
+            def run(self):
+                results.append(self.session.uuid)
+
+        self.server = esl.OutboundESLServer(bind_port=[8026, 8027],
+                                            application=Application,
+                                            listen_all=True, backlog=512,
+                                            accept_batch=8)
+        self.listen = gevent.spawn(self.server.listen)
+        gevent.sleep(0)
+
+    def tearDown(self):
+        self.server.stop()
+        self.listen.join(timeout=1)
+
+    def call(self, port):
+        channel = FakeOutboundChannel(port)
+        gevent.with_timeout(2, channel.run)
+        return channel
+
+    def test_listen_all(self):
+        """Should accept calls on every configured port."""
+        self.assertEqual(sorted(self.server.listener_connections),
+                         [('127.0.0.1', 8026), ('127.0.0.1', 8027)])
+        channels = [gevent.spawn(self.call, port)
+                    for port in (8026, 8027, 8026, 8027)]
+        gevent.joinall(channels, timeout=2)
+        self.assertEqual(self.results, ['abc'] * 4)
+        self.assertEqual(self.server.listener_connections,
+                         {('127.0.0.1', 8026): 0, ('127.0.0.1', 8027): 0})
+        self.assertEqual(self.server.connection_count, 0)
+
+    def test_stop(self):
+        """Should stop every listener."""
+        self.server.stop()
+        self.listen.join(timeout=1)
+        self.assertTrue(self.listen.dead)
+
+
+class TestPreforkOutboundESLServer(unittest.TestCase):
+
+    port = 8029
+
+    def start(self, *args):
+        self.supervisor = subprocess.Popen(
+            [sys.executable, '-m', 'tests.preforkserver', str(self.port)] +
+            [str(arg) for arg in args], start_new_session=True)
+        self.call()
+
+    def tearDown(self):
+        try:
+            self.supervisor.send_signal(signal.SIGTERM)
+            self.assertEqual(self.supervisor.wait(timeout=5), 0)
+        finally:
+            # Workers must not outlive a failed test.
+            try:
+                os.killpg(self.supervisor.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def call(self, timeout=5):
+        """Return the commands of a new call, once a worker answers."""
+        started = time.monotonic()
+        while True:
+            try:
+                channel = FakeOutboundChannel(self.port)
+            except socket.error:
+                if time.monotonic() - started > timeout:
+                    raise
+                gevent.sleep(0.05)
+                continue
+            gevent.with_timeout(2, channel.run)
+            return channel.commands
+
+    def worker_pid(self):
+        """Return the pid of the worker handling a new call."""
+        return int(self.call()[2].split()[1])
+
+    def test_workers(self):
+        """Should handle calls in the forked workers."""
+        self.start(2)
+        pids = set(self.worker_pid() for _ in range(8))
+        self.assertTrue(1 <= len(pids) <= 2)
+        self.assertNotIn(self.supervisor.pid, pids)
+
+    def test_restart(self):
+        """Should restart workers that die."""
+        self.start(1)
+        pid = self.worker_pid()
+        os.kill(pid, signal.SIGKILL)
+        gevent.sleep(0.05)
+        self.assertNotEqual(self.worker_pid(), pid)
+
+    def test_max_total_connections(self):
+        """Should reject calls over the limit of all workers."""
+        self.start(2, 0)
+        self.assertEqual(self.call(), ['connect', 'exit'])
+
+    def test_start_failures(self):
+        """Should stop restarting workers that can not bind."""
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', self.port))
+        listener.listen(1)
+        try:
+            self.supervisor = subprocess.Popen(
+                [sys.executable, '-m', 'tests.preforkserver', str(self.port),
+                 '1'], start_new_session=True, stderr=subprocess.DEVNULL)
+            self.assertEqual(self.supervisor.wait(timeout=10), 0)
+        finally:
+            listener.close()
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
+import gevent
+import gevent.event
 import mock
 import unittest
 import pytest
@@ -72,6 +75,21 @@ class TestWhileConnectedMethod(unittest.TestCase):
 
         self.execute_slow_task.assert_called()
 
+    def test_coroutine_decorator(self):
+        @self.outbound_session.while_connected()
+        async def myflow():
+            self.simulate_caller_hangup()
+            self.execute_slow_task()
+
+        loop = asyncio.new_event_loop()
+        try:
+            with self.assertRaises(esl.OutboundSessionHasGoneAway):
+                loop.run_until_complete(myflow())
+        finally:
+            loop.close()
+
+        self.execute_slow_task.assert_called()
+
     def test_skip_code_execution_if_the_outbound_session_is_disconnected(self):
         self.simulate_caller_hangup()
 
@@ -95,3 +113,81 @@ class TestWhileConnectedMethod(unittest.TestCase):
         # stop and assert sock.close is called
         self.outbound_session.stop()
         assert self.outbound_session.sock.close.called
+
+
+@pytest.mark.usefixtures("outbound_session")
+@pytest.mark.usefixtures("disconnect_event")
+class TestExpectedEvents(unittest.TestCase):
+    def execute_complete(self, **variables):
+        event = esl.ESLEvent('Event-Name: CHANNEL_EXECUTE_COMPLETE\n')
+        for name, value in variables.items():
+            event.headers['variable_%s' % name] = value
+        return event
+
+    def test_resolve_by_value(self):
+        playback = gevent.event.AsyncResult()
+        say = gevent.event.AsyncResult()
+        for app_name, waiter in (('playback', playback), ('say', say)):
+            self.outbound_session.register_expected_event(
+                'CHANNEL_EXECUTE_COMPLETE', 'current_application', app_name,
+                waiter)
+        event = self.execute_complete(current_application='say')
+        self.outbound_session.on_event(event)
+        self.assertIs(say.get(timeout=0), event)
+        self.assertFalse(playback.ready())
+
+    def test_missing_variable_does_not_strand_waiters(self):
+        digits = gevent.event.AsyncResult()
+        playback = gevent.event.AsyncResult()
+        self.outbound_session.register_expected_event(
+            'CHANNEL_EXECUTE_COMPLETE', 'digits', '1', digits)
+        self.outbound_session.register_expected_event(
+            'CHANNEL_EXECUTE_COMPLETE', 'current_application', 'playback',
+            playback)
+        event = self.execute_complete(current_application='playback')
+        self.outbound_session.on_event(event)
+        self.assertIs(playback.get(timeout=0), event)
+        self.assertFalse(digits.ready())
+
+    def test_resolve_every_matching_waiter(self):
+        waiters = [gevent.event.AsyncResult() for _ in range(3)]
+        for waiter in waiters:
+            self.outbound_session.register_expected_event(
+                'CHANNEL_EXECUTE_COMPLETE', 'current_application', 'say',
+                waiter)
+        self.outbound_session.on_event(
+            self.execute_complete(current_application='say'))
+        self.assertTrue(all(waiter.ready() for waiter in waiters))
+        self.assertEqual(self.outbound_session.expected_events, {})
+
+    def test_unregister_on_timeout(self):
+        with self.assertRaises(gevent.Timeout):
+            self.outbound_session.call_command('say', 'en', block=True,
+                                               response_timeout=0.01)
+        self.assertEqual(self.outbound_session.expected_events, {})
+
+    def test_fail_waiters(self):
+        waiter = gevent.event.AsyncResult()
+        self.outbound_session.register_expected_event(
+            'CHANNEL_EXECUTE_COMPLETE', 'current_application', 'say', waiter)
+        self.outbound_session.on_disconnect(self.disconnect_event)
+        with self.assertRaises(esl.OutboundSessionHasGoneAway):
+            waiter.get(timeout=0)
+        self.assertEqual(self.outbound_session.expected_events, {})
+
+    def test_execute_async_by_application_uuid(self):
+        commands = []
+        self.outbound_session.send = mock.MagicMock(side_effect=commands.append)
+        first = self.outbound_session.execute_async('playback', 'a.wav')
+        second = self.outbound_session.execute_async('playback', 'b.wav')
+        first_uuid, second_uuid = [
+            command.split('Event-UUID: ')[1] for command in commands]
+        self.assertNotEqual(first_uuid, second_uuid)
+
+        event = self.execute_complete(current_application='playback')
+        event.headers['Application-UUID'] = second_uuid
+        self.outbound_session.on_event(event)
+        self.assertIs(second.get(timeout=0), event)
+        self.assertFalse(first.ready())
+        self.assertEqual(list(self.outbound_session.expected_events[
+            'CHANNEL_EXECUTE_COMPLETE']['Application-UUID']), [first_uuid])